@@ -0,0 +1,392 @@
+"""
+活動記錄 (交易明細)
+每天一個 JSON Lines 檔 (activities/YYYY-MM-DD.jsonl)，新增一筆只附加一行；
+讀取時從檔尾往前讀 (最新的在前)，不必載入整天的記錄。
+各動作的筆數在附加時累計，多個行程同時寫入時以檔案鎖互斥，並補讀其他行程新增的行。
+
+歷史查詢以日期檔名作為日期索引，另外在 index.json 保存每天的筆數、各動作筆數與出現過的書籍 id，
+查詢日期區間時可直接加總筆數、跳過沒有符合記錄的日期。
+"""
+
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+import base64
+import logging
+import os
+import re
+import threading
+
+from json_backend import dump, dumpb, load, loads
+from locks import FileLock
+
+logger = logging.getLogger(__name__)
+
+ACTIONS = ('add', 'edit', 'delete', 'category_change', 'batch')
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+_DAY_FILE_RE = re.compile(r'^(\d{4}-\d{2}-\d{2})\.jsonl$')
+
+
+def _empty_counts():
+    return dict.fromkeys(ACTIONS, 0)
+
+
+def activity_book_ids(activity):
+    """記錄涉及的書籍 id (批次操作包含每一筆)"""
+    ids = set()
+    if activity.get('book_id') is not None:
+        ids.add(activity['book_id'])
+    for item in (activity.get('details') or {}).get('operations', ()):
+        if item.get('book_id') is not None:
+            ids.add(item['book_id'])
+    return ids
+
+
+def build_activity(action, book_data, old_data=None):
+    """產生一筆活動記錄 (尚未寫入)"""
+    activity = {
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'date': datetime.now().strftime('%Y-%m-%d'),
+        'time': datetime.now().strftime('%H:%M:%S'),
+        'action': action,  # 'add', 'edit', 'delete', 'category_change', 'batch'
+        'book_id': book_data.get('id'),
+        'book_title': book_data.get('title', ''),
+        'book_author': book_data.get('author', ''),
+        'book_category': book_data.get('category', ''),
+        'old_category': old_data.get('category', '') if old_data else None,
+        'details': {}
+    }
+
+    # 記錄變更細節
+    if action == 'edit' and old_data:
+        changes = []
+        for key in ['title', 'author', 'date', 'note', 'category']:
+            old_val = old_data.get(key, '')
+            new_val = book_data.get(key, '')
+            if old_val != new_val:
+                changes.append({
+                    'field': key,
+                    'old': old_val,
+                    'new': new_val
+                })
+        activity['details']['changes'] = changes
+    elif action == 'category_change' and old_data:
+        activity['details']['old_category'] = old_data.get('category', '')
+        activity['details']['new_category'] = book_data.get('category', '')
+
+    return activity
+
+
+def build_batch_activity(results):
+    """批次操作的結果 (BookCache.plan_batch) 合併為一筆活動 (details.operations 為每一筆的內容)"""
+    operations = []
+    for result in results:
+        if result['status'] != 'ok':
+            continue
+        if result['op'] == 'add':
+            item = build_activity('add', result['book'])
+        elif result['op'] == 'delete':
+            item = build_activity('delete', result['book'])
+        else:
+            old_book, book = result['old'], result['book']
+            action = 'category_change' if old_book.get('category') != book.get('category') else 'edit'
+            item = build_activity(action, book, old_book)
+        for key in ('timestamp', 'date', 'time'):
+            del item[key]
+        operations.append(item)
+
+    counts = {}
+    for item in operations:
+        counts[item['action']] = counts.get(item['action'], 0) + 1
+    activity = build_activity('batch', {'title': f'批次操作 {len(operations)} 本書籍'})
+    activity['details'] = {'operations': operations, 'counts': counts}
+    return activity
+
+
+def activity_stats(counts):
+    """將各動作筆數轉為前端使用的統計欄位"""
+    return {
+        'total': counts['total'],
+        'adds': counts['add'],
+        'edits': counts['edit'],
+        'deletes': counts['delete'],
+        'category_changes': counts['category_change'],
+        'batches': counts['batch'],
+    }
+
+
+def parse_day(value):
+    """YYYY-MM-DD，格式錯誤時拋出 ValueError"""
+    if not value:
+        return None
+    return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+
+
+class _Segment:
+    """一天的記錄檔目前讀到的位置、筆數與各動作筆數"""
+
+    def __init__(self, inode=None):
+        self.inode = inode
+        self.offset = 0
+        self.count = 0
+        self.counts = _empty_counts()
+        self.book_ids = set()
+
+    def add(self, activity):
+        self.count += 1
+        action = activity.get('action')
+        if action in self.counts:
+            self.counts[action] += 1
+        self.book_ids.update(activity_book_ids(activity))
+
+    def to_dict(self):
+        return {
+            'inode': self.inode, 'offset': self.offset, 'count': self.count,
+            'counts': self.counts, 'book_ids': sorted(self.book_ids),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        segment = cls(data['inode'])
+        segment.offset = data['offset']
+        segment.count = data['count']
+        segment.counts = {**_empty_counts(), **data['counts']}
+        segment.book_ids = set(data['book_ids'])
+        return segment
+
+
+def encode_cursor(day, activity_id):
+    return base64.urlsafe_b64encode(f'{day}:{activity_id}'.encode('ascii')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """解析分頁游標 (日期, 記錄 id)，格式錯誤時拋出 ValueError"""
+    try:
+        day, activity_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii').split(':')
+        return day, int(activity_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+class ActivityJournal:
+    """以日期分段的附加式活動記錄"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._file_lock = FileLock(os.path.join(directory, 'activities.lock'))
+        self._index_file = os.path.join(directory, 'index.json')
+        self._segments = self._load_index()  # day -> _Segment
+
+    def segment_path(self, day):
+        return os.path.join(self.directory, f'{day}.jsonl')
+
+    def _load_index(self):
+        try:
+            with open(self._index_file, 'r', encoding='utf-8') as f:
+                return {day: _Segment.from_dict(data) for day, data in load(f).items()}
+        except Exception:
+            return {}
+
+    def _save_index(self):
+        """保存每天的統計 (呼叫端須持有 _lock)；寫入失敗不影響記錄本身"""
+        tmp_file = self._index_file + f'.{os.getpid()}.tmp'
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                dump({day: seg.to_dict() for day, seg in self._segments.items()}, f)
+            os.replace(tmp_file, self._index_file)
+        except OSError as e:
+            logger.error(f"Error saving activity index: {e}")
+
+    def days(self):
+        """有記錄的日期 (由舊到新)"""
+        return sorted(
+            m.group(1) for m in map(_DAY_FILE_RE.match, os.listdir(self.directory)) if m
+        )
+
+    def _sync(self, day):
+        """補讀上次讀取之後新增的行 (其他行程寫入的記錄)"""
+        segment = self._segments.get(day)
+        if segment is None:
+            segment = self._segments[day] = _Segment()
+        path = self.segment_path(day)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stat = None
+        size = stat.st_size if stat else 0
+        inode = stat.st_ino if stat else None
+        if inode != segment.inode or size < segment.offset:
+            # 檔案被清除或取代，重新計算
+            segment = self._segments[day] = _Segment(inode)
+        if size == segment.offset:
+            return segment
+        with open(path, 'rb') as f:
+            f.seek(segment.offset)
+            data = f.read(size - segment.offset)
+        end = data.rfind(b'\n') + 1  # 只處理完整的行
+        for line in data[:end].splitlines():
+            try:
+                segment.add(loads(line))
+            except ValueError:
+                continue
+        segment.offset += end
+        return segment
+
+    def append(self, activity):
+        """附加一筆記錄 (依日期寫入當天的檔案)，回傳含 id 的記錄"""
+        with self._lock, self._file_lock:
+            return self._append_locked(activity)
+
+    def _append_locked(self, activity):
+        day = activity['date']
+        segment = self._sync(day)
+        activity = {'id': segment.count + 1, **activity}
+        line = dumpb(activity) + b'\n'
+        with open(self.segment_path(day), 'ab') as f:
+            f.write(line)
+            segment.inode = os.fstat(f.fileno()).st_ino
+        segment.offset += len(line)
+        segment.add(activity)
+        return activity
+
+    def counts(self, day):
+        """某天的總筆數與各動作筆數"""
+        with self._lock:
+            segment = self._sync(day)
+            return {'total': segment.count, **segment.counts}
+
+    def _iter_reverse(self, day, block_size=65536):
+        """從檔尾往前逐筆讀取某天的記錄 (最新的在前)"""
+        path = self.segment_path(day)
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            rest = b''
+            while position > 0:
+                read_size = min(block_size, position)
+                position -= read_size
+                f.seek(position)
+                chunk = f.read(read_size) + rest
+                lines = chunk.split(b'\n')
+                # 第一段可能是不完整的行，留到下一次 (檔頭時則是完整的第一行)
+                rest = lines.pop(0) if position > 0 else b''
+                for line in reversed(lines):
+                    if not line.strip():
+                        continue
+                    try:
+                        yield loads(line)
+                    except ValueError:
+                        continue  # 寫到一半的行
+
+    def tail(self, day, limit=None, block_size=65536):
+        """某天的記錄，最新的在前；limit 指定最多讀幾筆 (從檔尾往前讀)"""
+        activities = []
+        for activity in self._iter_reverse(day, block_size):
+            activities.append(activity)
+            if limit is not None and len(activities) >= limit:
+                break
+        return activities
+
+    def daily_counts(self, start=None, end=None):
+        """日期區間內每天的筆數 [{'date', 'total', 'add', ...}] (由新到舊)"""
+        days = self.days()
+        days = days[bisect_left(days, start) if start else 0:bisect_right(days, end) if end else None]
+        with self._lock:
+            stale = [day for day in days if day not in self._segments]
+            result = []
+            for day in reversed(days):
+                segment = self._sync(day)
+                result.append({'date': day, 'total': segment.count, **segment.counts})
+            if stale:
+                self._save_index()
+        return result
+
+    def query(self, start=None, end=None, action=None, book_id=None, limit=DEFAULT_LIMIT, cursor=None):
+        """
+        日期區間的歷史記錄 (最新在前，分頁): 回傳 {'activities', 'total', 'next_cursor', 'daily'}
+        以每天的統計跳過沒有符合記錄的日期；沒有指定 book_id 時 total 直接由統計加總，
+        指定 book_id 時只讀取有該書記錄的日期
+        """
+        if action is not None and action not in ACTIONS:
+            raise ValueError(f"Unknown action: {action}")
+        limit = max(1, min(int(limit), MAX_LIMIT))
+        after = decode_cursor(cursor) if cursor else None
+        daily = self.daily_counts(start, end)
+
+        def day_matches(day):
+            segment = self._segments.get(day)
+            if segment is None:
+                return True
+            if action is not None and not segment.counts[action]:
+                return False
+            return book_id is None or book_id in segment.book_ids
+
+        def before_cursor(day, activity):
+            return not after or (day, activity.get('id', 0)) < after
+
+        activities = []
+        next_cursor = None
+        total = 0
+        for counts in daily:
+            day = counts['date']
+            if book_id is None:
+                total += counts[action] if action else counts['total']
+                if next_cursor or (after and day > after[0]):
+                    continue
+            if not day_matches(day):
+                continue
+            for activity in self._iter_reverse(day):
+                if action is not None and activity.get('action') != action:
+                    continue
+                if book_id is not None:
+                    if book_id not in activity_book_ids(activity):
+                        continue
+                    total += 1  # 指定書籍時逐筆計數 (只讀有該書記錄的日期)
+                if next_cursor or not before_cursor(day, activity):
+                    continue
+                if len(activities) == limit:
+                    last = activities[-1]
+                    next_cursor = encode_cursor(last['date'], last['id'])
+                    if book_id is None:
+                        break
+                    continue
+                activities.append(activity)
+        return {
+            'activities': activities,
+            'total': total,
+            'next_cursor': next_cursor,
+            'daily': daily,
+        }
+
+    def clear(self, day):
+        """刪除某天的記錄"""
+        with self._lock, self._file_lock:
+            try:
+                os.remove(self.segment_path(day))
+            except FileNotFoundError:
+                pass
+            self._segments.pop(day, None)
+
+    def migrate(self, legacy_file):
+        """匯入舊版 activity_log.json (最新在前的 list)，完成後改名為 .bak"""
+        with self._lock, self._file_lock:
+            # 多個行程同時啟動時只有一個會匯入
+            if not os.path.exists(legacy_file):
+                return 0
+            with open(legacy_file, 'r', encoding='utf-8') as f:
+                activities = load(f)
+            count = 0
+            for activity in reversed(activities):
+                if not activity.get('date'):
+                    continue
+                self._append_locked({k: v for k, v in activity.items() if k != 'id'})
+                count += 1
+            os.replace(legacy_file, legacy_file + '.bak')
+        logger.info(f"Migrated {count} activities from {legacy_file}")
+        return count
+
@@ -0,0 +1,772 @@
+"""
+圖書館借書管理系統 - 非同步 (ASGI) 版本
+路由與回應格式同 server.py，以 Starlette 實作，使用 uvicorn 執行:
+    pip install -r requirements-asgi.txt
+    uvicorn asgi_server:app --host 0.0.0.0 --port 5001
+
+- 查詢直接讀取記憶體中的書籍快取，不等待任何 I/O；快取只在事件迴圈中修改，不需要讀寫鎖
+- 修改依序處理 (asyncio.Lock)，多個 worker 之間以 library.write.lock 檔案鎖互斥 (同 server.py)；寫入 journal (fsync)、重讀、匯入等阻塞的儲存操作在專用的
+  單一執行緒 (STORAGE_EXECUTOR) 依序執行，Excel / JSON / SQLite 寫檔不會卡住事件迴圈；
+  寫入儲存後端同 server.py 由寫入佇列在背景合併寫入
+- 其他行程 (或直接編輯 Excel) 修改的資料由背景工作每 LIBRARY_WATCH_INTERVAL 秒檢查並重讀
+- 匯出檔案、活動記錄查詢與大型回應的編碼/壓縮在執行緒池中處理
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime
+import asyncio
+import logging
+import os
+import threading
+import traceback
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import FileResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from starlette.staticfiles import StaticFiles
+
+from activity_log import (
+    DEFAULT_LIMIT as ACTIVITY_DEFAULT_LIMIT, ActivityJournal, activity_stats, build_activity,
+    build_batch_activity, parse_day
+)
+from backup import BackupScheduler
+from backup_store import BackupStore
+from book_cache import DEFAULT_LIMIT, BookCache, build_book
+from book_export import FORMATS as EXPORT_FORMATS, ExportCache
+from book_record import Book
+from events import EventBroker
+from excel_io import read_workbook_cached
+from http_cache import CODINGS, COMPRESSIBLE_TYPES, MIN_SIZE, PAYLOADS, collection_etag, compress_body
+from locks import FileLock
+from storage import create_storage
+from write_queue import WriteBehindQueue
+import json_backend
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler("server.log", encoding='utf-8'),
+        logging.StreamHandler()
+    ]
+)
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASE_DIR, 'static')
+EXCEL_FILE = os.path.join(BASE_DIR, '圖書館借書清單.xlsx')
+
+CATEGORIES = [
+    '新書-待借',
+    '待借',
+    '不能借',
+    '食譜',
+    '頁數太多',
+    '已看-3447本',
+    '已看-1',
+    '未到館'
+]
+
+EXPORTS = ExportCache(CATEGORIES)
+
+# 儲存後端: 'sqlite' (預設)、'excel' 或 'json' (同 server.py)
+STORAGE_BACKEND = os.environ.get('LIBRARY_STORAGE', 'sqlite')
+DB_FILE = os.path.join(BASE_DIR, 'library.db')
+JSON_FILE = os.path.join(BASE_DIR, 'data', 'books.json')
+BACKUP_DIR = os.path.join(BASE_DIR, 'backups')
+STORAGE = create_storage(STORAGE_BACKEND, EXCEL_FILE, CATEGORIES, db_file=DB_FILE, json_file=JSON_FILE)
+
+# 阻塞的儲存操作 (journal 寫入、重讀、匯入) 都在這個執行緒依序執行
+STORAGE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='library-storage')
+
+# 檢查其他行程是否修改了資料的間隔 (秒)
+WATCH_INTERVAL = float(os.environ.get('LIBRARY_WATCH_INTERVAL', 2))
+
+BACKUP_INTERVAL_MIN = float(os.environ.get('LIBRARY_BACKUP_INTERVAL_MIN', 10))
+BACKUP_MAX_CHANGES = int(os.environ.get('LIBRARY_BACKUP_MAX_CHANGES', 50))
+# store: 寫入備份庫 backups/store/ (只保存有變更的區塊)；file: 每次備份整份資料為 backups/備份_*.gz
+BACKUP_FORMAT = os.environ.get('LIBRARY_BACKUP_FORMAT', 'store')
+
+FLUSH_INTERVAL_MS = int(os.environ.get('LIBRARY_FLUSH_INTERVAL_MS', 500))
+FLUSH_MAX_OPS = int(os.environ.get('LIBRARY_FLUSH_MAX_OPS', 50))
+
+EVENTS = EventBroker(
+    max_buffer=int(os.environ.get('LIBRARY_SSE_BUFFER', 100)),
+    max_clients=int(os.environ.get('LIBRARY_SSE_MAX_CLIENTS', 50)),
+    heartbeat=float(os.environ.get('LIBRARY_SSE_HEARTBEAT', 15))
+)
+
+QUERY_PARAMS = ('category', 'q', 'sort', 'limit', 'cursor')
+ACTIVITY_QUERY_PARAMS = ('from', 'to', 'action', 'book_id', 'cursor')
+
+ACTIVITIES = ActivityJournal(os.path.join(BASE_DIR, 'activities'))
+try:
+    ACTIVITIES.migrate(os.path.join(BASE_DIR, 'activity_log.json'))
+except Exception as e:
+    logger.error(f"Error migrating activity log: {e}")
+
+CACHED_BOOKS = None
+LAST_TOKEN = None
+TOKEN_LOCK = threading.Lock()  # LAST_TOKEN 也會在寫入佇列的執行緒更新
+WRITE_LOCK = asyncio.Lock()    # 修改 (讀取-修改-寫入) 依序進行；查詢不需要
+WRITE_FILE_LOCK = FileLock(os.path.join(BASE_DIR, 'library.write.lock'))  # 多個 worker 之間互斥 (同 server.py)
+
+
+async def run_storage(func, *args):
+    """在儲存執行緒執行阻塞的操作 (依序執行)，等待期間事件迴圈繼續處理其他請求"""
+    return await asyncio.get_running_loop().run_in_executor(STORAGE_EXECUTOR, func, *args)
+
+
+def on_storage_flushed(before_token, after_token):
+    """寫入佇列寫入完成後同步版本 (同 server.py)，避免自己的寫入觸發重讀"""
+    global LAST_TOKEN
+    with TOKEN_LOCK:
+        if LAST_TOKEN == before_token:
+            LAST_TOKEN = after_token
+
+
+WRITE_QUEUE = WriteBehindQueue(
+    STORAGE,
+    BASE_DIR,
+    flush_interval=FLUSH_INTERVAL_MS / 1000,
+    max_pending=FLUSH_MAX_OPS,
+    on_flush=on_storage_flushed
+)
+
+BACKUPS = BackupScheduler(
+    STORAGE,
+    BACKUP_DIR,
+    interval=BACKUP_INTERVAL_MIN * 60,
+    max_changes=BACKUP_MAX_CHANGES,
+    hourly=int(os.environ.get('LIBRARY_BACKUP_KEEP_HOURLY', 24)),
+    daily=int(os.environ.get('LIBRARY_BACKUP_KEEP_DAILY', 30)),
+    weekly=int(os.environ.get('LIBRARY_BACKUP_KEEP_WEEKLY', 12)),
+    before_snapshot=WRITE_QUEUE.flush,
+    store=BackupStore(os.path.join(BACKUP_DIR, 'store')) if BACKUP_FORMAT == 'store' else None
+)
+
+
+# 回應 (ETag / 壓縮，同 http_cache 的 Flask 版本)
+
+def _choose_coding(request):
+    """Accept-Encoding 接受的壓縮編碼 (依 CODINGS 的優先順序)，都不接受時回傳 None"""
+    accepted = {}
+    for item in request.headers.get('accept-encoding', '').split(','):
+        name, _, params = item.partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for coding in CODINGS:
+        if accepted.get(coding, accepted.get('*', 0)) > 0:
+            return coding
+    return None
+
+
+def _matched_etag(request, etag):
+    """If-None-Match 中與 etag 相同版本的值 (含壓縮後綴)，沒有時回傳 None"""
+    header = request.headers.get('if-none-match')
+    if not header:
+        return None
+    tags = {tag.strip().removeprefix('W/').strip('"') for tag in header.split(',')}
+    for tag in (etag, *(f'{etag}-{coding}' for coding in CODINGS)):
+        if tag in tags or '*' in tags:
+            return tag
+    return None
+
+
+def encode_json(data):
+    """JSON 內容 (與 Flask jsonify 相同: 鍵排序、結尾換行)"""
+    if isinstance(data, list) and data and isinstance(data[0], Book):
+        data = [book.to_dict() for book in data]
+    return json_backend.dumpb(data, sort_keys=True) + b'\n'
+
+
+def respond(request, body, status=200, media_type='application/json', headers=None):
+    """組成回應；JSON/文字超過 MIN_SIZE 時依 Accept-Encoding 壓縮"""
+    headers = dict(headers or {})
+    if status == 200 and media_type in COMPRESSIBLE_TYPES:
+        headers['Vary'] = 'Accept-Encoding'
+        coding = _choose_coding(request) if len(body) >= MIN_SIZE else None
+        if coding is not None:
+            body = compress_body(body, coding)
+            headers['Content-Encoding'] = coding
+    return Response(body, status, headers, media_type)
+
+
+def json_response(request, data, status=200, headers=None):
+    return respond(request, encode_json(data), status, headers=headers)
+
+
+async def conditional(request, books, build):
+    """
+    帶 ETag 的回應 (同 http_cache.conditional_json)；客戶端已有相同版本時直接回傳 304
+    build() 為 coroutine function，回傳 Response，只有 200 時才加上 ETag
+    """
+    etag = collection_etag(books, f'{request.url.path}?{request.url.query}')
+    matched = _matched_etag(request, etag)
+    if matched:
+        response = Response(status_code=304, headers={'ETag': f'"{matched}"'})
+    else:
+        response = await build()
+        if response.status_code != 200:
+            return response
+        coding = response.headers.get('content-encoding')
+        response.headers['ETag'] = f'"{etag}-{coding}"' if coding else f'"{etag}"'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+async def cached_json(request, books, key, build):
+    """
+    JSON 回應，內容依 books 的版本快取 (同 http_cache.cached_json)
+    build() 回傳要輸出的資料 (在事件迴圈中呼叫)，編碼與壓縮在執行緒池中進行
+    """
+    bodies = PAYLOADS.bodies(books, key)
+    body = bodies.get('')
+    if body is None:
+        body = bodies.setdefault('', await asyncio.to_thread(encode_json, build()))
+    headers = {'Vary': 'Accept-Encoding'}
+    coding = _choose_coding(request) if len(body) >= MIN_SIZE else None
+    if coding is None:
+        return Response(body, headers=headers, media_type='application/json')
+    data = bodies.get(coding)
+    if data is None:
+        data = bodies.setdefault(coding, await asyncio.to_thread(compress_body, body, coding))
+    headers['Content-Encoding'] = coding
+    return Response(data, headers=headers, media_type='application/json')
+
+
+async def read_json(request):
+    """請求內容 (JSON)，沒有內容時回傳 {}；格式錯誤時拋出 ValueError"""
+    body = await request.body()
+    return (json_backend.loads(body) if body else None) or {}
+
+
+def no_store(response):
+    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+    return response
+
+
+# 快取與儲存
+
+def publish_book_change(op, book, books):
+    EVENTS.publish('book', {'op': op, 'book': book, 'version': books.version, 'epoch': books.instance})
+
+
+def publish_reload(books):
+    EVENTS.publish('reload', {'version': books.version, 'epoch': books.instance})
+
+
+def _load_books():
+    """
+    從儲存後端讀取並建立快取 (在儲存執行緒執行)，補上尚未寫入儲存後端的變更
+    回傳 (資料版本, 快取)；版本、資料與佇列在 flush 之間一起讀取
+    """
+    logger.info(f"Loading books from {STORAGE.name} storage...")
+    (token, loaded), pending = WRITE_QUEUE.load_with_pending(
+        lambda: (STORAGE.change_token(), STORAGE.load_books())
+    )
+    books = BookCache(loaded, id_source=STORAGE.allocate_id).apply(pending)
+    logger.info(f"Read {len(books)} books. Updated cache.")
+    return token, books
+
+
+async def reload_cache(force=False):
+    """
+    資料版本改變 (或 force) 時重讀快取；新的快取建立完成後才替換，
+    期間查詢繼續使用舊的快取，修改則等待重讀完成
+    """
+    async with WRITE_LOCK:
+        return await _reload_locked(force)
+
+
+async def _reload_locked(force=False):
+    """同 reload_cache (呼叫端須持有 WRITE_LOCK)"""
+    global CACHED_BOOKS, LAST_TOKEN
+    try:
+        token = await run_storage(STORAGE.change_token)
+        with TOKEN_LOCK:
+            if not force and CACHED_BOOKS is not None and token == LAST_TOKEN:
+                return CACHED_BOOKS
+        token, books = await run_storage(_load_books)
+        CACHED_BOOKS = books
+        with TOKEN_LOCK:
+            LAST_TOKEN = token
+        publish_reload(books)
+    except Exception as e:
+        logger.error(f"讀取書籍錯誤: {e}")
+        logger.error(traceback.format_exc())
+        if CACHED_BOOKS is None:
+            CACHED_BOOKS = BookCache(id_source=STORAGE.allocate_id)
+    return CACHED_BOOKS
+
+
+@asynccontextmanager
+async def write_file_lock():
+    """
+    持有跨行程的 WRITE_FILE_LOCK (呼叫端須持有 WRITE_LOCK)
+    等待其他 worker 釋放時在預設執行緒池中阻塞，不佔用儲存執行緒
+    """
+    acquired = asyncio.get_running_loop().run_in_executor(None, WRITE_FILE_LOCK.acquire)
+    try:
+        await asyncio.shield(acquired)
+    except asyncio.CancelledError:
+        # 請求被取消時，等取得後立即釋放
+        acquired.add_done_callback(lambda f: f.exception() is None and WRITE_FILE_LOCK.release())
+        raise
+    try:
+        yield
+    finally:
+        WRITE_FILE_LOCK.release()
+
+
+@asynccontextmanager
+async def books_for_write():
+    """
+    取得快取供修改 (讀取-修改-寫入期間獨佔，同 server.py)
+    依序取得行程內的 WRITE_LOCK 與跨行程的 WRITE_FILE_LOCK，再確認快取是最新的
+    (其他 worker 已寫入儲存後端的修改會先重讀)；新書 id 由儲存後端配發，各 worker 不會重複
+    """
+    async with WRITE_LOCK, write_file_lock():
+        yield await _reload_locked()
+
+
+async def watch_storage():
+    """背景工作: 其他行程修改了資料時重讀快取 (客戶端會收到 reload 事件)"""
+    while True:
+        await asyncio.sleep(WATCH_INTERVAL)
+        try:
+            token = await run_storage(STORAGE.change_token)
+            with TOKEN_LOCK:
+                changed = token != LAST_TOKEN
+            if changed:
+                await reload_cache()
+        except Exception as e:
+            logger.error(f"Storage watch error: {e}")
+
+
+async def persist_changes(changes):
+    """將一批 (op, book) 變更寫入 journal 並排入寫入佇列 (在儲存執行緒執行)"""
+    try:
+        await run_storage(WRITE_QUEUE.submit, changes)
+        BACKUPS.notify(len(changes))
+        return True
+    except Exception as e:
+        logger.error(f"寫入書籍錯誤: {e}")
+        logger.error(traceback.format_exc())
+        return False
+
+
+def _replace_all(books):
+    """整份取代 (在儲存執行緒執行): 先寫入佇列中的變更並備份，再取代"""
+    WRITE_QUEUE.flush()
+    BACKUPS.run_once(force=True)
+    _, token = STORAGE.replace_all(books)
+    return token, BookCache(books, id_source=STORAGE.allocate_id)
+
+
+async def save_all_books(books):
+    """以整份書單取代儲存後端的資料 (匯入用)"""
+    global CACHED_BOOKS, LAST_TOKEN
+    try:
+        async with WRITE_LOCK, write_file_lock():
+            token, cache = await run_storage(_replace_all, books)
+            CACHED_BOOKS = cache
+            with TOKEN_LOCK:
+                LAST_TOKEN = token
+            publish_reload(cache)
+        logger.info(f"Successfully saved {len(books)} books.")
+        return True
+    except Exception as e:
+        logger.error(f"寫入書籍錯誤: {e}")
+        logger.error(traceback.format_exc())
+        return False
+
+
+async def log_activity(activity):
+    """寫入活動記錄 (在儲存執行緒依序附加) 並推播"""
+    try:
+        activity = await run_storage(ACTIVITIES.append, activity)
+    except Exception as e:
+        logger.error(f"Error saving activity log: {e}")
+    logger.info(f"Activity logged: {activity['action']} - {activity.get('book_title') or 'Unknown'}")
+    EVENTS.publish('activity', activity)
+    return activity
+
+
+async def add_activity(action, book_data, old_data=None):
+    return await log_activity(build_activity(action, book_data, old_data))
+
+
+# API 路由
+
+async def serve_index(request):
+    return FileResponse(os.path.join(STATIC_DIR, 'index.html'))
+
+
+async def get_books(request):
+    """取得書籍 (同 server.py): 無查詢參數時回傳所有書籍，否則回傳分頁結果"""
+    books = CACHED_BOOKS
+    args = request.query_params
+
+    async def build():
+        if not any(param in args for param in QUERY_PARAMS):
+            return await cached_json(request, books, 'books', lambda: books.sorted('date_desc'))
+        try:
+            result = books.query(
+                category=args.get('category') or None,
+                q=args.get('q') or None,
+                sort=args.get('sort', 'date_desc'),
+                limit=args.get('limit', DEFAULT_LIMIT),
+                cursor=args.get('cursor') or None
+            )
+        except ValueError as e:
+            return json_response(request, {'error': str(e)}, 400)
+        return json_response(request, result)
+
+    return await conditional(request, books, build)
+
+
+async def search_books(request):
+    """全文搜尋 (書名/作者/備註)，依相關度排序"""
+    args = request.query_params
+    q = args.get('q', '').strip()
+    if not q:
+        return json_response(request, {'books': [], 'total': 0})
+    books = CACHED_BOOKS
+
+    async def build():
+        try:
+            result = books.search(q, limit=args.get('limit', 20), category=args.get('category') or None)
+        except ValueError as e:
+            return json_response(request, {'error': str(e)}, 400)
+        return json_response(request, result)
+
+    return await conditional(request, books, build)
+
+
+async def get_book_changes(request):
+    """增量同步: since=上次取得的 version，epoch=上次取得的 epoch"""
+    try:
+        since = int(request.query_params.get('since', 0))
+    except ValueError:
+        return json_response(request, {'error': 'Invalid since'}, 400)
+    return json_response(request, CACHED_BOOKS.changes_since(since, request.query_params.get('epoch')))
+
+
+async def add_book(request):
+    """新增書籍"""
+    try:
+        data = await read_json(request)
+    except ValueError:
+        return json_response(request, {'error': 'Invalid JSON'}, 400)
+    try:
+        new_book = build_book(None, data)
+    except ValueError as e:
+        return json_response(request, {'error': str(e)}, 400)
+    try:
+        logger.info(f"Adding new book: {new_book['title'] or 'Unknown'}")
+
+        async with books_for_write() as books:
+            new_id = new_book['id'] = await run_storage(books.next_id)
+
+            if not await persist_changes([('add', new_book)]):
+                logger.error("Failed to save book")
+                return json_response(request, {'error': '儲存失敗'}, 500)
+            books.add(new_book)
+            publish_book_change('add', new_book, books)
+
+        await add_activity('add', new_book)
+        logger.info(f"Book added successfully: ID {new_id}")
+        return json_response(request, new_book, 201)
+
+    except Exception as e:
+        logger.error(f"Error in add_book: {e}")
+        logger.error(traceback.format_exc())
+        return json_response(request, {'error': str(e)}, 500)
+
+
+async def update_book(request):
+    """更新書籍"""
+    book_id = request.path_params['book_id']
+    try:
+        data = await read_json(request)
+    except ValueError:
+        return json_response(request, {'error': 'Invalid JSON'}, 400)
+    async with books_for_write() as books:
+        if book_id not in books:
+            return json_response(request, {'error': '找不到書籍'}, 404)
+
+        old_book = books.get(book_id).copy()
+        try:
+            updated_book = build_book(book_id, data, base=old_book)
+        except ValueError as e:
+            return json_response(request, {'error': str(e)}, 400)
+
+        if not await persist_changes([('update', updated_book)]):
+            return json_response(request, {'error': '儲存失敗'}, 500)
+        books.update(updated_book)
+        publish_book_change('update', updated_book, books)
+
+    if old_book.get('category') != updated_book.get('category'):
+        await add_activity('category_change', updated_book, old_book)
+    else:
+        await add_activity('edit', updated_book, old_book)
+    return json_response(request, updated_book)
+
+
+async def batch_books(request):
+    """批次新增/修改/刪除 (同 server.py)：整批驗證通過後一次寫入，並記錄為一筆活動"""
+    try:
+        data = await read_json(request)
+    except ValueError:
+        return json_response(request, {'error': 'Invalid JSON'}, 400)
+    if not isinstance(data, dict):
+        return json_response(request, {'error': 'Request body must be an object'}, 400)
+    async with books_for_write() as books:
+        try:
+            changes, results, errors = await run_storage(books.plan_batch, data.get('operations'))
+        except ValueError as e:
+            return json_response(request, {'error': str(e)}, 400)
+        if errors:
+            return json_response(request, {'error': '批次操作有誤，未套用任何變更', 'errors': errors}, 400)
+
+        if changes and not await persist_changes(changes):
+            return json_response(request, {'error': '儲存失敗'}, 500)
+        for op, book in changes:
+            if op == 'add':
+                books.add(book)
+            elif op == 'update':
+                books.update(book)
+            else:
+                books.remove(book['id'])
+            publish_book_change(op, book, books)
+        version = books.version
+
+    if changes:
+        await log_activity(build_batch_activity(results))
+    return json_response(request, {
+        'success': True,
+        'version': version,
+        'results': [{k: v for k, v in r.items() if k != 'old'} for r in results]
+    })
+
+
+async def delete_book(request):
+    """刪除書籍"""
+    book_id = request.path_params['book_id']
+    async with books_for_write() as books:
+        if book_id not in books:
+            return json_response(request, {'success': True})
+
+        deleted_book = books.get(book_id).copy()
+
+        if not await persist_changes([('delete', deleted_book)]):
+            return json_response(request, {'error': '儲存失敗'}, 500)
+        books.remove(book_id)
+        publish_book_change('delete', deleted_book, books)
+
+    await add_activity('delete', deleted_book)
+    return json_response(request, {'success': True})
+
+
+async def stream_events(request):
+    """即時推播 (Server-Sent Events)；等待事件時不佔用執行緒"""
+    subscriber = EVENTS.subscribe()
+    if subscriber is None:
+        return json_response(request, {'error': '連線數已達上限'}, 503)
+    return StreamingResponse(
+        EVENTS.astream(subscriber),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+async def get_stats(request):
+    """取得統計資料 (總數/作者數/各分類數量)"""
+    books = CACHED_BOOKS
+
+    async def build():
+        return json_response(request, {
+            'total_books': len(books),
+            'total_authors': books.author_count(),
+            'category_stats': {cat: books.count(cat) for cat in CATEGORIES}
+        })
+
+    return await conditional(request, books, build)
+
+
+async def get_author_stats(request):
+    """作者統計 (分頁): sort=count|name, limit, offset"""
+    books = CACHED_BOOKS
+    args = request.query_params
+
+    async def build():
+        try:
+            result = books.authors(
+                sort=args.get('sort', 'count'),
+                limit=args.get('limit', DEFAULT_LIMIT),
+                offset=args.get('offset', 0)
+            )
+        except ValueError as e:
+            return json_response(request, {'error': str(e)}, 400)
+        return json_response(request, result)
+
+    return await conditional(request, books, build)
+
+
+async def export_books(request):
+    """匯出目前資料: format=xlsx (預設) / csv / jsonl；檔案在執行緒池中產生 (同一版本只產生一次)"""
+    fmt = request.query_params.get('format', 'xlsx')
+    if fmt not in EXPORT_FORMATS:
+        return json_response(request, {'error': f'Unknown format: {fmt}'}, 400)
+    books = CACHED_BOOKS.snapshot()  # 匯出期間的修改不影響這一版
+
+    async def build():
+        data = await asyncio.to_thread(EXPORTS.get, books, fmt)
+        filename = f'library_books_{datetime.now().strftime("%Y%m%d")}.{fmt}'
+        headers = {'Content-Disposition': f'attachment; filename={filename}'}
+        return await asyncio.to_thread(respond, request, data, 200, EXPORT_FORMATS[fmt], headers)
+
+    try:
+        return await conditional(request, books, build)
+    except Exception as e:
+        logger.error(f"Export error: {e}")
+        return json_response(request, {'error': str(e)}, 500)
+
+
+async def force_reload(request):
+    """強制重讀 (清除快取)"""
+    books = await reload_cache(force=True)
+    return json_response(request, {'message': 'Cache cleared', 'count': len(books)})
+
+
+async def import_books(request):
+    """從 Excel 重新匯入所有書籍 (會取代目前資料)"""
+    try:
+        if not os.path.exists(EXCEL_FILE):
+            return json_response(request, {'error': '找不到原始檔案'}, 404)
+
+        if STORAGE.name == 'excel':
+            # Excel 本身就是儲存，重讀即可
+            books = await reload_cache(force=True)
+        else:
+            books = await run_storage(read_workbook_cached, EXCEL_FILE, CATEGORIES)
+            if not await save_all_books(books):
+                return json_response(request, {'error': '匯入失敗'}, 500)
+
+        logger.info(f"Imported {len(books)} books from Excel")
+        return json_response(request, {'message': 'Imported', 'count': len(books)})
+    except Exception as e:
+        logger.error(f"Import error: {e}")
+        logger.error(traceback.format_exc())
+        return json_response(request, {'error': str(e)}, 500)
+
+
+def _today_activities(limit):
+    today = datetime.now().strftime('%Y-%m-%d')
+    counts = ACTIVITIES.counts(today)
+    logger.info(f"API: get_activities. Today: {today}. Found: {counts['total']}")
+    return {
+        'activities': ACTIVITIES.tail(today, limit=limit),
+        'stats': dict(activity_stats(counts), date=today)
+    }
+
+
+def _activity_history(args):
+    book_id = args.get('book_id')
+    result = ACTIVITIES.query(
+        start=parse_day(args.get('from')),
+        end=parse_day(args.get('to')),
+        action=args.get('action') or None,
+        book_id=int(book_id) if book_id else None,
+        limit=args.get('limit', ACTIVITY_DEFAULT_LIMIT),
+        cursor=args.get('cursor') or None
+    )
+    result['daily'] = [dict(activity_stats(c), date=c['date']) for c in result['daily']]
+    return result
+
+
+async def get_activities(request):
+    """
+    取得活動記錄 (在執行緒池中讀取記錄檔)
+    - 無查詢參數: 今日記錄與統計
+    - from / to / action / book_id / cursor: 歷史記錄分頁結果
+    """
+    args = request.query_params
+    try:
+        if any(param in args for param in ACTIVITY_QUERY_PARAMS):
+            result = await asyncio.to_thread(_activity_history, args)
+        else:
+            limit = int(args['limit']) if 'limit' in args else None
+            result = await asyncio.to_thread(_today_activities, limit)
+    except ValueError as e:
+        return json_response(request, {'error': str(e)}, 400)
+    return no_store(json_response(request, result))
+
+
+async def clear_activities(request):
+    """清除今日活動記錄"""
+    await run_storage(ACTIVITIES.clear, datetime.now().strftime('%Y-%m-%d'))
+    return json_response(request, {'success': True, 'message': '活動記錄已清除'})
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """啟動: 重播 journal、載入快取並啟動背景工作；結束: 寫入剩餘變更"""
+    await run_storage(WRITE_QUEUE.start)
+    BACKUPS.start()
+    await reload_cache()
+    watcher = asyncio.create_task(watch_storage())
+    try:
+        yield
+    finally:
+        watcher.cancel()
+        await run_storage(BACKUPS.stop)
+        await run_storage(WRITE_QUEUE.stop)
+        STORAGE_EXECUTOR.shutdown()
+
+
+app = Starlette(
+    routes=[
+        Route('/', serve_index),
+        Route('/api/books', get_books, methods=['GET']),
+        Route('/api/books', add_book, methods=['POST']),
+        Route('/api/search', search_books, methods=['GET']),
+        Route('/api/books/changes', get_book_changes, methods=['GET']),
+        Route('/api/books/batch', batch_books, methods=['POST']),
+        Route('/api/books/{book_id:int}', update_book, methods=['PUT']),
+        Route('/api/books/{book_id:int}', delete_book, methods=['DELETE']),
+        Route('/api/events', stream_events, methods=['GET']),
+        Route('/api/stats', get_stats, methods=['GET']),
+        Route('/api/stats/authors', get_author_stats, methods=['GET']),
+        Route('/api/export', export_books, methods=['GET']),
+        Route('/api/debug/reload', force_reload, methods=['POST']),
+        Route('/api/import', import_books, methods=['POST']),
+        Route('/api/activities', get_activities, methods=['GET']),
+        Route('/api/activities', clear_activities, methods=['DELETE']),
+        Mount('/', StaticFiles(directory=STATIC_DIR, check_dir=False)),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    lifespan=lifespan
+)
+
+if __name__ == '__main__':
+    import uvicorn
+
+    print("=" * 50)
+    print("📚 圖書館借書管理系統 - API 服務 (ASGI)")
+    print("=" * 50)
+    print(f"儲存後端: {STORAGE.name}")
+    print(f"API 網址: http://localhost:5001")
+    print("=" * 50)
+
+    uvicorn.run(app, host='0.0.0.0', port=int(os.environ.get('PORT', 5001)))
@@ -0,0 +1,219 @@
+"""
+背景備份排程
+取代每次寫入前同步複製整份 Excel: 由背景執行緒定期備份儲存後端的資料。
+- 觸發: 距離上次備份超過 interval 秒，或累積 max_changes 筆變更
+- 去重: 內容雜湊與最新一份備份相同時略過 (雜湊記在檔名中)
+- 壓縮: 備份以 gzip 保存 (備份_<時間>_<雜湊>.<xlsx|db>.gz)
+- 保留: 分層保留最近 hourly 個小時、daily 天、weekly 週各一份 (每個區間保留最新的一份)，
+  最新的備份一定保留；舊版的 備份_<時間>.xlsx 一併納入保留規則
+指定 store (BackupStore) 時改為寫入內容定址的備份庫，只保存有變更的書籍區塊，
+保留規則套用在備份庫的快照上。
+多個行程 (gunicorn worker) 共用備份目錄，以檔案鎖確保同一時間只有一個行程在備份。
+"""
+
+from datetime import datetime
+import gzip
+import logging
+import os
+import re
+import threading
+import time
+
+from locks import FileLock
+
+logger = logging.getLogger(__name__)
+
+DIGEST_LENGTH = 16  # 檔名中保留的雜湊長度
+TIMESTAMP_FORMAT = '%Y%m%d_%H%M%S'
+RETENTION_TIERS = (
+    ('hourly', '%Y%m%d%H'),
+    ('daily', '%Y%m%d'),
+    ('weekly', '%G%V'),  # ISO 週
+)
+
+_BACKUP_FILE_RE = re.compile(r'^備份_(\d{8}_\d{6})(?:_([0-9a-f]+))?\.(xlsx|db)(\.gz)?$')
+
+
+def list_backups(backup_dir):
+    """備份目錄中的備份 [(時間, 雜湊或 None, 檔名)]，由新到舊"""
+    try:
+        names = os.listdir(backup_dir)
+    except FileNotFoundError:
+        return []
+    backups = []
+    for name in names:
+        m = _BACKUP_FILE_RE.match(name)
+        if not m:
+            continue
+        try:
+            taken = datetime.strptime(m.group(1), TIMESTAMP_FORMAT)
+        except ValueError:
+            continue
+        backups.append((taken, m.group(2), name))
+    backups.sort(reverse=True)
+    return backups
+
+
+def select_retained(backups, hourly=24, daily=30, weekly=12):
+    """依分層保留規則選出要保留的檔名 (backups 由新到舊)"""
+    keep = set()
+    if backups:
+        keep.add(backups[0][2])
+    limits = {'hourly': hourly, 'daily': daily, 'weekly': weekly}
+    for tier, bucket_format in RETENTION_TIERS:
+        limit = limits[tier]
+        buckets = set()
+        for taken, _, name in backups:
+            if len(buckets) >= limit:
+                break
+            bucket = taken.strftime(bucket_format)
+            if bucket not in buckets:
+                buckets.add(bucket)
+                keep.add(name)  # 每個區間最新的一份
+    return keep
+
+
+class BackupScheduler:
+    """背景備份執行緒"""
+
+    def __init__(self, storage, backup_dir, interval=600, max_changes=50,
+                 hourly=24, daily=30, weekly=12, before_snapshot=None, store=None):
+        self.storage = storage
+        self.backup_dir = backup_dir
+        self.store = store
+        self.interval = interval
+        self.max_changes = max_changes
+        self.retention = {'hourly': hourly, 'daily': daily, 'weekly': weekly}
+        self.before_snapshot = before_snapshot  # 備份前呼叫 (例如先寫入佇列中的變更)
+        os.makedirs(backup_dir, exist_ok=True)
+        self._file_lock = FileLock(os.path.join(backup_dir, 'backup.lock'))
+        self._lock = threading.Lock()
+        self._changes = 0
+        self._last_run = time.monotonic()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='backup', daemon=True)
+        self._thread.start()
+
+    def notify(self, count=1):
+        """記錄有 count 筆變更，累積到 max_changes 時提早備份"""
+        with self._lock:
+            self._changes += count
+            due = self._changes >= self.max_changes
+        if due:
+            self._wakeup.set()
+
+    def _due(self):
+        with self._lock:
+            if self._changes >= self.max_changes:
+                return True
+            return self._changes > 0 and time.monotonic() - self._last_run >= self.interval
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(min(self.interval, 60))
+            self._wakeup.clear()
+            if self._stopped.is_set():
+                break
+            if self._due():
+                self.run_once()
+
+    def run_once(self, force=False):
+        """
+        備份一次，回傳新備份的路徑或快照 id (內容沒有變更或其他行程正在備份時回傳 None)
+        force=True 時不論是否有變更都檢查 (例如匯入前)
+        """
+        with self._lock:
+            if not force and not self._changes:
+                return None
+            changes = self._changes
+            self._changes = 0
+            self._last_run = time.monotonic()
+        if not self._file_lock.acquire(blocking=False):
+            return None  # 其他行程正在備份
+        try:
+            return self._backup_locked()
+        except Exception as e:
+            logger.error(f"Backup error: {e}")
+            with self._lock:
+                self._changes += changes  # 下次再試
+            return None
+        finally:
+            self._file_lock.release()
+
+    def _backup_locked(self):
+        if self.before_snapshot:
+            self.before_snapshot()
+        if self.store is not None:
+            return self._commit_to_store()
+        data, digest = self.storage.snapshot()
+        digest = digest[:DIGEST_LENGTH]
+        backups = list_backups(self.backup_dir)
+        if backups and backups[0][1] == digest:
+            logger.info("Backup skipped: content unchanged")
+            return None
+
+        timestamp = datetime.now().strftime(TIMESTAMP_FORMAT)
+        name = f'備份_{timestamp}_{digest}.{self.storage.snapshot_suffix}.gz'
+        path = os.path.join(self.backup_dir, name)
+        tmp_file = path + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(gzip.compress(data, compresslevel=6))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, path)
+        logger.info(f"Backup created: {name} ({len(data)} bytes)")
+        self._prune_locked()
+        return path
+
+    def _commit_to_store(self):
+        # current_books 不重讀儲存後端 (例如不丟棄 Excel 已載入的活頁簿)
+        snapshot_id = self.store.commit(self.storage.current_books(), source=self.storage.name)
+        if snapshot_id is None:
+            logger.info("Backup skipped: content unchanged")
+            return None
+        self._prune_store()
+        return snapshot_id
+
+    def _prune_store(self):
+        snapshots = [(taken, None, snapshot_id) for taken, snapshot_id in reversed(self.store.snapshots())]
+        keep = select_retained(snapshots, **self.retention)
+        removed = [snapshot_id for _, _, snapshot_id in snapshots if snapshot_id not in keep]
+        if removed:
+            self.store.forget(removed)
+            self.store.gc()
+        return removed
+
+    def prune(self):
+        """依保留規則刪除舊備份"""
+        with self._file_lock:
+            if self.store is not None:
+                return self._prune_store()
+            return self._prune_locked()
+
+    def _prune_locked(self):
+        backups = list_backups(self.backup_dir)
+        keep = select_retained(backups, **self.retention)
+        removed = []
+        for _, _, name in backups:
+            if name in keep:
+                continue
+            try:
+                os.remove(os.path.join(self.backup_dir, name))
+                removed.append(name)
+            except OSError as e:
+                logger.error(f"Error removing backup {name}: {e}")
+        if removed:
+            logger.info(f"Removed {len(removed)} old backup(s)")
+        return removed
+
+    def stop(self):
+        """停止背景執行緒；還有未備份的變更時最後備份一次"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        self.run_once()
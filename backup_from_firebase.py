@@ -3,8 +3,14 @@ import firebase_admin
 from firebase_admin import credentials, firestore
 import pandas as pd
 import os
+import sys
+import json
 import datetime
 
+from backup_store import BackupStore
+
+CLOUD_STORE_DIR = os.path.join('backups', 'cloud')
+
 # 1. 初始化 Firebase
 key_path = 'key.json' 
 if not os.path.exists(key_path):
@@ -37,8 +43,18 @@ books_ref = db.collection('books')
 docs = books_ref.stream()
 
 data = []
+records = []
 for doc in docs:
     book = doc.to_dict()
+    records.append({
+        'id': book.get('id', ''),
+        'title': book.get('title', ''),
+        'author': book.get('author', ''),
+        'category': book.get('category', '未分類'),
+        'date': book.get('date', ''),
+        'note': book.get('note', ''),
+        'created_at': str(book.get('created_at', '')),
+    })
     # 確保欄位齊全
     data.append({
         '系統ID': book.get('id', ''),
@@ -52,7 +68,18 @@ for doc in docs:
 
 print(f"✅ 共下載 {len(data)} 筆資料")
 
-# 3. 轉存 Excel
+# 3. 存入雲端備份庫 (只保存有變更的書籍區塊)
+#    還原: python backup_store.py --store backups/cloud restore --at "2026-01-30 18:00"
+snapshot_id = BackupStore(CLOUD_STORE_DIR).commit(records, source='firebase')
+if snapshot_id:
+    print(f"💾 已存入備份庫：{snapshot_id}")
+else:
+    print("💾 雲端資料與上次備份相同，備份庫不需更新")
+
+# 4. 加上 --excel 時另外轉存完整的 Excel
+if '--excel' not in sys.argv:
+    sys.exit(0)
+
 timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
 output_file = f'雲端備份_{timestamp}.xlsx'
 
@@ -0,0 +1,323 @@
+"""
+內容定址的備份庫 (只保存有變更的書籍資料)
+每次備份把書單依 id 排序後切成區塊 (chunk)，區塊以內容的 SHA-256 命名存放，
+相同內容只存一份；快照 (snapshot) 只記錄區塊雜湊清單。
+區塊邊界由書籍 id 決定 (不受內容影響)，修改一本書只會產生一個新區塊，
+因此每次備份通常只新增數 KB。
+
+目錄結構:
+    <root>/objects/ab/cdef...    gzip 壓縮的區塊 (每行一筆書籍 JSON)
+    <root>/snapshots/<時間>.json 快照: 時間、來源、筆數、區塊雜湊清單
+
+還原時取指定時間 (含) 之前最新的快照，一次讀出所有區塊即得到當時的書單。
+
+用法:
+    python backup_store.py list
+    python backup_store.py restore [--at "2026-01-30 18:00"] [--output 還原.xlsx|.json|.db]
+    python backup_store.py ingest backups/備份_*.xlsx     (匯入舊的完整備份檔)
+    python backup_store.py gc
+"""
+
+from datetime import datetime, timedelta
+import argparse
+import gzip
+import hashlib
+import logging
+import os
+import re
+import sys
+import tempfile
+import zlib
+
+from json_backend import dump, dumpb, dumps, load, loads
+from locks import FileLock
+
+logger = logging.getLogger(__name__)
+
+CHUNK_TARGET = 64     # 平均每個區塊的書籍數
+CHUNK_MAX = 256       # 區塊上限 (連續多筆都不是邊界時強制切開)
+SNAPSHOT_FORMAT = '%Y%m%d_%H%M%S_%f'
+
+DEFAULT_STORE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backups', 'store')
+CATEGORIES = [
+    '新書-待借', '待借', '不能借', '食譜', '頁數太多',
+    '已看-3447本', '已看-1', '未到館'
+]
+
+_LEGACY_FILE_RE = re.compile(r'備份_(\d{8}_\d{6})')
+
+
+def _id_key(book):
+    """排序用: 數字 id 在前，其他 (例如雲端的字串 id) 依字串排序"""
+    book_id = book.get('id')
+    if isinstance(book_id, int):
+        return (0, book_id, '')
+    return (1, 0, str(book_id))
+
+
+def _is_boundary(book):
+    return zlib.crc32(str(book.get('id')).encode('utf-8')) % CHUNK_TARGET == 0
+
+
+def split_chunks(books):
+    """依 id 排序並切成區塊，回傳每個區塊的內容 (bytes，每行一筆 JSON)"""
+    chunks = []
+    lines = []
+    for book in sorted(books, key=_id_key):
+        lines.append(dumps(book, sort_keys=True, default=str))
+        if _is_boundary(book) or len(lines) >= CHUNK_MAX:
+            chunks.append(('\n'.join(lines) + '\n').encode('utf-8'))
+            lines = []
+    if lines:
+        chunks.append(('\n'.join(lines) + '\n').encode('utf-8'))
+    return chunks
+
+
+class BackupStore:
+    """內容定址的備份庫"""
+
+    def __init__(self, root=DEFAULT_STORE_DIR):
+        self.root = root
+        self.objects_dir = os.path.join(root, 'objects')
+        self.snapshots_dir = os.path.join(root, 'snapshots')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.snapshots_dir, exist_ok=True)
+        self._file_lock = FileLock(os.path.join(root, 'store.lock'))
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest[2:])
+
+    def _snapshot_path(self, snapshot_id):
+        return os.path.join(self.snapshots_dir, f'{snapshot_id}.json')
+
+    @staticmethod
+    def _write_file(path, data):
+        """先寫暫存檔再改名，中斷時不會留下寫到一半的檔案"""
+        tmp_file = path + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, path)
+
+    def snapshots(self):
+        """所有快照 [(時間, 快照 id)]，由舊到新"""
+        result = []
+        for name in os.listdir(self.snapshots_dir):
+            if not name.endswith('.json'):
+                continue
+            snapshot_id = name[:-len('.json')]
+            try:
+                result.append((datetime.strptime(snapshot_id, SNAPSHOT_FORMAT), snapshot_id))
+            except ValueError:
+                continue
+        result.sort()
+        return result
+
+    def read_snapshot(self, snapshot_id):
+        with open(self._snapshot_path(snapshot_id), 'r', encoding='utf-8') as f:
+            return load(f)
+
+    def commit(self, books, source=None, when=None):
+        """
+        新增一個快照，只寫入備份庫中還沒有的區塊
+        內容與最新的快照相同時不新增，回傳 None；否則回傳快照 id
+        """
+        when = when or datetime.now()
+        chunks = split_chunks(books)
+        digests = [hashlib.sha256(chunk).hexdigest() for chunk in chunks]
+        with self._file_lock:
+            existing = self.snapshots()
+            previous = [s for t, s in existing if t <= when]
+            if previous and self.read_snapshot(previous[-1])['chunks'] == digests:
+                return None
+
+            written = 0
+            for digest, chunk in zip(digests, chunks):
+                path = self._object_path(digest)
+                if os.path.exists(path):
+                    continue
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                data = gzip.compress(chunk, compresslevel=9, mtime=0)
+                self._write_file(path, data)
+                written += len(data)
+
+            taken = {s for _, s in existing}
+            while when.strftime(SNAPSHOT_FORMAT) in taken:
+                when += timedelta(microseconds=1)
+            snapshot_id = when.strftime(SNAPSHOT_FORMAT)
+            manifest = {
+                'time': when.isoformat(timespec='seconds'),
+                'source': source,
+                'count': len(books),
+                'chunks': digests,
+            }
+            self._write_file(
+                self._snapshot_path(snapshot_id),
+                dumpb(manifest)
+            )
+        logger.info(f"Backup snapshot {snapshot_id}: {len(books)} books, {written} new bytes")
+        return snapshot_id
+
+    def load(self, snapshot_id):
+        """讀出快照當時的書單 (依 id 排序)"""
+        books = []
+        for digest in self.read_snapshot(snapshot_id)['chunks']:
+            with open(self._object_path(digest), 'rb') as f:
+                chunk = gzip.decompress(f.read())
+            books.extend(loads(line) for line in chunk.splitlines())
+        return books
+
+    def find(self, at=None):
+        """指定時間 (含) 之前最新的快照 id，沒有時回傳 None；at 為 None 表示最新"""
+        candidates = [s for t, s in self.snapshots() if at is None or t <= at]
+        return candidates[-1] if candidates else None
+
+    def restore(self, at=None):
+        """回傳 (快照 id, 書單)；指定時間之前沒有快照時拋出 LookupError"""
+        snapshot_id = self.find(at)
+        if snapshot_id is None:
+            raise LookupError(f"No backup snapshot at or before {at}")
+        return snapshot_id, self.load(snapshot_id)
+
+    def forget(self, snapshot_ids):
+        """刪除快照 (區塊留待 gc 清除)"""
+        with self._file_lock:
+            for snapshot_id in snapshot_ids:
+                try:
+                    os.remove(self._snapshot_path(snapshot_id))
+                except FileNotFoundError:
+                    pass
+
+    def gc(self):
+        """刪除沒有任何快照使用的區塊，回傳刪除的數量"""
+        with self._file_lock:
+            referenced = set()
+            for _, snapshot_id in self.snapshots():
+                referenced.update(self.read_snapshot(snapshot_id)['chunks'])
+            removed = 0
+            for prefix in os.listdir(self.objects_dir):
+                prefix_dir = os.path.join(self.objects_dir, prefix)
+                if not os.path.isdir(prefix_dir):
+                    continue
+                for name in os.listdir(prefix_dir):
+                    if prefix + name not in referenced:
+                        os.remove(os.path.join(prefix_dir, name))
+                        removed += 1
+        if removed:
+            logger.info(f"Removed {removed} unused backup chunk(s)")
+        return removed
+
+    def size(self):
+        """備份庫佔用的位元組數"""
+        total = 0
+        for directory, _, names in os.walk(self.root):
+            total += sum(os.path.getsize(os.path.join(directory, name)) for name in names)
+        return total
+
+
+def read_backup_file(path, categories=CATEGORIES):
+    """讀取舊的完整備份檔 (備份_*.xlsx / .db，可為 .gz)"""
+    from excel_io import read_workbook
+    from storage import SQLiteStorage
+
+    suffix = path[:-3] if path.endswith('.gz') else path
+    kind = os.path.splitext(suffix)[1]
+    if kind not in ('.xlsx', '.db'):
+        raise ValueError(f"Unsupported backup file: {path}")
+    if not path.endswith('.gz'):
+        if kind == '.xlsx':
+            return read_workbook(path, categories)
+        storage = SQLiteStorage(path)
+        try:
+            return storage.load_books()
+        finally:
+            storage.close()
+
+    with open(path, 'rb') as f:
+        data = gzip.decompress(f.read())
+    fd, tmp_file = tempfile.mkstemp(suffix=kind)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return read_backup_file(tmp_file, categories)
+    finally:
+        os.remove(tmp_file)
+
+
+def write_restored(path, books, categories=CATEGORIES):
+    """將還原的書單寫成 .xlsx / .json / .db"""
+    kind = os.path.splitext(path)[1]
+    if kind == '.xlsx':
+        from excel_io import write_workbook
+        extra = sorted({b.get('category') for b in books if b.get('category')} - set(categories))
+        write_workbook(path, books, list(categories) + extra)
+    elif kind == '.json':
+        with open(path, 'w', encoding='utf-8') as f:
+            dump(books, f)
+    elif kind == '.db':
+        from storage import SQLiteStorage
+        storage = SQLiteStorage(path)
+        try:
+            storage.replace_all(books)
+        finally:
+            storage.close()
+    else:
+        raise ValueError(f"Unsupported output format: {path}")
+
+
+def _parse_time(value):
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d', '%Y%m%d_%H%M%S'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError(f"無法解析時間: {value}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='書籍備份庫')
+    parser.add_argument('--store', default=DEFAULT_STORE_DIR, help='備份庫目錄')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help='列出所有快照')
+    restore = commands.add_parser('restore', help='還原指定時間的書單')
+    restore.add_argument('--at', type=_parse_time, help='時間 (預設為最新)，例如 "2026-01-30 18:00"')
+    restore.add_argument('--output', default='還原.xlsx', help='輸出檔案 (.xlsx / .json / .db)')
+    ingest = commands.add_parser('ingest', help='匯入舊的完整備份檔')
+    ingest.add_argument('files', nargs='+')
+    commands.add_parser('gc', help='清除沒有使用的區塊')
+    args = parser.parse_args(argv)
+
+    store = BackupStore(args.store)
+    if args.command == 'list':
+        for taken, snapshot_id in store.snapshots():
+            manifest = store.read_snapshot(snapshot_id)
+            print(f"{taken:%Y-%m-%d %H:%M:%S}  {manifest['count']:>6} 本  {manifest.get('source') or ''}")
+        print(f"備份庫大小: {store.size() / 1024:.1f} KB")
+    elif args.command == 'restore':
+        try:
+            snapshot_id, books = store.restore(args.at)
+        except LookupError:
+            print("❌ 指定時間之前沒有備份")
+            return 1
+        write_restored(args.output, books)
+        print(f"✅ 已還原 {snapshot_id} 的 {len(books)} 本書到 {args.output}")
+    elif args.command == 'ingest':
+        # 依時間順序匯入，快照時間取自檔名 (沒有時用檔案修改時間)
+        def file_time(path):
+            m = _LEGACY_FILE_RE.search(os.path.basename(path))
+            if m:
+                return datetime.strptime(m.group(1), '%Y%m%d_%H%M%S')
+            return datetime.fromtimestamp(os.path.getmtime(path))
+
+        for path in sorted(args.files, key=file_time):
+            books = read_backup_file(path)
+            snapshot_id = store.commit(books, source=os.path.basename(path), when=file_time(path))
+            print(f"{os.path.basename(path)}: {snapshot_id or '內容相同，略過'}")
+    elif args.command == 'gc':
+        print(f"已刪除 {store.gc()} 個區塊")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+"""
+Excel 讀取速度比較
+- pandas: 舊的讀取方式 (pd.ExcelFile + read_excel + to_dict('records'))
+- openpyxl: read-only 串流讀取 (excel_io.read_workbook)
+- calamine: 有安裝 python-calamine 時一併比較
+
+用法: python benchmark_excel_read.py [Excel 檔案] [重複次數]
+"""
+
+import sys
+import time
+
+import pandas as pd
+
+from excel_io import CalamineWorkbook, _column_map, parse_row, read_workbook
+
+EXCEL_FILE = '圖書館借書清單.xlsx'
+CATEGORIES = [
+    '新書-待借', '待借', '不能借', '食譜', '頁數太多',
+    '已看-3447本', '已看-1', '未到館'
+]
+
+
+def read_workbook_pandas(path, categories):
+    """舊的讀取方式 (經過 DataFrame)"""
+    books = []
+    xls = pd.ExcelFile(path)
+    book_id = 0
+
+    for sheet_name in xls.sheet_names:
+        if sheet_name not in categories:
+            continue
+
+        df = pd.read_excel(xls, sheet_name=sheet_name)
+        col_map = _column_map(df.columns.tolist())
+        if not col_map['title']:
+            continue
+
+        for row in df.to_dict('records'):
+            book = parse_row(
+                sheet_name,
+                row.get(col_map['title']),
+                row.get(col_map['author']),
+                row.get(col_map['date']),
+                row.get(col_map['note'])
+            )
+            if book is None:
+                continue
+            books.append({'id': book_id, **book})
+            book_id += 1
+
+    return books
+
+
+def bench(name, func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        books = func()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    print(f"{name:<10} best={best:.4f}s avg={sum(times) / len(times):.4f}s books={len(books)}")
+    return books, best
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else EXCEL_FILE
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    readers = [
+        ('pandas', lambda: read_workbook_pandas(path, CATEGORIES)),
+        ('openpyxl', lambda: read_workbook(path, CATEGORIES, engine='openpyxl')),
+    ]
+    if CalamineWorkbook is not None:
+        readers.append(('calamine', lambda: read_workbook(path, CATEGORIES, engine='calamine')))
+    else:
+        print("python-calamine 未安裝，略過 calamine")
+
+    results = {name: bench(name, func, repeat) for name, func in readers}
+
+    baseline_books, baseline = results['pandas']
+    print()
+    for name, (books, best) in results.items():
+        same = '相同' if books == baseline_books else '不同'
+        print(f"{name:<10} {baseline / best:5.1f}x (結果與 pandas {same})")
+
+
+if __name__ == "__main__":
+    main()
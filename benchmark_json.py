@@ -0,0 +1,66 @@
+"""
+JSON 編碼/解碼速度比較 (整份書單)
+- json: 標準函式庫 (舊的 jsonify / json.dump 方式)
+- orjson: 有安裝 orjson 時一併比較 (json_backend 使用的方式)
+- API 回應: Flask jsonify 與 BookJSONProvider (快取中的 Book 記錄)
+
+用法: python benchmark_json.py [資料檔] [重複次數]
+"""
+
+import json
+import sys
+import time
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+from book_cache import BookCache
+from http_cache import BookJSONProvider
+import json_backend
+
+DATA_FILE = 'data/books.json'
+
+
+def bench(name, func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    print(f"{name:<28} best={best * 1000:8.2f}ms avg={sum(times) / len(times) * 1000:8.2f}ms")
+    return best
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else DATA_FILE
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    books = json.loads(text)
+    data = text.encode('utf-8')
+    print(f"{len(books)} 本書，JSON 後端: {json_backend.BACKEND}\n")
+
+    print("編碼")
+    bench('json.dumps (indent=2)', lambda: json.dumps(books, ensure_ascii=False, indent=2), repeat)
+    bench('json.dumps (compact)', lambda: json.dumps(books, ensure_ascii=False, separators=(',', ':')), repeat)
+    if json_backend.orjson is not None:
+        bench('orjson.dumps', lambda: json_backend.orjson.dumps(books), repeat)
+
+    print("\n解碼")
+    bench('json.loads', lambda: json.loads(data), repeat)
+    if json_backend.orjson is not None:
+        bench('orjson.loads', lambda: json_backend.orjson.loads(data), repeat)
+
+    print("\nAPI 回應 (GET /api/books 全部書籍)")
+    app = Flask(__name__)
+    default_provider = DefaultJSONProvider(app)
+    book_provider = BookJSONProvider(app)
+    records = BookCache(books).all()
+    with app.app_context():
+        bench('jsonify (dict, 標準函式庫)', lambda: default_provider.response(books), repeat)
+        bench('BookJSONProvider (Book)', lambda: book_provider.response(records), repeat)
+
+
+if __name__ == "__main__":
+    main()
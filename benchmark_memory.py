@@ -0,0 +1,80 @@
+"""
+書籍快取記憶體用量比較
+- dict: 舊的表示方式 (每本書一個 6 個鍵的 dict，JSON 載入後每個字串各自一份)
+- Book: 精簡記錄 (book_record.Book: __slots__ + 分類代碼 + 共用字串)
+並比較整份書單的 JSON 編碼時間 (json.dumps vs dumps_books)。
+
+以 data/books.json 的書籍為樣本複製成指定數量 (書名加上編號，作者/分類/日期沿用)。
+
+用法: python benchmark_memory.py [資料檔] [數量...]   (預設 5000 50000 500000)
+"""
+
+import gc
+import json
+import sys
+import time
+import tracemalloc
+
+from book_record import Book, dumps_books
+
+DATA_FILE = 'data/books.json'
+SIZES = [5000, 50000, 500000]
+
+
+def make_raw(sample, count):
+    """產生 count 本書的 JSON (經過 json.loads，與從檔案載入時相同，重複的字串各自一份)"""
+    books = []
+    for i in range(count):
+        book = dict(sample[i % len(sample)])
+        book['id'] = i
+        if i >= len(sample):
+            book['title'] = f"{book['title']} ({i // len(sample)})"
+        books.append(book)
+    return json.dumps(books, ensure_ascii=False)
+
+
+def measure(build):
+    """build() 產生的物件佔用的記憶體 (bytes)"""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def best_time(func, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def compare(count, payload):
+    """量測並印出一列結果 (函式結束後釋放兩份資料，不影響下一種數量的量測)"""
+    dicts, dict_size = measure(lambda: json.loads(payload))
+    records, record_size = measure(lambda: [Book.from_dict(b) for b in json.loads(payload)])
+
+    dict_time = best_time(lambda: json.dumps(dicts, sort_keys=True, separators=(',', ':')))
+    record_time = best_time(lambda: dumps_books(records))
+    print(
+        f"{count:>8} {dict_size / 1048576:>8.1f}MB {record_size / 1048576:>8.1f}MB "
+        f"{1 - record_size / dict_size:>5.0%} {dict_time:>10.3f}s {record_time:>11.3f}s"
+    )
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else DATA_FILE
+    sizes = [int(n) for n in sys.argv[2:]] or SIZES
+    with open(path, 'r', encoding='utf-8') as f:
+        sample = json.load(f)
+
+    print(f"{'書籍數':>8} {'dict':>10} {'Book':>10} {'節省':>6} {'json.dumps':>11} {'dumps_books':>12}")
+    for count in sizes:
+        compare(count, make_raw(sample, count))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,484 @@
+"""
+書籍快取
+以 id 為鍵的字典 + 各分類的 id 集合，取得/新增/修改/刪除皆為 O(1)；
+新書 id 由遞增計數器配發，不必每次掃描全部書籍找最大值。
+查詢 (分類/搜尋/排序/分頁) 使用各排序方式的已排序索引，第一次使用時建立、之後隨變更增量維護。
+作者/書名的筆畫排序鍵在載入時計算並快取，書籍修改時重新計算。
+關鍵字搜尋使用全文索引 (search_index.py)，同樣在第一次搜尋時建立、之後增量維護。
+統計 (各分類/各作者書籍數) 隨新增/修改/刪除增量更新，不必每次掃描全部書籍。
+每次變更記錄在有上限的變更紀錄 (version, id)，客戶端可只取得某版本之後的變更 (changes_since)。
+書籍以精簡的 Book 記錄保存 (book_record.py)；取得的記錄為唯讀，需要修改時用 copy() 取得 dict。
+"""
+
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+import base64
+import json
+import uuid
+
+from book_record import Book
+from collation import sort_key
+from search_index import SearchIndex
+
+DEFAULT_AUTHOR = '未分類作者'
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+AUTHOR_SORTS = ('count', 'name')
+CHANGE_LOG_SIZE = 10000
+MAX_BATCH_OPS = 500
+BOOK_FIELDS = ('title', 'author', 'category', 'date', 'note')
+NEW_BOOK = {'title': '', 'author': DEFAULT_AUTHOR, 'category': '新書-待借', 'date': '', 'note': ''}
+
+
+def _field_text(field, value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    raise ValueError(f"Invalid {field}: expected a string")
+
+
+def build_book(book_id, data, base=None, default_category=None):
+    """
+    由請求資料產生要寫入的書籍 (dict)，在寫入儲存前驗證
+    沒有提供 (或為 null) 的欄位沿用 base (修改時的舊資料) 或新書預設值；
+    數字轉為字串，其他型別拋出 ValueError
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Book data must be an object")
+    if base is None:
+        base = dict(NEW_BOOK, category=default_category or NEW_BOOK['category'])
+    book = {'id': book_id}
+    for field in BOOK_FIELDS:
+        value = data.get(field)
+        book[field] = base.get(field, '') if value is None else _field_text(field, value)
+    return book
+
+
+def _desc(text):
+    """字串遞減排序用的鍵"""
+    return tuple(-ord(c) for c in text) + (1,)
+
+
+# 排序鍵 (book, 筆畫鍵) -> tuple，筆畫鍵為 (作者鍵, 書名鍵)
+# 最後一項都是 -id，確保每本書的鍵唯一 (同分時新書在前)
+SORT_KEYS = {
+    'added': lambda b, k: (-b['id'],),
+    'date_desc': lambda b, k: (not b.get('date'), _desc(b.get('date') or ''), -b['id']),
+    'date_asc': lambda b, k: (not b.get('date'), b.get('date') or '', -b['id']),
+    'author': lambda b, k: (b.get('author') == DEFAULT_AUTHOR, k[0], k[1], -b['id']),
+    'title': lambda b, k: (k[1], -b['id']),
+}
+
+
+def _to_tuple(value):
+    if isinstance(value, list):
+        return tuple(_to_tuple(v) for v in value)
+    return value
+
+
+def encode_cursor(key):
+    """將排序鍵編碼為分頁游標"""
+    raw = json.dumps(key, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """解析分頁游標，格式錯誤時拋出 ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        key = _to_tuple(json.loads(raw.decode('utf-8')))
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    if not isinstance(key, tuple):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return key
+
+
+def _matches(book, needle):
+    """書名/作者/備註包含關鍵字 (不分大小寫)"""
+    return (
+        needle in (book.get('title') or '').lower()
+        or needle in (book.get('author') or '').lower()
+        or needle in (book.get('note') or '').lower()
+    )
+
+
+class SortedIndex:
+    """依某種排序方式排好的鍵 (全部 + 各分類)，以二分搜尋增量維護"""
+
+    def __init__(self, key_func, books):
+        self.key_func = key_func
+        self.all = []
+        self.by_category = {}
+        for book in books:
+            key = key_func(book)
+            self.all.append(key)
+            self.by_category.setdefault(book.get('category'), []).append(key)
+        self.all.sort()
+        for keys in self.by_category.values():
+            keys.sort()
+
+    def keys(self, category=None):
+        if category is None:
+            return self.all
+        return self.by_category.get(category, [])
+
+    def insert(self, key, category):
+        insort(self.all, key)
+        insort(self.by_category.setdefault(category, []), key)
+
+    def remove(self, book):
+        key = self.key_func(book)
+        for keys in (self.all, self.by_category.get(book.get('category'), [])):
+            i = bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                del keys[i]
+
+
+class BookSnapshot(list):
+    """某一版本的書籍列表 (Book 記錄唯讀，與快取共用)，附 instance / version 供匯出快取比對"""
+
+    def __init__(self, books):
+        super().__init__(books.all())
+        self.instance = books.instance
+        self.version = books.version
+
+
+class BookCache:
+    """書籍快取 (id 索引 + 分類索引)"""
+
+    def __init__(self, books=(), id_source=None):
+        self._books = {}        # id -> Book (保留插入順序)
+        self._id_source = id_source  # 配發新書 id 的函式 (最小 id) -> id，例如 storage.allocate_id
+        self._by_category = {}  # category -> set(id)
+        self._next_id = 0
+        self._indexes = {}      # sort -> SortedIndex (第一次查詢時建立)
+        self._stroke_keys = {}  # id -> (作者筆畫鍵, 書名筆畫鍵)
+        self._search = None     # SearchIndex (第一次搜尋時建立)
+        self._by_author = {}    # author -> set(id) (不含未分類作者)
+        self._author_order = {}  # sort -> (version, 排序好的作者)
+        self.version = 0        # 每次變更遞增
+        self.instance = uuid.uuid4().hex[:12]  # 快取實例 id (與 version 組成 ETag / 同步用 epoch)
+        self._change_log = deque()  # (version, id)，最多 CHANGE_LOG_SIZE 筆
+        self._log_floor = 0         # 早於此版本的變更已被捨棄
+        for book in books:
+            self._insert(book)
+
+    def __len__(self):
+        return len(self._books)
+
+    def __iter__(self):
+        return iter(self._books.values())
+
+    def __contains__(self, book_id):
+        return book_id in self._books
+
+    def all(self):
+        """所有書籍 (list)"""
+        return list(self._books.values())
+
+    def snapshot(self):
+        """目前版本的所有書籍 (BookSnapshot)，可交給其他執行緒處理，之後的修改不影響"""
+        return BookSnapshot(self)
+
+    def get(self, book_id):
+        return self._books.get(book_id)
+
+    def category_ids(self, category):
+        """某分類的所有書籍 id"""
+        return self._by_category.get(category, set())
+
+    def count(self, category):
+        return len(self._by_category.get(category, ()))
+
+    def author_count(self):
+        """作者數 (不含未分類作者)"""
+        return len(self._by_author)
+
+    def next_id(self):
+        """
+        配發新書 id (單調遞增)
+        有 id_source 時由儲存後端配發，跨行程、重新啟動後都不會重複 (刪除的 id 也不會再用)；
+        沒有時只保證這個快取內不重複 (重新載入後，刪除的最大 id 可能再被配發)
+        """
+        if self._id_source is None:
+            book_id = self._next_id
+        else:
+            book_id = self._id_source(self._next_id)
+        self._next_id = book_id + 1
+        return book_id
+
+    def _prepare(self, book):
+        """轉為 Book 並算好所有排序鍵 (不修改快取；欄位有誤時在這裡就拋出例外)"""
+        book = Book.from_dict(book)
+        strokes = (sort_key(book.author or ''), sort_key(book.title or ''))
+        index_keys = [(index, SORT_KEYS[sort](book, strokes)) for sort, index in self._indexes.items()]
+        return book, strokes, index_keys
+
+    def _link(self, prepared):
+        """將 _prepare 的結果加入各索引"""
+        book, strokes, index_keys = prepared
+        book_id = book.id
+        self._stroke_keys[book_id] = strokes
+        for index, key in index_keys:
+            index.insert(key, book.category)
+        if self._search is not None:
+            self._search.add(book)
+        self._books[book_id] = book
+        self._by_category.setdefault(book.category, set()).add(book_id)
+        author = book.author
+        if author and author != DEFAULT_AUTHOR:
+            self._by_author.setdefault(author, set()).add(book_id)
+        if book_id >= self._next_id:
+            self._next_id = book_id + 1
+
+    def _insert(self, book):
+        self._link(self._prepare(book))
+
+    def _unlink(self, book_id):
+        old = self._books.pop(book_id, None)
+        if old is not None:
+            self._by_category.get(old.get('category'), set()).discard(book_id)
+            author_ids = self._by_author.get(old.get('author'))
+            if author_ids is not None:
+                author_ids.discard(book_id)
+                if not author_ids:
+                    del self._by_author[old.get('author')]
+            for index in self._indexes.values():
+                index.remove(old)
+            if self._search is not None:
+                self._search.remove(book_id)
+            del self._stroke_keys[book_id]
+        return old
+
+    def _bump(self, book_id):
+        """版本遞增並記錄變更的書籍 (超過上限時捨棄最舊的紀錄)"""
+        self.version += 1
+        if len(self._change_log) >= CHANGE_LOG_SIZE:
+            self._log_floor = self._change_log.popleft()[0]
+        self._change_log.append((self.version, book_id))
+
+    def add(self, book):
+        self._insert(book)
+        self._bump(book['id'])
+        return book
+
+    def update(self, book):
+        """以新資料取代同 id 的書籍，回傳舊資料 (dict)；新資料有誤時快取不變"""
+        prepared = self._prepare(book)
+        old = self._unlink(book['id'])
+        self._link(prepared)
+        self._bump(book['id'])
+        return old.to_dict() if old is not None else None
+
+    def remove(self, book_id):
+        """刪除書籍，回傳被刪除的資料 (dict，不存在時回傳 None)"""
+        old = self._unlink(book_id)
+        if old is None:
+            return None
+        self._bump(book_id)
+        return old.to_dict()
+
+    def plan_batch(self, operations, default_category='新書-待借'):
+        """
+        驗證一批操作並轉為 (op, book) 變更 (不修改快取，只配發新書 id)
+        operations: [{'op': 'add', 'book': {...}}, {'op': 'update', 'id': 1, 'book': {...}}, {'op': 'delete', 'id': 2}]
+        回傳 (changes, results, errors)；有任何錯誤時整批都不應套用
+        """
+        if not isinstance(operations, list) or not operations:
+            raise ValueError("operations must be a non-empty list")
+        if len(operations) > MAX_BATCH_OPS:
+            raise ValueError(f"Too many operations (max {MAX_BATCH_OPS})")
+
+        view = {}  # 本批次中已變更的書籍 (None 表示已刪除)
+        changes, results, errors = [], [], []
+
+        def current(book_id):
+            return view[book_id] if book_id in view else self._books.get(book_id)
+
+        for index, item in enumerate(operations):
+            op = item.get('op') if isinstance(item, dict) else None
+            data = (item.get('book') or {}) if isinstance(item, dict) else {}
+            if op not in ('add', 'update', 'delete') or not isinstance(data, dict):
+                errors.append({'index': index, 'error': f"Invalid operation: {op}"})
+                continue
+
+            if op == 'add':
+                try:
+                    book = build_book(None, data, default_category=default_category)
+                except ValueError as e:
+                    errors.append({'index': index, 'error': str(e)})
+                    continue
+                book['id'] = self.next_id()
+                view[book['id']] = book
+                changes.append(('add', book))
+                results.append({'index': index, 'op': op, 'status': 'ok', 'book': book})
+                continue
+
+            try:
+                book_id = int(item.get('id', data.get('id')))
+            except (TypeError, ValueError):
+                errors.append({'index': index, 'error': 'Missing or invalid id'})
+                continue
+            old = current(book_id)
+
+            if op == 'delete':
+                if old is None:
+                    # 與單筆刪除相同: 不存在視為成功
+                    results.append({'index': index, 'op': op, 'status': 'skipped', 'id': book_id})
+                    continue
+                view[book_id] = None
+                changes.append(('delete', old.copy()))
+                results.append({'index': index, 'op': op, 'status': 'ok', 'id': book_id, 'book': old.copy()})
+                continue
+
+            if old is None:
+                errors.append({'index': index, 'error': f"Book not found: {book_id}"})
+                continue
+            try:
+                book = build_book(book_id, data, base=old)
+            except ValueError as e:
+                errors.append({'index': index, 'error': str(e)})
+                continue
+            view[book_id] = book
+            changes.append(('update', book))
+            results.append({'index': index, 'op': op, 'status': 'ok', 'book': book, 'old': old.copy()})
+
+        return changes, results, errors
+
+    def changes_since(self, since, epoch=None):
+        """
+        某版本之後的變更: 回傳 {'epoch', 'version', 'full', 'books', 'deleted'}
+        epoch 不同 (快取已重建) 或變更紀錄已被捨棄時回傳完整資料 (full=True)
+        """
+        since = int(since)
+        if epoch != self.instance or since < self._log_floor or since > self.version:
+            return {
+                'epoch': self.instance, 'version': self.version, 'full': True,
+                'books': self.all(), 'deleted': []
+            }
+        # 從最新的紀錄往回找，同一本書只取目前狀態
+        changed = set()
+        for version, book_id in reversed(self._change_log):
+            if version <= since:
+                break
+            changed.add(book_id)
+        books = self._books
+        return {
+            'epoch': self.instance, 'version': self.version, 'full': False,
+            'books': [books[i] for i in sorted(changed) if i in books],
+            'deleted': sorted(i for i in changed if i not in books)
+        }
+
+    def apply(self, changes):
+        """套用 (op, book) 變更"""
+        for op, book in changes:
+            if op == 'delete':
+                self.remove(book['id'])
+            else:
+                self.update(book)
+        return self
+
+    def _sort_key_func(self, sort):
+        key_func = SORT_KEYS[sort]
+        stroke_keys = self._stroke_keys
+        return lambda book: key_func(book, stroke_keys[book['id']])
+
+    def _index(self, sort):
+        if sort not in self._indexes:
+            self._indexes[sort] = SortedIndex(self._sort_key_func(sort), self._books.values())
+        return self._indexes[sort]
+
+    def _search_index(self):
+        if self._search is None:
+            self._search = SearchIndex(self._books.values())
+        return self._search
+
+    def search(self, q, limit=20, category=None):
+        """全文搜尋，依相關度排序: 回傳 {'books', 'total'} (每本書附上 score)"""
+        limit = max(1, min(int(limit), MAX_LIMIT))
+        ranked, total = self._search_index().search(self._books, q, limit=limit, category=category)
+        return {
+            'books': [dict(book, score=round(score, 2)) for score, book in ranked],
+            'total': total
+        }
+
+    def authors(self, sort='count', limit=DEFAULT_LIMIT, offset=0):
+        """
+        作者統計 (分頁): 回傳 {'authors': [{'author', 'count', 'titles'}], 'total'}
+        sort: 'count' (書籍數多的在前) 或 'name' (筆畫排序)；排序結果在資料變更前重複使用
+        """
+        if sort not in AUTHOR_SORTS:
+            raise ValueError(f"Unknown sort: {sort}")
+        limit = max(1, min(int(limit), MAX_LIMIT))
+        offset = max(0, int(offset))
+        cached = self._author_order.get(sort)
+        if cached is None or cached[0] != self.version:
+            by_author = self._by_author
+            if sort == 'count':
+                order = sorted(by_author, key=lambda a: (-len(by_author[a]), sort_key(a)))
+            else:
+                order = sorted(by_author, key=sort_key)
+            cached = self._author_order[sort] = (self.version, order)
+        books = self._books
+        return {
+            'authors': [
+                {
+                    'author': author,
+                    'count': len(self._by_author[author]),
+                    'titles': [books[book_id]['title'] for book_id in sorted(self._by_author[author])]
+                }
+                for author in cached[1][offset:offset + limit]
+            ],
+            'total': len(cached[1])
+        }
+
+    def _filtered_keys(self, keys, category, sort, q):
+        """符合關鍵字的排序鍵 (先用全文索引找出候選，再確認完整包含關鍵字)"""
+        needle = q.strip().lower()
+        books = self._books
+        # 英數字可能出現在單字中間 (索引只支援前綴)，含英數字的查詢逐筆比對
+        has_latin = any(c.isascii() and c.isalnum() for c in needle)
+        candidates = None if has_latin else self._search_index().match(q)
+        if candidates is None:
+            # 查詢沒有可索引的中文字 (例如只有符號或英數字)，逐筆比對
+            return [key for key in keys if _matches(books[-key[-1]], needle)]
+        key_func = self._sort_key_func(sort)
+        return sorted(
+            key_func(books[book_id]) for book_id in candidates
+            if (category is None or books[book_id].get('category') == category)
+            and _matches(books[book_id], needle)
+        )
+
+    def sorted(self, sort='date_desc', category=None):
+        """依排序方式回傳書籍列表"""
+        books = self._books
+        return [books[-key[-1]] for key in self._index(sort).keys(category)]
+
+    def query(self, category=None, q=None, sort='date_desc', limit=DEFAULT_LIMIT, cursor=None):
+        """
+        分頁查詢: 回傳 {'books', 'total', 'next_cursor'}
+        cursor 為上一頁最後一本書的排序鍵 (keyset 分頁，翻頁期間有變更也不會重複/遺漏)
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Unknown sort: {sort}")
+        limit = max(1, min(int(limit), MAX_LIMIT))
+        keys = self._index(sort).keys(category)
+        if q:
+            keys = self._filtered_keys(keys, category, sort, q)
+        try:
+            start = bisect_right(keys, decode_cursor(cursor)) if cursor else 0
+        except TypeError as e:
+            raise ValueError(f"Cursor does not match sort '{sort}'") from e
+        books = self._books
+
+        total = len(keys)
+        page = keys[start:start + limit + 1]
+
+        next_cursor = encode_cursor(page[limit - 1]) if len(page) > limit else None
+        return {
+            'books': [books[-key[-1]] for key in page[:limit]],
+            'total': total,
+            'next_cursor': next_cursor
+        }
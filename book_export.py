@@ -0,0 +1,87 @@
+"""
+書籍匯出 (/api/export)
+- xlsx: openpyxl write-only 模式逐列寫入記憶體緩衝區，不經過 DataFrame、不產生暫存檔
+- csv: UTF-8 (含 BOM，Excel 可直接開啟)
+- jsonl: 每行一本書的 JSON
+產生的檔案依書籍快取的版本 (instance + version) 快取，資料沒變時重複匯出直接回傳。
+"""
+
+from io import BytesIO, StringIO
+import csv
+import threading
+
+import openpyxl
+
+from book_record import BookEncoder
+from excel_io import DEFAULT_AUTHOR, EXCEL_COLUMNS, group_by_category
+
+CSV_COLUMNS = ['系統ID', '分類', *EXCEL_COLUMNS]
+
+FORMATS = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+def _excel_row(book):
+    return [book.get('author', DEFAULT_AUTHOR), book.get('title', ''), book.get('date', ''), book.get('note', '')]
+
+
+def export_xlsx(books, categories):
+    """每個分類一個工作表 (欄位同 圖書館借書清單.xlsx)"""
+    workbook = openpyxl.Workbook(write_only=True)
+    for cat, cat_books in group_by_category(books, categories).items():
+        sheet = workbook.create_sheet(title=cat)
+        sheet.append(EXCEL_COLUMNS)
+        for book in cat_books:
+            sheet.append(_excel_row(book))
+    buffer = BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def export_csv(books, categories):
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    for cat, cat_books in group_by_category(books, categories).items():
+        for book in cat_books:
+            writer.writerow([book.get('id', ''), cat, *_excel_row(book)])
+    return buffer.getvalue().encode('utf-8-sig')
+
+
+def export_jsonl(books, categories=None):
+    encoder = BookEncoder(ensure_ascii=False)
+    return ''.join(encoder.book(book) + '\n' for book in books).encode('utf-8')
+
+
+EXPORTERS = {
+    'xlsx': export_xlsx,
+    'csv': export_csv,
+    'jsonl': export_jsonl,
+}
+
+
+class ExportCache:
+    """各格式的匯出檔案，只保留目前版本 (BookCache.instance + version)"""
+
+    def __init__(self, categories):
+        self.categories = categories
+        self._key = None
+        self._files = {}  # 格式 -> bytes
+        self._lock = threading.Lock()
+
+    def get(self, books, fmt):
+        """回傳 books 目前版本的匯出內容 (bytes)；格式不支援時拋出 ValueError"""
+        if fmt not in EXPORTERS:
+            raise ValueError(f"Unknown export format: {fmt}")
+        key = (books.instance, books.version)
+        with self._lock:
+            if key != self._key:
+                self._key = key
+                self._files = {}
+            data = self._files.get(fmt)
+            if data is None:
+                data = self._files[fmt] = EXPORTERS[fmt](books, self.categories)
+            return data
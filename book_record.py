@@ -0,0 +1,145 @@
+"""
+精簡的書籍記錄 (快取用)
+快取中的每本書不再是一個 6 個鍵的 dict:
+- Book 使用 __slots__，沒有每筆一個 __dict__
+- 分類以小整數保存 (分類名稱表全部共用)，作者/日期/備註以 sys.intern 共用同一個字串物件
+- 提供與 dict 相同的讀取介面 (book['title']、book.get()、dict(book)、book.copy())，
+  既有的查詢/排序/搜尋程式不必修改；需要可修改的資料時用 copy() 取得 dict
+- dumps_books() 直接由欄位產生 JSON (與 Flask jsonify 的輸出相同)，不必先轉成 dict；
+  重複出現的作者/分類/日期字串只編碼一次
+"""
+
+from collections.abc import Mapping
+import json
+import sys
+import threading
+
+from json.encoder import encode_basestring, encode_basestring_ascii
+
+FIELDS = ('id', 'title', 'author', 'category', 'date', 'note')
+_FIELD_SET = frozenset(FIELDS)
+
+_category_names = []  # 分類代碼 -> 名稱
+_category_codes = {}  # 名稱 -> 分類代碼
+_category_lock = threading.Lock()
+
+
+def category_code(name):
+    """分類名稱對應的小整數 (第一次出現時配發)"""
+    code = _category_codes.get(name)
+    if code is None:
+        with _category_lock:
+            code = _category_codes.get(name)
+            if code is None:
+                code = len(_category_names)
+                _category_names.append(name)
+                _category_codes[name] = code
+    return code
+
+
+def _text(value):
+    """欄位值一律為字串 (None 為 '')，舊資料中的數字也能正常排序/搜尋"""
+    if type(value) is str:
+        return value
+    return '' if value is None else str(value)
+
+
+def _intern(value):
+    return sys.intern(_text(value))
+
+
+class Book(Mapping):
+    """唯讀的書籍記錄"""
+
+    __slots__ = ('id', 'title', 'author', '_category', 'date', 'note')
+
+    def __init__(self, id, title='', author='', category='', date='', note=''):
+        self.id = id
+        self.title = _text(title)
+        self.author = _intern(author)
+        self._category = category_code(_text(category))
+        self.date = _intern(date)
+        self.note = _intern(note)
+
+    @classmethod
+    def from_dict(cls, book):
+        if isinstance(book, cls):
+            return book
+        get = book.get
+        return cls(book['id'], get('title', ''), get('author', ''), get('category', ''),
+                   get('date', ''), get('note', ''))
+
+    @property
+    def category(self):
+        return _category_names[self._category]
+
+    def __getitem__(self, key):
+        if key in _FIELD_SET:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in _FIELD_SET:
+            return getattr(self, key)
+        return default
+
+    def __iter__(self):
+        return iter(FIELDS)
+
+    def __len__(self):
+        return len(FIELDS)
+
+    def to_dict(self):
+        return {
+            'id': self.id, 'title': self.title, 'author': self.author,
+            'category': self.category, 'date': self.date, 'note': self.note
+        }
+
+    copy = to_dict
+
+    def __repr__(self):
+        return f'Book({self.to_dict()!r})'
+
+
+class BookEncoder:
+    """
+    書籍列表的 JSON 編碼 (鍵依字母排序，與 json.dumps(sort_keys=True, separators=(',', ':')) 相同)
+    作者/分類/日期/備註的編碼結果快取重複使用；書名每本都不同，直接編碼
+    """
+
+    def __init__(self, ensure_ascii=True):
+        self._encode = encode_basestring_ascii if ensure_ascii else encode_basestring
+        self._fragments = {}
+
+    def _value(self, value):
+        fragment = self._fragments.get(value)
+        if fragment is None:
+            fragment = self._json(value)
+            if type(value) is str and len(self._fragments) < 100000:
+                self._fragments[value] = fragment
+        return fragment
+
+    def _json(self, value):
+        if type(value) is str:
+            return self._encode(value)
+        return json.dumps(value, sort_keys=True, separators=(',', ':'),
+                          ensure_ascii=self._encode is encode_basestring_ascii)
+
+    def book(self, book):
+        if not isinstance(book, Book):
+            return self._json(dict(book))
+        value = self._value
+        category = _category_names[book._category]
+        return (
+            f'{{"author":{value(book.author)},"category":{value(category)},'
+            f'"date":{value(book.date)},"id":{book.id if type(book.id) is int else self._json(book.id)},'
+            f'"note":{value(book.note)},"title":{self._json(book.title)}}}'
+        )
+
+    def books(self, books):
+        return '[' + ','.join(map(self.book, books)) + ']'
+
+
+def dumps_books(books, ensure_ascii=True):
+    """書籍列表 -> JSON 字串"""
+    return BookEncoder(ensure_ascii).books(books)
@@ -0,0 +1,101 @@
+"""
+產生筆畫排序資料 (collation.py 使用) 與測試用的排序範例
+以 Node.js (完整 ICU) 的 Intl.Collator('zh-TW-u-co-stroke') 排序，即前端 localeCompare 使用的順序 (臺灣標準筆畫數)
+- data/stroke_counts.txt: 每行為「筆畫數<TAB>該筆畫的所有中文字 (依排序順序)」；
+  ICU 沒有筆畫資料的字依部首排在所有筆畫之後，記錄為最後一行 (筆畫數 0)
+- data/symbol_order.txt: 空白、標點、符號與數字 (BMP) 依排序順序排成一行
+- tests/data/zh_tw_stroke_order.txt: 範例字串 (書單中的作者/書名、各筆畫的中文字、英數字) 依 Intl.Collator 排序的結果
+
+用法: python build_stroke_table.py [node 路徑]
+"""
+
+import json
+import subprocess
+import sys
+import unicodedata
+
+from collation import HAN_RANGES, STROKE_FILE, SYMBOL_FILE
+
+DATA_FILE = 'data/books.json'
+FIXTURE_FILE = 'tests/data/zh_tw_stroke_order.txt'
+
+# 排序字串；同時排入筆畫分界 (U+FDD0 + U+2800+筆畫數，ICU 筆畫索引的分界字元)，用來取得每個字的筆畫數
+SORT_SCRIPT = r"""
+const items = JSON.parse(require('fs').readFileSync(0, 'utf8'));
+const collator = new Intl.Collator(process.argv[1]);
+process.stdout.write(JSON.stringify(items.sort(collator.compare)));
+"""
+BOUNDARY = '﷐'
+MAX_STROKES = 100
+
+
+def collate(node, items, locale='zh-TW-u-co-stroke'):
+    result = subprocess.run(
+        [node, '-e', SORT_SCRIPT, locale], input=json.dumps(items), capture_output=True, text=True,
+        encoding='utf-8', check=True
+    )
+    return json.loads(result.stdout)
+
+
+def han_chars():
+    """需要筆畫資料的中文字 (NFKC 後不變的字；相容表意文字會正規化為統一表意文字)"""
+    for start, end in HAN_RANGES:
+        for cp in range(start, end + 1):
+            char = chr(cp)
+            if unicodedata.category(char) == 'Lo' and unicodedata.normalize('NFKC', char) == char:
+                yield char
+
+
+def build_table(node):
+    boundaries = [BOUNDARY + chr(0x2800 + n) for n in range(1, MAX_STROKES)]
+    groups = {}
+    strokes = None
+    for item in collate(node, list(han_chars()) + boundaries):
+        if item[0] == BOUNDARY:
+            strokes = ord(item[1]) - 0x2800
+        elif strokes is not None:
+            groups.setdefault(strokes, []).append(item)
+    # 沒有筆畫資料的字排在最後一種筆畫數之後 (依部首排序)，從最後一組中分出依部首排序的尾段
+    last = max(groups)
+    chars = groups[last]
+    radical_rank = {char: i for i, char in enumerate(collate(node, chars, 'zh-u-co-unihan'))}
+    split = len(chars) - 1
+    while split > 0 and radical_rank[chars[split - 1]] < radical_rank[chars[split]]:
+        split -= 1
+    groups[last], unknown = chars[:split], chars[split:]
+    with open(STROKE_FILE, 'w', encoding='utf-8', newline='\n') as f:
+        for strokes in sorted(groups):
+            f.write(f"{strokes}\t{''.join(groups[strokes])}\n")
+        if unknown:
+            f.write(f"0\t{''.join(unknown)}\n")
+    print(f"{STROKE_FILE}: {sum(map(len, groups.values()))} 字, {len(groups)} 種筆畫數, {len(unknown)} 字無筆畫資料")
+    return groups
+
+
+def build_symbols(node):
+    symbols = [
+        chr(cp) for cp in range(0x10000)
+        if unicodedata.category(chr(cp))[0] in 'PSNZ' and unicodedata.normalize('NFKC', chr(cp)) == chr(cp)
+    ]
+    with open(SYMBOL_FILE, 'w', encoding='utf-8', newline='\n') as f:
+        f.write(''.join(collate(node, symbols)) + '\n')
+    print(f"{SYMBOL_FILE}: {len(symbols)} 字")
+
+
+def build_fixture(node, groups):
+    with open(DATA_FILE, 'r', encoding='utf-8') as f:
+        books = json.load(f)
+    items = {b.get('author') or '' for b in books} | {b.get('title') or '' for b in books}
+    for chars in groups.values():
+        items.update(chars[::25])
+    items.update(['一', '丁', '王', '陳', '龜', '黃', '林', '李', 'a', 'B', 'abc', 'Harry Potter', '123', '9', '2024'])
+    items = collate(node, sorted(item for item in items if item))
+    with open(FIXTURE_FILE, 'w', encoding='utf-8', newline='\n') as f:
+        f.write('\n'.join(items) + '\n')
+    print(f"{FIXTURE_FILE}: {len(items)} 筆")
+
+
+if __name__ == '__main__':
+    node = sys.argv[1] if len(sys.argv) > 1 else 'node'
+    build_symbols(node)
+    build_fixture(node, build_table(node))
@@ -0,0 +1,89 @@
+"""
+筆畫排序 (zh-TW stroke collation)
+與前端 localeCompare(..., 'zh-TW-u-co-stroke') 相同的順序 (ICU):
+空白、符號、數字在前，接著中文字依筆畫數由少到多 (臺灣標準筆畫數)，最後是注音符號與英文等其他文字。
+
+筆畫資料存放於 data/stroke_counts.txt (由 build_stroke_table.py 以 Intl.Collator 產生)，
+每行為「筆畫數<TAB>字串」，字串為該筆畫數的所有中文字，依 ICU 的排序順序 (同筆畫不是依字碼)；
+最後一行 (筆畫數 0) 為 ICU 沒有筆畫資料、排在所有筆畫之後的字。
+涵蓋 CJK 擴充 A、CJK 統一表意文字與相容表意文字；其他中文字 (擴充 B 以後) 排在有資料的中文字之後。
+符號與數字的順序 (不是字碼順序，例如 '-' < ',' < '!') 存放於 data/symbol_order.txt，同樣由 ICU 產生。
+"""
+
+from bisect import bisect_right
+from functools import lru_cache
+from pathlib import Path
+import unicodedata
+
+STROKE_FILE = Path(__file__).parent / "data" / "stroke_counts.txt"
+SYMBOL_FILE = Path(__file__).parent / "data" / "symbol_order.txt"
+
+HAN_RANGES = ((0x3400, 0x4DBF), (0x4E00, 0x9FFF), (0xF900, 0xFAFF))
+
+# 排序鍵分四段: 符號/數字 < 中文字 < 注音符號與其他文字 < 私用區/未指定字元
+# 符號依 symbol_order.txt、中文字依筆畫資料的順序，其他依字碼
+_HAN_BASE = 0x110000
+_LETTER_BASE = 0x110000 * 2
+_OTHER_BASE = 0x110000 * 3
+_BOPOMOFO = range(0x3100, 0x3130)
+
+
+def _load_strokes():
+    """回傳 ({字: 排序位置}, [各筆畫數第一個字的位置], [筆畫數])"""
+    ranks, starts, counts = {}, [], []
+    with open(STROKE_FILE, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            strokes, chars = line.split('\t', 1)
+            starts.append(len(ranks))
+            counts.append(int(strokes))
+            for char in chars:
+                ranks[char] = len(ranks)
+    return ranks, starts, counts
+
+
+def _load_symbols():
+    with open(SYMBOL_FILE, 'r', encoding='utf-8') as f:
+        return {char: rank for rank, char in enumerate(f.read().rstrip('\n'))}
+
+
+_RANKS, _STROKE_STARTS, _STROKE_COUNTS = _load_strokes()
+_SYMBOLS = _load_symbols()
+
+
+def stroke_count(char):
+    """單一中文字的筆畫數 (非中文字或無資料回傳 0)"""
+    rank = _RANKS.get(char)
+    if rank is None:
+        return 0
+    return _STROKE_COUNTS[bisect_right(_STROKE_STARTS, rank) - 1]
+
+
+@lru_cache(maxsize=65536)
+def _char_key(char):
+    rank = _RANKS.get(char)
+    if rank is not None:
+        return _HAN_BASE + rank
+    cp = ord(char)
+    if 0x20000 <= cp <= 0x3FFFF:
+        return _HAN_BASE + len(_RANKS) + cp  # CJK 擴充 B 以後 (無筆畫資料)
+    category = unicodedata.category(char)
+    if category[0] == 'L':
+        if cp in _BOPOMOFO:
+            return _LETTER_BASE + cp - _BOPOMOFO.start
+        return _LETTER_BASE + ord(unicodedata.normalize('NFD', char)[0].lower()[0])  # 忽略重音、大小寫
+    if category in ('Co', 'Cn'):
+        return _OTHER_BASE + cp
+    rank = _SYMBOLS.get(char)
+    return rank if rank is not None else len(_SYMBOLS) + cp
+
+
+@lru_cache(maxsize=65536)
+def sort_key(text):
+    """字串的筆畫排序鍵 (tuple of int，可直接比較)"""
+    if not text:
+        return ()
+    text = unicodedata.normalize('NFKC', text)
+    return tuple(_char_key(c) for c in text)
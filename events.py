@@ -0,0 +1,142 @@
+"""
+Server-Sent Events 推播
+書籍變更/活動記錄發生時推送給所有連線中的客戶端 (GET /api/events)。
+- 每個客戶端有自己的緩衝區 (上限 max_buffer 筆)，跟不上時清空並送出 resync 事件，
+  由客戶端改用 /api/books/changes 重新同步，不會讓慢的客戶端拖住伺服器記憶體
+- 沒有事件時每 heartbeat 秒送出註解行，保持連線並偵測已斷線的客戶端
+- stream() 供 Flask (每個連線一個執行緒等待)，astream() 供 ASGI (在事件迴圈中等待，不佔用執行緒)
+"""
+
+from collections import deque
+import asyncio
+import threading
+
+from json_backend import dumps
+
+
+def format_event(event, data):
+    """SSE 訊息格式 (event + data 一行 JSON)"""
+    payload = dumps(data)
+    return f'event: {event}\ndata: {payload}\n\n'
+
+
+HEARTBEAT = ': ping\n\n'
+RETRY_MS = 3000  # 斷線後瀏覽器重新連線的間隔
+
+
+class Subscriber:
+    """單一客戶端的事件緩衝區"""
+
+    def __init__(self, max_buffer):
+        self.max_buffer = max_buffer
+        self._messages = deque()
+        self._cond = threading.Condition()
+        self._overflowed = False
+        self.listener = None  # put() 之後呼叫 (astream 用來喚醒事件迴圈)
+
+    def put(self, message):
+        with self._cond:
+            if len(self._messages) >= self.max_buffer:
+                # 客戶端跟不上，丟棄緩衝並要求重新同步
+                self._messages.clear()
+                self._overflowed = True
+            else:
+                self._messages.append(message)
+            self._cond.notify()
+        listener = self.listener
+        if listener is not None:
+            listener()
+
+    def get(self, timeout):
+        """等待事件，回傳緩衝中的所有訊息 (逾時回傳空 list)"""
+        with self._cond:
+            if not self._messages and not self._overflowed:
+                self._cond.wait(timeout)
+            messages = list(self._messages)
+            self._messages.clear()
+            if self._overflowed:
+                self._overflowed = False
+                messages.insert(0, format_event('resync', {}))
+            return messages
+
+
+class EventBroker:
+    """事件發布 (同一行程內)"""
+
+    def __init__(self, max_buffer=100, max_clients=50, heartbeat=15.0):
+        self.max_buffer = max_buffer
+        self.max_clients = max_clients
+        self.heartbeat = heartbeat
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def subscribe(self):
+        """新增客戶端；已達連線上限時回傳 None"""
+        with self._lock:
+            if len(self._subscribers) >= self.max_clients:
+                return None
+            subscriber = Subscriber(self.max_buffer)
+            self._subscribers.add(subscriber)
+            return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, event, data):
+        """推送事件給所有客戶端 (訊息只序列化一次)"""
+        message = format_event(event, data)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.put(message)
+
+    def stream(self, subscriber, idle_check=None):
+        """
+        客戶端的 SSE 串流 (generator)；連線中斷時自動取消訂閱
+        idle_check() 在沒有事件時呼叫，可回傳要額外送出的訊息 (例如其他行程修改了資料)
+        """
+        try:
+            yield f'retry: {RETRY_MS}\n\n'
+            while True:
+                messages = subscriber.get(self.heartbeat)
+                if not messages:
+                    extra = idle_check() if idle_check else None
+                    messages = [extra] if extra else [HEARTBEAT]
+                yield ''.join(messages)
+        finally:
+            self.unsubscribe(subscriber)
+
+    async def astream(self, subscriber):
+        """
+        stream() 的 async 版本 (ASGI 用)，等待事件時不佔用執行緒
+        其他行程修改資料的檢查由呼叫端的背景工作負責 (重讀後會推播 reload)
+        """
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+
+        def notify():
+            try:
+                loop.call_soon_threadsafe(wakeup.set)
+            except RuntimeError:  # 事件迴圈已結束
+                pass
+
+        subscriber.listener = notify
+        try:
+            yield f'retry: {RETRY_MS}\n\n'
+            while True:
+                messages = subscriber.get(0)
+                if not messages:
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), self.heartbeat)
+                    except asyncio.TimeoutError:
+                        pass
+                    wakeup.clear()
+                    messages = subscriber.get(0) or [HEARTBEAT]
+                yield ''.join(messages)
+        finally:
+            subscriber.listener = None
+            self.unsubscribe(subscriber)
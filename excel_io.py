@@ -0,0 +1,509 @@
+"""
+Excel 匯入/匯出工具
+負責 圖書館借書清單.xlsx 與書籍資料 (list of dict) 之間的轉換
+讀取時逐列串流解析 (openpyxl read-only，有安裝 python-calamine 時使用 calamine)，
+不經過 DataFrame。
+解析結果另存為快照 (<活頁簿>.snapshot)，以檔案大小 + 修改時間 + 內容雜湊判斷是否仍有效，
+活頁簿沒變時重新啟動/重讀不必再解析 Excel。
+書籍 id 存在每個工作表隱藏的「系統ID」欄 (由 WorkbookPatcher / write_workbook 寫入)，
+列的位置改變 (新增/刪除/在 Excel 中插入列) 時 id 不變。
+"""
+
+import hashlib
+import io
+import os
+import pickle
+import re
+
+import openpyxl
+from openpyxl.utils import get_column_letter
+import pandas as pd
+
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:  # 選用套件
+    CalamineWorkbook = None
+
+# Excel 欄位 (依序: 作者, 書名, 到期日, ISBN/備註)
+EXCEL_COLUMNS = ['作者', '書名', '到期日', 'ISBN']
+ID_COLUMN = '系統ID'  # 隱藏欄，保存書籍 id
+DEFAULT_AUTHOR = '未分類作者'
+
+# 常見日期格式: YYYY-MM-DD, YYYY/MM/DD, MM/DD, DD/MM/YYYY 等
+DATE_PATTERNS = [
+    re.compile(r'^\d{4}-\d{1,2}-\d{1,2}$'),  # 2024-01-30
+    re.compile(r'^\d{4}/\d{1,2}/\d{1,2}$'),  # 2024/01/30
+    re.compile(r'^\d{1,2}/\d{1,2}/\d{4}$'),  # 01/30/2024
+    re.compile(r'^\d{1,2}/\d{1,2}$'),        # 01/30 (沒有年份)
+    re.compile(r'^\d{1,2}-\d{1,2}$'),        # 01-30 (沒有年份)
+]
+
+
+def is_valid_date(date_str):
+    """檢查字串是否為有效日期格式"""
+    return any(pattern.match(date_str) for pattern in DATE_PATTERNS)
+
+
+def _cell_text(value):
+    """將儲存格的值轉為去除空白的字串 (空值回傳 '')"""
+    if value is None:
+        return ''
+    try:
+        if pd.isna(value):
+            return ''
+    except (TypeError, ValueError):
+        pass
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)  # calamine 的數字一律為 float
+    return str(value).strip()
+
+
+def _cell_id(value):
+    """系統ID 儲存格 -> int (空白或不是整數時回傳 None)"""
+    text = _cell_text(value)
+    return int(text) if text.isdigit() else None
+
+
+def parse_row(sheet_name, r_title, r_author, r_date, r_note):
+    """將一列原始儲存格轉為書籍資料 (不含 id)，標題行或空行回傳 None"""
+    # 處理標題 (過濾掉標題行或空行)
+    title = _cell_text(r_title)
+    if not title or title == '書名':
+        return None
+
+    author = _cell_text(r_author) or DEFAULT_AUTHOR
+    if author == '作者':
+        author = DEFAULT_AUTHOR  # 防止標題行被誤讀
+
+    # 處理日期
+    date = _cell_text(r_date)
+    if ' ' in date:
+        date = date.split(' ')[0]
+    if date == '到期日':
+        date = ''
+
+    # 處理備註
+    note = _cell_text(r_note)
+    if note == 'ISBN':
+        note = ''
+
+    # 🔧 自動修正：檢查「到期日」欄位是否被誤填為借閱人名稱
+    # 如果 date 不是日期格式，就當作備註處理
+    if date and not is_valid_date(date):
+        if not note:
+            note = date
+        date = ''
+
+    return {
+        'title': title,
+        'author': author,
+        'category': sheet_name,
+        'date': date,
+        'note': note
+    }
+
+
+def _column_map(cols):
+    """找出作者/書名/到期日/備註欄位 (優先使用名稱，否則使用位置)；系統ID 欄只依名稱"""
+    def pick(name, index):
+        if name in cols:
+            return name
+        return cols[index] if len(cols) > index and cols[index] != ID_COLUMN else None
+
+    return {
+        'author': pick('作者', 0),
+        'title': pick('書名', 1),
+        'date': pick('到期日', 2),
+        'note': pick('ISBN', 3),
+        'id': ID_COLUMN if ID_COLUMN in cols else None,
+    }
+
+
+def _header_columns(header):
+    """標題列 -> 欄位名稱 (空白欄位命名為 Unnamed: i)"""
+    return [
+        str(v) if v is not None and v != '' else f'Unnamed: {i}'
+        for i, v in enumerate(header)
+    ]
+
+
+def parse_sheet(sheet_name, rows):
+    """
+    解析一個工作表的列 (第一列為標題列)
+    回傳 (欄位位置 {'author': 0, ...}, 每一資料列的書籍資料或 None 的 iterator)；
+    有系統ID 欄時書籍資料含 'id' (沒有值時為 None，由 assign_ids 補上)；
+    無法識別書名欄位時回傳 (None, 空 iterator)
+    """
+    rows = iter(rows)
+    cols = _header_columns(next(rows, ()))
+    col_map = _column_map(cols)
+    if not col_map['title']:
+        return None, iter(())
+    columns = {key: cols.index(name) for key, name in col_map.items() if name}
+    positions = [columns.get(key) for key in ('title', 'author', 'date', 'note')]
+    id_position = columns.get('id')
+
+    def books():
+        for row in rows:
+            size = len(row)
+            book = parse_row(sheet_name, *(
+                row[i] if i is not None and i < size else None for i in positions
+            ))
+            if book is not None and id_position is not None:
+                book['id'] = _cell_id(row[id_position]) if id_position < size else None
+            yield book
+
+    return columns, books()
+
+
+def assign_ids(books):
+    """
+    依工作表順序排列的書籍 -> 加上 id 的書籍 (id 在第一個鍵)
+    系統ID 有值且不重複的沿用；其餘 (舊檔案沒有系統ID 欄、在 Excel 中手動新增的列)
+    依序從最大 id 之後編號，因此沒有系統ID 欄時與舊版相同，從 0 開始依序編號
+    """
+    used = set()
+    ids = []
+    for book in books:
+        book_id = book.get('id')
+        if book_id is None or book_id in used:
+            ids.append(None)
+        else:
+            used.add(book_id)
+            ids.append(book_id)
+    next_id = max(used) + 1 if used else 0
+    result = []
+    for book, book_id in zip(books, ids):
+        if book_id is None:
+            book_id = next_id
+            next_id += 1
+        result.append({'id': book_id, **{k: v for k, v in book.items() if k != 'id'}})
+    return result
+
+
+def _openpyxl_sheets(path, categories):
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        for ws in wb.worksheets:
+            if ws.title in categories:
+                yield ws.title, ws.iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+
+def _calamine_sheets(path, categories):
+    wb = CalamineWorkbook.from_path(path)
+    for name in wb.sheet_names:
+        if name in categories:
+            yield name, wb.get_sheet_by_name(name).to_python(skip_empty_area=False)
+
+
+EXCEL_ENGINES = {'openpyxl': _openpyxl_sheets, 'calamine': _calamine_sheets}
+
+
+def read_workbook(path, categories, engine=None):
+    """
+    從 Excel 讀取所有書籍，id 取自系統ID 欄 (沒有時依工作表順序編號，見 assign_ids)
+    engine: 'openpyxl' 或 'calamine'，預設有安裝 python-calamine 時使用 calamine
+    """
+    if engine is None:
+        engine = 'calamine' if CalamineWorkbook is not None else 'openpyxl'
+    if engine not in EXCEL_ENGINES:
+        raise ValueError(f"Unknown Excel engine: {engine}")
+    if engine == 'calamine' and CalamineWorkbook is None:
+        raise ValueError("python-calamine is not installed")
+
+    books = []
+    for sheet_name, rows in EXCEL_ENGINES[engine](path, categories):
+        _, parsed = parse_sheet(sheet_name, rows)
+        books.extend(book for book in parsed if book is not None)
+
+    return assign_ids(books)
+
+
+SNAPSHOT_VERSION = 2
+
+
+def snapshot_path(path):
+    return path + '.snapshot'
+
+
+def _file_stat(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _snapshot_rows(books):
+    return [(b['id'], b['title'], b['author'], b['category'], b['date'], b['note']) for b in books]
+
+
+def _write_snapshot(path, categories, stat, digest, rows):
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'categories': tuple(categories),
+        'size': stat[0],
+        'mtime': stat[1],
+        'digest': digest,
+        'rows': rows,
+    }
+    target = snapshot_path(path)
+    tmp_file = target + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, target)
+
+
+def save_snapshot(path, categories, books, digest=None):
+    """將 read_workbook 的結果 (依工作表順序) 存為快照；digest 為已知的檔案雜湊 (省略時讀取檔案計算)"""
+    _write_snapshot(path, categories, _file_stat(path), digest or _file_digest(path), _snapshot_rows(books))
+
+
+def load_snapshot(path, categories):
+    """讀取快照中的書籍；快照不存在或與活頁簿內容不符時回傳 None"""
+    try:
+        with open(snapshot_path(path), 'rb') as f:
+            snapshot = pickle.load(f)
+        stat = _file_stat(path)
+    except Exception:
+        return None
+    if (
+        not isinstance(snapshot, dict)
+        or snapshot.get('version') != SNAPSHOT_VERSION
+        or snapshot.get('categories') != tuple(categories)
+        or snapshot.get('size') != stat[0]
+    ):
+        return None
+    if snapshot.get('mtime') != stat[1]:
+        # 修改時間不同 (例如複製/還原檔案)，內容相同時仍可使用
+        digest = _file_digest(path)
+        if snapshot.get('digest') != digest:
+            return None
+        _write_snapshot(path, categories, stat, digest, snapshot['rows'])
+    return [
+        {'id': book_id, 'title': title, 'author': author, 'category': category,
+         'date': date, 'note': note}
+        for book_id, title, author, category, date, note in snapshot['rows']
+    ]
+
+
+def read_workbook_cached(path, categories, engine=None):
+    """與 read_workbook 相同，但活頁簿沒變時直接使用快照"""
+    books = load_snapshot(path, categories)
+    if books is not None:
+        return books
+    stat = _file_stat(path)
+    digest = _file_digest(path)
+    books = read_workbook(path, categories, engine=engine)
+    if _file_stat(path) == stat:
+        # 解析期間檔案沒被修改才存快照
+        try:
+            _write_snapshot(path, categories, stat, digest, _snapshot_rows(books))
+        except OSError:
+            pass
+    return books
+
+
+def group_by_category(books, categories, default_category=None):
+    """按分類分組，未知分類歸入第一個分類"""
+    default_category = default_category or categories[0]
+    categorized = {cat: [] for cat in categories}
+    for book in books:
+        cat = book.get('category', default_category)
+        categorized[cat if cat in categorized else default_category].append(book)
+    return categorized
+
+
+def _sheet_frame(cat_books):
+    """將一個分類的書籍轉為 DataFrame (空分類保留欄位結構)"""
+    if not cat_books:
+        return pd.DataFrame(columns=[*EXCEL_COLUMNS, ID_COLUMN])
+    return pd.DataFrame([{
+        '作者': b.get('author', DEFAULT_AUTHOR),
+        '書名': b.get('title', ''),
+        '到期日': b.get('date', ''),
+        'ISBN': b.get('note', ''),
+        ID_COLUMN: b.get('id')
+    } for b in cat_books])
+
+
+def _hide_column(ws, col):
+    ws.column_dimensions[get_column_letter(col)].hidden = True
+
+
+def write_workbook(path, books, categories, sheets=None):
+    """將書籍寫回 Excel，sheets 指定只覆寫哪些工作表 (None 表示全部)"""
+    categorized = group_by_category(books, categories)
+
+    # 如果檔案不存在，必須用 'w' 模式寫入所有工作表
+    if not os.path.exists(path) or sheets is None:
+        kwargs = {'engine': 'openpyxl', 'mode': 'w'}
+        sheets = list(categories)
+    else:
+        kwargs = {'engine': 'openpyxl', 'mode': 'a', 'if_sheet_exists': 'replace'}
+
+    with pd.ExcelWriter(path, **kwargs) as writer:
+        for cat in sheets:
+            _sheet_frame(categorized[cat]).to_excel(writer, sheet_name=cat, index=False)
+            _hide_column(writer.sheets[cat], len(EXCEL_COLUMNS) + 1)
+
+
+class WorkbookPatcher:
+    """
+    以儲存格為單位修改 Excel (增量寫入)
+    - 新增: 附加到該分類工作表的最後一列
+    - 編輯: 只改寫該列的儲存格 (分類改變時從舊表刪列、附加到新表)
+    - 刪除: 只刪除該列
+    書籍 id 與 read_workbook 相同；載入時為還沒有系統ID 的列補上 id (下次存檔時寫入)，
+    之後重新讀取或重新載入活頁簿時 id 都不會改變。
+    """
+
+    def __init__(self, path, categories):
+        self.path = path
+        self.categories = categories
+        self.wb = openpyxl.load_workbook(path)
+        self.mtime = os.path.getmtime(path)
+        self._rows = {}     # sheet -> 第 2 列起每列的書籍 id (非書籍列為 None)
+        self._columns = {}  # sheet -> {'author': 1, 'title': 2, 'date': 3, 'note': 4, 'id': 5}
+        self._where = {}    # book id -> sheet
+        self._books = {}    # book id -> 該列目前的內容 (與重新解析的結果相同)
+        self._scan()
+
+    def _scan(self):
+        """掃描工作表，建立 id -> 列位置的對照，並補上缺少的系統ID"""
+        found = []  # (sheet, 列索引, 解析結果)
+        for ws in self.wb.worksheets:
+            if ws.title not in self.categories:
+                continue
+            columns, parsed = parse_sheet(ws.title, ws.iter_rows(values_only=True))
+            if columns is None:
+                continue
+            self._columns[ws.title] = {key: i + 1 for key, i in columns.items()}
+            if 'id' not in columns:
+                self._add_id_column(ws)
+
+            ids = []
+            for book in parsed:
+                if book is not None:
+                    found.append((ws.title, len(ids), book))
+                ids.append(None)
+            self._rows[ws.title] = ids
+
+        for (sheet, index, raw), book in zip(found, assign_ids([raw for _, _, raw in found])):
+            if raw.get('id') != book['id']:
+                self.wb[sheet].cell(row=index + 2, column=self._columns[sheet]['id'], value=book['id'])
+            self._rows[sheet][index] = book['id']
+            self._where[book['id']] = sheet
+            self._books[book['id']] = book
+
+    def _add_id_column(self, ws):
+        col = ws.max_column + 1
+        ws.cell(row=1, column=col, value=ID_COLUMN)
+        _hide_column(ws, col)
+        self._columns[ws.title]['id'] = col
+
+    def _sheet(self, category):
+        """取得分類工作表 (不存在時建立並寫入標題列)"""
+        if category not in self.categories:
+            category = self.categories[0]
+        if category not in self.wb.sheetnames:
+            ws = self.wb.create_sheet(category)
+            ws.append([*EXCEL_COLUMNS, ID_COLUMN])
+            _hide_column(ws, len(EXCEL_COLUMNS) + 1)
+        ws = self.wb[category]
+        if category not in self._columns:
+            # 新建或無法識別欄位的工作表，使用預設欄位位置
+            self._rows[category] = [None] * (ws.max_row - 1)
+            self._columns[category] = {'author': 1, 'title': 2, 'date': 3, 'note': 4, 'id': 5}
+        return ws
+
+    def _write_cells(self, ws, row, book):
+        columns = self._columns[ws.title]
+        values = {
+            'author': book.get('author', DEFAULT_AUTHOR),
+            'title': book.get('title', ''),
+            'date': book.get('date', ''),
+            'note': book.get('note', ''),
+            'id': book['id'],
+        }
+        for key, col in columns.items():
+            ws.cell(row=row, column=col, value=values[key] if values[key] != '' else None)
+        cells = {key: ws.cell(row=row, column=col).value for key, col in columns.items()}
+        parsed = parse_row(ws.title, cells.get('title'), cells.get('author'), cells.get('date'), cells.get('note'))
+        if parsed is None:
+            self._books.pop(book['id'], None)
+        else:
+            self._books[book['id']] = {'id': book['id'], **parsed}
+
+    def _row_of(self, sheet, book_id):
+        """書籍所在的列號；對照表與工作表不一致時拋出 KeyError (不會改到別本書)"""
+        try:
+            return self._rows[sheet].index(book_id) + 2
+        except (KeyError, ValueError):
+            raise KeyError(f"Book {book_id} is not in sheet {sheet}") from None
+
+    def append(self, book):
+        ws = self._sheet(book.get('category'))
+        ids = self._rows[ws.title]
+        ids.append(book['id'])
+        self._write_cells(ws, len(ids) + 1, book)
+        self._where[book['id']] = ws.title
+
+    def delete(self, book_id):
+        sheet = self._where.get(book_id)
+        if sheet is None:
+            return
+        row = self._row_of(sheet, book_id)
+        self.wb[sheet].delete_rows(row)
+        del self._rows[sheet][row - 2]
+        del self._where[book_id]
+        self._books.pop(book_id, None)
+
+    def update(self, book):
+        sheet = self._where.get(book['id'])
+        target = self._sheet(book.get('category')).title
+        if sheet != target:
+            # 分類改變: 從舊工作表移到新工作表
+            self.delete(book['id'])
+            self.append(book)
+            return
+        self._write_cells(self.wb[sheet], self._row_of(sheet, book['id']), book)
+
+    def apply(self, changes):
+        """套用一批 (op, book) 變更 (尚未存檔)"""
+        for op, book in changes:
+            if op == 'add':
+                self.append(book)
+            elif op == 'update':
+                self.update(book)
+            elif op == 'delete':
+                self.delete(book['id'])
+            else:
+                raise ValueError(f"Unknown change op: {op}")
+
+    def books(self):
+        """目前活頁簿內容的書籍 (與重新 read_workbook 的結果相同，不必重新解析)"""
+        books = []
+        for ws in self.wb.worksheets:
+            for book_id in self._rows.get(ws.title, ()):
+                book = self._books.get(book_id) if book_id is not None else None
+                if book is not None:
+                    books.append(book)
+        return books
+
+    def save(self):
+        """存檔；同時記下檔案內容的雜湊 (寫快照時不必重新讀取檔案)"""
+        buffer = io.BytesIO()
+        self.wb.save(buffer)
+        data = buffer.getvalue()
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        self.mtime = os.path.getmtime(self.path)
+        self.digest = hashlib.sha1(data).hexdigest()
@@ -0,0 +1,202 @@
+"""
+HTTP 快取與壓縮
+- ETag: 由書籍快取的實例 id + 版本 + 查詢參數產生 (強 ETag)，If-None-Match 相同時回傳 304，
+  不必重新產生 JSON
+- 壓縮: 回應為 JSON/文字且超過 MIN_SIZE 時依 Accept-Encoding 使用 brotli (有安裝時) 或 gzip；
+  壓縮後的 ETag 加上編碼後綴 (例如 "...-gzip")，比對時視為同一版本
+- JSON: 有安裝 orjson 時 API 回應以 orjson 編碼 (json_backend.py)；快取中的 Book 記錄可直接 jsonify
+- 預先編碼: cached_json() 依書籍快取版本保存編碼好 (及壓縮好) 的回應內容，
+  資料沒變時重複讀取直接回傳 bytes，不必重新排序/編碼/壓縮
+"""
+
+import gzip
+import threading
+import zlib
+
+from flask import Response, current_app, make_response, request
+from flask.json.provider import DefaultJSONProvider
+
+from book_record import Book, dumps_books
+import json_backend
+
+try:
+    import brotli
+except ImportError:  # 選用套件
+    brotli = None
+
+MIN_SIZE = 1024
+COMPRESSIBLE_TYPES = ('application/json', 'text/html', 'text/plain', 'text/css',
+                      'text/csv', 'application/x-ndjson', 'application/javascript', 'text/javascript')
+CODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def collection_etag(books, variant=''):
+    """書籍快取目前版本的 ETag (不含引號)；variant 區分同一版本的不同查詢"""
+    return f'{books.instance}-{books.version}-{zlib.crc32(variant.encode("utf-8")):08x}'
+
+
+def _matched_etag(etag):
+    """If-None-Match 中與 etag 相同版本的值 (含壓縮後綴)，沒有時回傳 None"""
+    if_none_match = request.if_none_match
+    if not if_none_match:
+        return None
+    for tag in (etag, *(f'{etag}-{coding}' for coding in CODINGS)):
+        if if_none_match.contains(tag):
+            return tag
+    return None
+
+
+def conditional_json(books, build):
+    """
+    產生帶 ETag 的回應；客戶端已有相同版本時直接回傳 304
+    build() 回傳 Flask 回應 (或 (內容, 狀態碼))，只有 200 時才加上 ETag
+    """
+    etag = collection_etag(books, request.full_path)
+    matched = _matched_etag(etag)
+    if matched:
+        response = make_response('', 304)
+        response.set_etag(matched)
+    else:
+        response = make_response(build())
+        if response.status_code != 200:
+            return response
+        coding = response.headers.get('Content-Encoding')
+        response.set_etag(f'{etag}-{coding}' if coding else etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def _choose_coding():
+    accept = request.accept_encodings
+    for coding in CODINGS:
+        if accept[coding] > 0:
+            return coding
+    return None
+
+
+def compress_body(data, coding):
+    """以 br / gzip 壓縮回應內容"""
+    if coding == 'br':
+        return brotli.compress(data, quality=5)
+    return gzip.compress(data, compresslevel=6)
+
+
+def compress_response(response):
+    """after_request: 依 Accept-Encoding 壓縮回應"""
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or response.status_code != 200
+        or 'Content-Encoding' in response.headers
+        or response.mimetype not in COMPRESSIBLE_TYPES
+    ):
+        return response
+    response.vary.add('Accept-Encoding')
+    coding = _choose_coding()
+    if coding is None:
+        return response
+    data = response.get_data()
+    if len(data) < MIN_SIZE:
+        return response
+
+    response.set_data(compress_body(data, coding))
+    response.headers['Content-Encoding'] = coding
+
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f'{etag}-{coding}', weak)
+    return response
+
+
+class PayloadCache:
+    """預先編碼的回應內容 {key: ((instance, version), {編碼: bytes})}，只保留每個 key 的目前版本"""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def bodies(self, books, key):
+        """books 目前版本的內容 dict ('' 為未壓縮，其他為各壓縮編碼)"""
+        stamp = (books.instance, books.version)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != stamp:
+                entry = self._entries[key] = (stamp, {})
+            return entry[1]
+
+
+PAYLOADS = PayloadCache()
+
+
+def cached_json(books, key, build):
+    """
+    JSON 回應 (內容依 books 的版本快取): build() 回傳要輸出的資料，同一版本只編碼一次；
+    客戶端接受壓縮時回傳預先壓縮好的內容 (ETag 由 conditional_json 加上編碼後綴)
+    """
+    bodies = PAYLOADS.bodies(books, key)
+    body = bodies.get('')
+    if body is None:
+        # 同時有多個請求時可能重複產生，結果相同，保留先完成的
+        body = bodies.setdefault('', current_app.json.response(build()).get_data())
+    response = Response(mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    coding = _choose_coding() if len(body) >= MIN_SIZE else None
+    if coding is None:
+        response.set_data(body)
+        return response
+    data = bodies.get(coding)
+    if data is None:
+        data = bodies.setdefault(coding, compress_body(body, coding))
+    response.set_data(data)
+    response.headers['Content-Encoding'] = coding
+    return response
+
+
+def _is_book_list(obj):
+    return isinstance(obj, list) and obj and isinstance(obj[0], Book)
+
+
+class BookJSONProvider(DefaultJSONProvider):
+    """
+    支援 Book 記錄的 JSON 輸出 (其他位置的 Book 轉為 dict)
+    有安裝 orjson 時以 orjson 編碼/解碼 (UTF-8，中文不跳脫)；否則書籍列表由欄位直接編碼
+    """
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, Book):
+            return o.to_dict()
+        return DefaultJSONProvider.default(o)
+
+    def _dumpb(self, obj, indent=False):
+        if _is_book_list(obj):
+            obj = [book.to_dict() for book in obj]  # 比逐筆經過 default 快
+        return json_backend.dumpb(obj, sort_keys=self.sort_keys, indent=indent,
+                                  default=DefaultJSONProvider.default)
+
+    def dumps(self, obj, **kwargs):
+        if json_backend.orjson is not None:
+            return self._dumpb(obj, bool(kwargs.get('indent'))).decode('utf-8')
+        if (
+            _is_book_list(obj)
+            and kwargs.get('separators') == (',', ':') and kwargs.get('sort_keys', self.sort_keys)
+        ):
+            return dumps_books(obj, ensure_ascii=kwargs.get('ensure_ascii', self.ensure_ascii))
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if json_backend.orjson is not None:
+            return json_backend.loads(s)
+        return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        if json_backend.orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        return self._app.response_class(self._dumpb(obj, indent) + b'\n', mimetype=self.mimetype)
+
+
+def init_app(app):
+    app.json = BookJSONProvider(app)
+    app.after_request(compress_response)
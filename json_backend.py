@@ -0,0 +1,80 @@
+"""
+JSON 編碼/解碼
+有安裝 orjson 時使用 orjson (編碼/解碼都快很多)，沒有時使用標準函式庫 json，輸出格式相同:
+精簡 (沒有多餘空白)、UTF-8 (中文不跳脫)。
+API 回應 (http_cache.BookJSONProvider) 與所有寫入檔案的資料 (活動記錄、寫入佇列、
+JSON 儲存、備份庫) 都經過這裡。
+"""
+
+from collections.abc import Mapping
+import json
+
+try:
+    import orjson
+except ImportError:  # 選用套件
+    orjson = None
+
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+
+def _default(o):
+    """其他型別: 有 to_dict() 的物件 (例如快取的 Book 記錄) 與 Mapping 轉為 dict"""
+    to_dict = getattr(o, 'to_dict', None)
+    if to_dict is not None:
+        return to_dict()
+    if isinstance(o, Mapping):
+        return dict(o)
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+def _chain(default):
+    if default is None:
+        return _default
+
+    def chained(o):
+        try:
+            return _default(o)
+        except TypeError:
+            return default(o)
+
+    return chained
+
+
+if orjson is not None:
+    def dumpb(obj, sort_keys=False, indent=False, default=None):
+        """編碼為 UTF-8 bytes"""
+        option = orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=_chain(default), option=option)
+
+    def dumps(obj, sort_keys=False, indent=False, default=None):
+        """編碼為 str"""
+        return dumpb(obj, sort_keys, indent, default).decode('utf-8')
+
+    loads = orjson.loads
+else:
+    def dumps(obj, sort_keys=False, indent=False, default=None):
+        """編碼為 str"""
+        return json.dumps(
+            obj, ensure_ascii=False, sort_keys=sort_keys, default=_chain(default),
+            indent=2 if indent else None, separators=(',', ': ') if indent else (',', ':')
+        )
+
+    def dumpb(obj, sort_keys=False, indent=False, default=None):
+        """編碼為 UTF-8 bytes"""
+        return dumps(obj, sort_keys, indent, default).encode('utf-8')
+
+    loads = json.loads
+
+
+def dump(obj, f, **kwargs):
+    """寫入文字檔"""
+    f.write(dumps(obj, **kwargs))
+
+
+def load(f):
+    """讀取檔案 (文字或二進位模式)"""
+    return loads(f.read())
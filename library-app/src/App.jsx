@@ -255,6 +255,7 @@ const ActivityLog = ({ activities, stats, onRefresh, onClear }) => {
       case 'edit': return '✏️';
       case 'delete': return '🗑️';
       case 'category_change': return '📁';
+      case 'batch': return '📦';
       default: return '📝';
     }
   };
@@ -265,6 +266,7 @@ const ActivityLog = ({ activities, stats, onRefresh, onClear }) => {
       case 'edit': return '編輯書籍';
       case 'delete': return '刪除書籍';
       case 'category_change': return '變更分類';
+      case 'batch': return '批次操作';
       default: return '操作';
     }
   };
@@ -275,6 +277,7 @@ const ActivityLog = ({ activities, stats, onRefresh, onClear }) => {
       case 'edit': return '#3b82f6';
       case 'delete': return '#ef4444';
       case 'category_change': return '#f59e0b';
+      case 'batch': return '#0ea5e9';
       default: return '#8b5cf6';
     }
   };
@@ -3,167 +3,308 @@
 Python Flask 後端 + 靜態前端
 """
 
-from flask import Flask, jsonify, request, send_from_directory, send_file
+from flask import Flask, Response, jsonify, request, send_from_directory
 from flask_cors import CORS
-import pandas as pd
-import json
 import os
 from pathlib import Path
 from datetime import datetime
-import tempfile
+from contextlib import contextmanager
+
+from book_cache import DEFAULT_LIMIT, BookCache, build_book
+from book_export import FORMATS as EXPORT_FORMATS, ExportCache
+from events import EventBroker, format_event
+from http_cache import cached_json, conditional_json, init_app as init_http_cache
+from locks import FileLock, RWLock
+from storage import JsonStorage
+import json_backend
 
 app = Flask(__name__, static_folder='static', static_url_path='')
 CORS(app)
+init_http_cache(app)  # 回應壓縮 (gzip/brotli)
 
 # 資料檔案路徑
 DATA_FILE = Path(__file__).parent / "data" / "books.json"
 LAST_MTIME = 0
 CACHED_BOOKS = None
 
+# 快取的讀寫鎖 (行程內) + 資料檔的檔案鎖 (多個 worker 之間)
+CACHE_LOCK = RWLock()
+DATA_FILE.parent.mkdir(parents=True, exist_ok=True)
+DATA_LOCK = FileLock(str(DATA_FILE) + '.lock')
+
+# 資料儲存: books.json 快照 + books.json.wal 寫入記錄 (每次變更只附加一行)，
+# 寫入記錄超過 LIBRARY_WAL_COMPACT_BYTES 時合併成新快照；啟動時重播並合併上次留下的記錄
+STORAGE = JsonStorage(
+    str(DATA_FILE),
+    compact_bytes=int(os.environ.get('LIBRARY_WAL_COMPACT_BYTES', 1024 * 1024))
+)
+STORAGE.compact()
+
 # 分類
 CATEGORIES = [
     '新書-待借', '待借', '不能借', '食譜', 
     '頁數太多', '已看-3447本', '已看-1', '未到館'
 ]
 
-def load_books():
-    """載入書籍資料 (含快取)"""
+# 匯出檔案快取 (依資料版本)
+EXPORTS = ExportCache(CATEGORIES)
+
+# GET /api/books 的查詢參數 (有任一參數時回傳分頁結果)
+QUERY_PARAMS = ('category', 'q', 'sort', 'limit', 'cursor')
+
+# 即時推播 (SSE)
+EVENTS = EventBroker(
+    max_buffer=int(os.environ.get('LIBRARY_SSE_BUFFER', 100)),
+    max_clients=int(os.environ.get('LIBRARY_SSE_MAX_CLIENTS', 50)),
+    heartbeat=float(os.environ.get('LIBRARY_SSE_HEARTBEAT', 15))
+)
+
+def _data_token():
+    return STORAGE.change_token()
+
+def _load_books_locked():
+    """重讀資料 (呼叫端須持有 CACHE_LOCK 寫入鎖與 DATA_LOCK)"""
     global CACHED_BOOKS, LAST_MTIME
     
-    if DATA_FILE.exists():
-        try:
-            current_mtime = DATA_FILE.stat().st_mtime
-            
-            if CACHED_BOOKS is not None and current_mtime == LAST_MTIME:
-                return CACHED_BOOKS
-                
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                books = json.load(f)
-                
-            CACHED_BOOKS = books
-            LAST_MTIME = current_mtime
-            return books
-        except Exception as e:
-            print(f"Error loading books: {e}")
-            return []
-    return []
-
-def save_books(books):
-    """儲存書籍資料"""
+    current_token = _data_token()
+    if CACHED_BOOKS is not None and current_token == LAST_MTIME:
+        return
+    try:
+        books = BookCache(STORAGE.load_books(), id_source=STORAGE.allocate_id)
+        CACHED_BOOKS = books
+        LAST_MTIME = current_token
+        EVENTS.publish('reload', {'version': books.version, 'epoch': books.instance})
+    except Exception as e:
+        print(f"Error loading books: {e}")
+        if CACHED_BOOKS is None:
+            CACHED_BOOKS = BookCache(id_source=STORAGE.allocate_id)
+
+def load_books():
+    """載入書籍資料 (含快取，回傳 BookCache)"""
+    if CACHED_BOOKS is None or _data_token() != LAST_MTIME:
+        with CACHE_LOCK.write(), DATA_LOCK:
+            _load_books_locked()
+    return CACHED_BOOKS
+
+@contextmanager
+def books_for_read():
+    """取得快取供查詢 (讀取鎖，可與其他查詢同時進行)"""
+    load_books()
+    with CACHE_LOCK.read():
+        yield CACHED_BOOKS
+
+@contextmanager
+def books_for_write():
+    """取得快取供修改 (讀取-修改-寫入期間持有寫入鎖與檔案鎖)"""
+    with CACHE_LOCK.write(), DATA_LOCK:
+        _load_books_locked()
+        yield CACHED_BOOKS
+
+def save_books(books, changes):
+    """
+    寫入一批 (op, book) 變更 (呼叫端須在 books_for_write 之內；只附加到寫入記錄，不重寫整份檔案)
+    寫入成功後才套用到快取；寫入失敗時拋出例外，快取不變
+    """
     global CACHED_BOOKS, LAST_MTIME
     
-    DATA_FILE.parent.mkdir(parents=True, exist_ok=True)
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(books, f, ensure_ascii=False, indent=2)
-        
-    # 更新快取
-    CACHED_BOOKS = books
-    if DATA_FILE.exists():
-        LAST_MTIME = DATA_FILE.stat().st_mtime
+    _, LAST_MTIME = STORAGE.apply_changes(changes)
+    CACHED_BOOKS = books.apply(changes)
+
+def request_json():
+    """請求內容 (JSON，同 asgi_server.read_json)，沒有內容時回傳 {}；格式錯誤時拋出 ValueError"""
+    body = request.get_data()
+    return (json_backend.loads(body) if body else None) or {}
+
+def publish_book_change(op, book, books):
+    """推播書籍變更 (附上快取版本)"""
+    EVENTS.publish('book', {'op': op, 'book': book, 'version': books.version, 'epoch': books.instance})
 
 # ========== API 路由 ==========
 
 @app.route('/api/books', methods=['GET'])
 def get_books():
-    """取得所有書籍"""
-    books = load_books()
-    return jsonify(books)
+    """
+    取得書籍
+    - 無查詢參數: 回傳所有書籍
+    - category / q / sort / limit / cursor: 回傳分頁結果 {books, total, next_cursor}
+    """
+    with books_for_read() as books:
+        def build():
+            if not any(param in request.args for param in QUERY_PARAMS):
+                # 同一版本只編碼/壓縮一次
+                return cached_json(books, 'books', books.all)
+            
+            try:
+                result = books.query(
+                    category=request.args.get('category') or None,
+                    q=request.args.get('q') or None,
+                    sort=request.args.get('sort', 'date_desc'),
+                    limit=request.args.get('limit', DEFAULT_LIMIT),
+                    cursor=request.args.get('cursor') or None
+                )
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            return jsonify(result)
+        
+        # 資料沒變時回傳 304
+        return conditional_json(books, build)
+
+@app.route('/api/search', methods=['GET'])
+def search_books():
+    """全文搜尋 (書名/作者/備註)，依相關度排序"""
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify({'books': [], 'total': 0})
+    with books_for_read() as books:
+        def build():
+            try:
+                result = books.search(
+                    q,
+                    limit=request.args.get('limit', 20),
+                    category=request.args.get('category') or None
+                )
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            return jsonify(result)
+        
+        return conditional_json(books, build)
+
+@app.route('/api/books/changes', methods=['GET'])
+def get_book_changes():
+    """
+    增量同步: since=上次取得的 version，epoch=上次取得的 epoch
+    回傳 {epoch, version, full, books, deleted}；epoch 不同或紀錄已被捨棄時 full=true 並回傳所有書籍
+    """
+    try:
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        return jsonify({'error': 'Invalid since'}), 400
+    with books_for_read() as books:
+        return jsonify(books.changes_since(since, request.args.get('epoch')))
+
+def _data_change_check():
+    """SSE 閒置時檢查: 其他 worker 修改了資料檔時通知客戶端重新同步"""
+    seen = [_data_token()]
+
+    def check():
+        token = _data_token()
+        if token == seen[0]:
+            return None
+        seen[0] = token
+        if token != LAST_MTIME:
+            return format_event('resync', {})
+        return None
+
+    return check
+
+@app.route('/api/events', methods=['GET'])
+def stream_events():
+    """即時推播 (Server-Sent Events): book / reload / resync 事件"""
+    subscriber = EVENTS.subscribe()
+    if subscriber is None:
+        return jsonify({'error': '連線數已達上限'}), 503
+    response = Response(
+        EVENTS.stream(subscriber, idle_check=_data_change_check()),
+        mimetype='text/event-stream'
+    )
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # 避免反向代理緩衝
+    return response
 
 @app.route('/api/books', methods=['POST'])
 def add_book():
     """新增書籍"""
-    data = request.json
-    books = load_books()
-    
-    new_id = max([b.get('id', 0) for b in books], default=-1) + 1
-    new_book = {
-        'id': new_id,
-        'title': data.get('title', ''),
-        'author': data.get('author', '未分類作者'),
-        'category': data.get('category', '新書-待借'),
-        'date': data.get('date', ''),
-        'note': data.get('note', '')
-    }
-    books.insert(0, new_book)
-    save_books(books)
+    try:
+        data = request_json()
+    except ValueError:
+        return jsonify({'error': 'Invalid JSON'}), 400
+    try:
+        new_book = build_book(None, data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    with books_for_write() as books:
+        new_book['id'] = books.next_id()
+        save_books(books, [('add', new_book)])
+        publish_book_change('add', new_book, books)
     
     return jsonify(new_book), 201
 
 @app.route('/api/books/<int:book_id>', methods=['PUT'])
 def update_book(book_id):
     """更新書籍"""
-    data = request.json
-    books = load_books()
-    
-    updated_book = None
-    for i, book in enumerate(books):
-        if book.get('id') == book_id:
-            books[i] = {
-                'id': book_id,
-                'title': data.get('title', book.get('title')),
-                'author': data.get('author', book.get('author')),
-                'category': data.get('category', book.get('category')),
-                'date': data.get('date', book.get('date', '')),
-                'note': data.get('note', book.get('note', ''))
-            }
-            updated_book = books[i]
-            break
+    try:
+        data = request_json()
+    except ValueError:
+        return jsonify({'error': 'Invalid JSON'}), 400
+    with books_for_write() as books:
+        book = books.get(book_id)
+        
+        if book:
+            try:
+                updated_book = build_book(book_id, data, base=book)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            save_books(books, [('update', updated_book)])
+            publish_book_change('update', updated_book, books)
+            return jsonify(updated_book)
+        else:
+            return jsonify({'error': '找不到書籍'}), 404
+
+@app.route('/api/books/batch', methods=['POST'])
+def batch_books():
+    """批次新增/修改/刪除 (整批驗證通過後一次寫入)"""
+    try:
+        data = request_json()
+    except ValueError:
+        return jsonify({'error': 'Invalid JSON'}), 400
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be an object'}), 400
+    with books_for_write() as books:
+        try:
+            changes, results, errors = books.plan_batch(data.get('operations'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if errors:
+            return jsonify({'error': '批次操作有誤，未套用任何變更', 'errors': errors}), 400
+        
+        if changes:
+            save_books(books, changes)
+        for op, book in changes:
+            publish_book_change(op, book, books)
+        version = books.version
     
-    if updated_book:
-        save_books(books)
-        return jsonify(updated_book)
-    else:
-        return jsonify({'error': '找不到書籍'}), 404
+    return jsonify({
+        'success': True,
+        'version': version,
+        'results': [{k: v for k, v in r.items() if k != 'old'} for r in results]
+    })
 
 @app.route('/api/books/<int:book_id>', methods=['DELETE'])
 def delete_book(book_id):
     """刪除書籍"""
-    books = load_books()
-    books = [b for b in books if b.get('id') != book_id]
-    save_books(books)
+    with books_for_write() as books:
+        book = books.get(book_id)
+        if book is not None:
+            deleted_book = book.to_dict()
+            save_books(books, [('delete', deleted_book)])
+            publish_book_change('delete', deleted_book, books)
     return jsonify({'success': True})
 
 @app.route('/api/export', methods=['GET'])
 def export_books():
-    """匯出 Excel 檔案 (JSON -> Excel)"""
+    """匯出書籍: format=xlsx (預設) / csv / jsonl；同一版本的檔案只產生一次"""
+    fmt = request.args.get('format', 'xlsx')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f'Unknown format: {fmt}'}), 400
     try:
-        books = load_books()
-        
-        # 分組
-        categorized = {cat: [] for cat in CATEGORIES}
-        for book in books:
-            cat = book.get('category', '新書-待借')
-            if cat in categorized:
-                categorized[cat].append(book)
-            else:
-                categorized['新書-待借'].append(book)
-
-        # 建立暫存檔
-        with tempfile.NamedTemporaryFile(suffix='.xlsx', delete=False) as tmp:
-            tmp_path = tmp.name
-            
-        # 寫入 Excel
-        with pd.ExcelWriter(tmp_path, engine='openpyxl') as writer:
-            for cat in CATEGORIES:
-                cat_books = categorized[cat]
-                if cat_books:
-                    df = pd.DataFrame([{
-                        '作者': b.get('author', '未分類作者'),
-                        '書名': b.get('title', ''),
-                        '到期日': b.get('date', ''),
-                        'ISBN': b.get('note', '')
-                    } for b in cat_books])
-                    df.to_excel(writer, sheet_name=cat, index=False)
-                else:
-                    pd.DataFrame(columns=['作者', '書名', '到期日', 'ISBN']).to_excel(writer, sheet_name=cat, index=False)
-        
-        return send_file(
-            tmp_path,
-            as_attachment=True,
-            download_name=f'library_books_{datetime.now().strftime("%Y%m%d")}.xlsx',
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
+        with books_for_read() as books:
+            def build():
+                response = Response(EXPORTS.get(books, fmt), mimetype=EXPORT_FORMATS[fmt])
+                filename = f'library_books_{datetime.now().strftime("%Y%m%d")}.{fmt}'
+                response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+                return response
 
+            return conditional_json(books, build)
     except Exception as e:
         print(f"Export error: {e}")
         return jsonify({'error': str(e)}), 500
@@ -172,10 +313,12 @@ def export_books():
 def force_reload():
     """強制重讀 (清除快取)"""
     global CACHED_BOOKS, LAST_MTIME
-    CACHED_BOOKS = None
-    LAST_MTIME = 0
-    books = load_books()
-    return jsonify({'message': 'Cache cleared', 'count': len(books)})
+    with CACHE_LOCK.write(), DATA_LOCK:
+        CACHED_BOOKS = None
+        LAST_MTIME = 0
+        _load_books_locked()
+        count = len(CACHED_BOOKS)
+    return jsonify({'message': 'Cache cleared', 'count': count})
 
 # ========== 靜態檔案路由 ==========
 
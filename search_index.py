@@ -0,0 +1,161 @@
+"""
+全文搜尋索引
+書名/作者/備註建立倒排索引:
+- 中文: 單字 + 相鄰兩字 (bigram)，查詢「哈利波特」= 哈利、利波、波特 都要出現
+- 英數: 以單字為單位，查詢的最後一個單字可做前綴比對 (harr -> harry)
+新增/修改/刪除書籍時只更新該書的索引項目。
+"""
+
+from bisect import bisect_left, insort
+import re
+import unicodedata
+
+# 欄位權重 (排序用)
+FIELDS = (('title', 1, 3.0), ('author', 2, 2.0), ('note', 4, 1.0))
+
+_TOKEN_RE = re.compile(
+    r'[㐀-䶿一-鿿豈-﫿\U00020000-\U0003ffff]+|[0-9a-z]+'
+)
+
+
+def normalize(text):
+    return unicodedata.normalize('NFKC', text or '').lower()
+
+
+def tokenize(text):
+    """回傳 [(token, 是否為英數字)]"""
+    tokens = []
+    for run in _TOKEN_RE.findall(normalize(text)):
+        if run[0].isascii():
+            tokens.append((run, True))
+            continue
+        tokens.extend((c, False) for c in run)
+        tokens.extend((run[i:i + 2], False) for i in range(len(run) - 1))
+    return tokens
+
+
+def _query_tokens(text):
+    """查詢字串的 token: 中文只用 bigram (單字查詢才用單字)"""
+    tokens = []
+    for run in _TOKEN_RE.findall(normalize(text)):
+        if run[0].isascii():
+            tokens.append((run, True))
+        elif len(run) == 1:
+            tokens.append((run, False))
+        else:
+            tokens.extend((run[i:i + 2], False) for i in range(len(run) - 1))
+    return tokens
+
+
+class SearchIndex:
+    """倒排索引: token -> {book id: 欄位遮罩}"""
+
+    def __init__(self, books=()):
+        self._postings = {}
+        self._doc_tokens = {}   # book id -> set(token)，刪除/修改時使用
+        self._latin_terms = []  # 排序好的英數 token (前綴比對用)
+        for book in books:
+            self.add(book)
+
+    def __len__(self):
+        return len(self._doc_tokens)
+
+    def add(self, book):
+        book_id = book['id']
+        if book_id in self._doc_tokens:
+            self.remove(book_id)
+        tokens = set()
+        for field, mask, _ in FIELDS:
+            for token, is_latin in tokenize(book.get(field)):
+                posting = self._postings.get(token)
+                if posting is None:
+                    posting = self._postings[token] = {}
+                    if is_latin:
+                        insort(self._latin_terms, token)
+                posting[book_id] = posting.get(book_id, 0) | mask
+                tokens.add(token)
+        self._doc_tokens[book_id] = tokens
+
+    def remove(self, book_id):
+        for token in self._doc_tokens.pop(book_id, ()):
+            posting = self._postings.get(token)
+            if posting is None:
+                continue
+            posting.pop(book_id, None)
+            if not posting:
+                del self._postings[token]
+                if token.isascii():
+                    i = bisect_left(self._latin_terms, token)
+                    if i < len(self._latin_terms) and self._latin_terms[i] == token:
+                        del self._latin_terms[i]
+
+    def update(self, book):
+        self.add(book)
+
+    def _prefix_postings(self, prefix):
+        """合併所有以 prefix 開頭的英數 token"""
+        merged = {}
+        terms = self._latin_terms
+        i = bisect_left(terms, prefix)
+        while i < len(terms) and terms[i].startswith(prefix):
+            for book_id, mask in self._postings[terms[i]].items():
+                merged[book_id] = merged.get(book_id, 0) | mask
+            i += 1
+        return merged
+
+    def match(self, query):
+        """
+        回傳 {book id: 分數}；所有 token 都要出現 (AND)
+        查詢沒有可索引的字元時回傳 None (由呼叫端改用逐筆比對)
+        """
+        tokens = _query_tokens(query)
+        if not tokens:
+            return None
+
+        postings = []
+        last = len(tokens) - 1
+        for i, (token, is_latin) in enumerate(tokens):
+            if is_latin and i == last:
+                posting = self._prefix_postings(token)
+            else:
+                posting = self._postings.get(token, {})
+            if not posting:
+                return {}
+            postings.append(posting)
+
+        # 從最短的 posting 開始取交集
+        postings.sort(key=len)
+        scores = {}
+        for book_id in postings[0]:
+            score = 0.0
+            for posting in postings:
+                mask = posting.get(book_id)
+                if mask is None:
+                    break
+                score += max(weight for _, bit, weight in FIELDS if mask & bit)
+            else:
+                scores[book_id] = score
+        return scores
+
+    def search(self, books, query, limit=20, category=None):
+        """
+        排序後的搜尋結果 [(分數, book)]
+        books 為 id -> book，完整出現查詢字串的書名/作者另外加分
+        """
+        scores = self.match(query)
+        if not scores:
+            return [], 0
+        needle = normalize(query).strip()
+        ranked = []
+        for book_id, score in scores.items():
+            book = books[book_id]
+            if category and book.get('category') != category:
+                continue
+            title = normalize(book.get('title'))
+            if needle and needle in title:
+                score += 5.0 + (5.0 if title.startswith(needle) else 0.0)
+            elif needle and needle in normalize(book.get('author')):
+                score += 4.0
+            ranked.append((score, book))
+        ranked.sort(key=lambda item: (-item[0], -item[1]['id']))
+        return ranked[:limit], len(ranked)
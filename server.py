@@ -1,16 +1,34 @@
 """
 圖書館借書管理系統 - Python 後端 API
-直接讀寫 Excel 檔案，提供 RESTful API 給前端使用
+資料存放於 SQLite (預設) 或 Excel，提供 RESTful API 給前端使用
+Excel 檔案作為匯入/匯出格式
 """
 
-from flask import Flask, jsonify, request, send_file
+from flask import Flask, Response, jsonify, request, send_file, send_from_directory
 from flask_cors import CORS
-import pandas as pd
 import os
 from datetime import datetime
+from contextlib import contextmanager
+import atexit
 import logging
 import traceback
 
+from excel_io import read_workbook_cached
+from storage import create_storage
+from book_cache import DEFAULT_LIMIT, BookCache, build_book
+from book_export import FORMATS as EXPORT_FORMATS, ExportCache
+from activity_log import (
+    DEFAULT_LIMIT as ACTIVITY_DEFAULT_LIMIT, ActivityJournal, activity_stats, build_activity,
+    build_batch_activity, parse_day
+)
+from backup import BackupScheduler
+from backup_store import BackupStore
+from events import EventBroker, format_event
+from http_cache import cached_json, conditional_json, init_app as init_http_cache
+from locks import FileLock, RWLock
+from write_queue import WriteBehindQueue
+import json_backend
+
 # 設定 Logging
 logging.basicConfig(
     level=logging.INFO,
@@ -24,12 +42,19 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__, static_folder='static', static_url_path='')
 CORS(app)  # 允許跨域請求
+init_http_cache(app)  # 回應壓縮 (gzip/brotli)
 
 # Excel 檔案路徑
 EXCEL_FILE = os.path.join(os.path.dirname(__file__), '圖書館借書清單.xlsx')
 LAST_MTIME = 0
 CACHED_BOOKS = None
 
+# 快取的讀寫鎖: 查詢可同時進行，修改/重讀時獨佔
+CACHE_LOCK = RWLock()
+
+# 跨行程的修改鎖: 多個 gunicorn worker 的讀取-修改-寫入依序進行
+WRITE_LOCK = FileLock(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'library.write.lock'))
+
 # 分類對應的工作表名稱
 CATEGORIES = [
     '新書-待借',
@@ -42,336 +67,199 @@ CATEGORIES = [
     '未到館'
 ]
 
-# 活動記錄 (今日交易明細) - 持久化到檔案
-ACTIVITY_LOG = []
-ACTIVITY_LOG_FILE = os.path.join(os.path.dirname(__file__), 'activity_log.json')
-
-def load_activity_log():
-    """從檔案載入活動記錄"""
-    global ACTIVITY_LOG
-    try:
-        if os.path.exists(ACTIVITY_LOG_FILE):
-            with open(ACTIVITY_LOG_FILE, 'r', encoding='utf-8') as f:
-                import json
-                ACTIVITY_LOG = json.load(f)
-                logger.info(f"Loaded {len(ACTIVITY_LOG)} activities from file")
-        else:
-            ACTIVITY_LOG = []
-    except Exception as e:
-        logger.error(f"Error loading activity log: {e}")
-        ACTIVITY_LOG = []
+# 匯出檔案快取 (依資料版本)
+EXPORTS = ExportCache(CATEGORIES)
+
+# 儲存後端: 'sqlite' (預設)、'excel' (直接讀寫 Excel，舊行為) 或 'json' (data/books.json + 寫入記錄)
+STORAGE_BACKEND = os.environ.get('LIBRARY_STORAGE', 'sqlite')
+DB_FILE = os.path.join(os.path.dirname(__file__), 'library.db')
+JSON_FILE = os.path.join(os.path.dirname(__file__), 'data', 'books.json')
+BACKUP_DIR = os.path.join(os.path.dirname(__file__), 'backups')
+STORAGE = create_storage(STORAGE_BACKEND, EXCEL_FILE, CATEGORIES, db_file=DB_FILE, json_file=JSON_FILE)
+
+# 背景備份: 每 N 分鐘或累積 N 筆變更備份一次，分層保留 (小時/天/週)
+BACKUP_INTERVAL_MIN = float(os.environ.get('LIBRARY_BACKUP_INTERVAL_MIN', 10))
+BACKUP_MAX_CHANGES = int(os.environ.get('LIBRARY_BACKUP_MAX_CHANGES', 50))
+# store: 寫入備份庫 backups/store/ (只保存有變更的區塊)；file: 每次備份整份資料為 backups/備份_*.gz
+BACKUP_FORMAT = os.environ.get('LIBRARY_BACKUP_FORMAT', 'store')
+
+# 寫入佇列: 變更先寫入 journal，每 N 毫秒或 N 筆合併寫入一次
+WRITE_JOURNAL_DIR = os.path.dirname(os.path.abspath(__file__))
+FLUSH_INTERVAL_MS = int(os.environ.get('LIBRARY_FLUSH_INTERVAL_MS', 500))
+FLUSH_MAX_OPS = int(os.environ.get('LIBRARY_FLUSH_MAX_OPS', 50))
+
+# 即時推播 (SSE): 每個客戶端的緩衝上限、連線數上限與 heartbeat 間隔 (秒)
+EVENTS = EventBroker(
+    max_buffer=int(os.environ.get('LIBRARY_SSE_BUFFER', 100)),
+    max_clients=int(os.environ.get('LIBRARY_SSE_MAX_CLIENTS', 50)),
+    heartbeat=float(os.environ.get('LIBRARY_SSE_HEARTBEAT', 15))
+)
 
-def save_activity_log():
-    """儲存活動記錄到檔案"""
+# GET /api/books 的查詢參數 (有任一參數時回傳分頁結果)
+QUERY_PARAMS = ('category', 'q', 'sort', 'limit', 'cursor')
+
+# 活動記錄 (交易明細) - 每天一個附加式記錄檔
+# GET /api/activities 的歷史查詢參數 (有任一參數時回傳歷史記錄分頁結果)
+ACTIVITY_QUERY_PARAMS = ('from', 'to', 'action', 'book_id', 'cursor')
+ACTIVITY_DIR = os.path.join(os.path.dirname(__file__), 'activities')
+ACTIVITY_LOG_FILE = os.path.join(os.path.dirname(__file__), 'activity_log.json')  # 舊版格式
+ACTIVITIES = ActivityJournal(ACTIVITY_DIR)
+try:
+    ACTIVITIES.migrate(ACTIVITY_LOG_FILE)
+except Exception as e:
+    logger.error(f"Error migrating activity log: {e}")
+
+def log_activity(activity):
+    """寫入活動記錄並推播"""
     try:
-        with open(ACTIVITY_LOG_FILE, 'w', encoding='utf-8') as f:
-            import json
-            json.dump(ACTIVITY_LOG, f, ensure_ascii=False, indent=2)
-        logger.info(f"Saved {len(ACTIVITY_LOG)} activities to file")
+        activity = ACTIVITIES.append(activity)  # 💾 附加到今日的記錄檔
     except Exception as e:
         logger.error(f"Error saving activity log: {e}")
-
-def is_valid_date(date_str):
-    """檢查字串是否為有效日期格式"""
-    import re
-    # 常見日期格式: YYYY-MM-DD, YYYY/MM/DD, MM/DD, DD/MM/YYYY 等
-    date_patterns = [
-        r'^\d{4}-\d{1,2}-\d{1,2}$',  # 2024-01-30
-        r'^\d{4}/\d{1,2}/\d{1,2}$',  # 2024/01/30
-        r'^\d{1,2}/\d{1,2}/\d{4}$',  # 01/30/2024
-        r'^\d{1,2}/\d{1,2}$',        # 01/30 (沒有年份)
-        r'^\d{1,2}-\d{1,2}$',        # 01-30 (沒有年份)
-    ]
-    for pattern in date_patterns:
-        if re.match(pattern, date_str):
-            return True
-    return False
-
+    logger.info(f"Activity logged: {activity['action']} - {activity.get('book_title') or 'Unknown'}")
+    EVENTS.publish('activity', activity)
+    return activity
 
 def add_activity(action, book_data, old_data=None):
     """記錄活動到日誌"""
-    global ACTIVITY_LOG
-    
-    today = datetime.now().strftime('%Y-%m-%d')
-    
-    # 清理非今日的記錄 (只保留今日)
-    ACTIVITY_LOG = [a for a in ACTIVITY_LOG if a.get('date', '').startswith(today)]
-    
-    activity = {
-        'id': len(ACTIVITY_LOG) + 1,
-        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        'date': datetime.now().strftime('%Y-%m-%d'),
-        'time': datetime.now().strftime('%H:%M:%S'),
-        'action': action,  # 'add', 'edit', 'delete', 'category_change'
-        'book_id': book_data.get('id'),
-        'book_title': book_data.get('title', ''),
-        'book_author': book_data.get('author', ''),
-        'book_category': book_data.get('category', ''),
-        'old_category': old_data.get('category', '') if old_data else None,
-        'details': {}
-    }
-    
-    # 記錄變更細節
-    if action == 'edit' and old_data:
-        changes = []
-        for key in ['title', 'author', 'date', 'note', 'category']:
-            old_val = old_data.get(key, '')
-            new_val = book_data.get(key, '')
-            if old_val != new_val:
-                changes.append({
-                    'field': key,
-                    'old': old_val,
-                    'new': new_val
-                })
-        activity['details']['changes'] = changes
-    elif action == 'category_change' and old_data:
-        activity['details']['old_category'] = old_data.get('category', '')
-        activity['details']['new_category'] = book_data.get('category', '')
-    
-    ACTIVITY_LOG.insert(0, activity)  # 最新的在最前面
-    save_activity_log()  # 💾 儲存到檔案
-    logger.info(f"Activity logged: {action} - {book_data.get('title', 'Unknown')}")
-    
-    return activity
+    return log_activity(build_activity(action, book_data, old_data))
 
-def read_all_books():
-    """從 Excel 讀取所有書籍 (含快取機制) - Optimized"""
+def add_batch_activity(results):
+    """批次操作記錄為一筆活動"""
+    return log_activity(build_batch_activity(results))
+
+def _cache_is_fresh():
+    return CACHED_BOOKS is not None and STORAGE.change_token() == LAST_MTIME
+
+def _reload_cache():
+    """從儲存後端重讀 (呼叫端須持有 CACHE_LOCK 寫入鎖)"""
     global LAST_MTIME, CACHED_BOOKS
     
     try:
-        # 檢查檔案是否存在
-        if not os.path.exists(EXCEL_FILE):
-             logger.error(f"Error: 找不到檔案 {EXCEL_FILE}")
-             return []
-
-        # Check file modification time
-        current_mtime = os.path.getmtime(EXCEL_FILE)
-        
-        # 如果有快取且檔案沒變，直接回傳快取
-        if CACHED_BOOKS is not None and current_mtime == LAST_MTIME:
-            return CACHED_BOOKS
-
-        print(f"Reading Excel file: {EXCEL_FILE}...")
-        books = []
-        xls = pd.ExcelFile(EXCEL_FILE)
-        book_id = 0
-        
-        for sheet_name in xls.sheet_names:
-            if sheet_name not in CATEGORIES:
-                continue
-                
-            df = pd.read_excel(xls, sheet_name=sheet_name)
-            
-            # 嘗試找出作者和書名欄位
-            cols = df.columns.tolist()
-            has_author = '作者' in cols
-            has_title = '書名' in cols
-            
-            # 如果沒有標準欄位，嘗試處理無標題或錯位的情況
-            if not (has_author and has_title):
-                 # 嘗試重新讀取 header=None (為了相容舊邏輯，雖然有點沒效率，但只針對格式錯誤的 sheet)
-                 # 簡單檢查：如果第一列看起來像標題
-                 is_header_row = False
-                 if len(df) > 0:
-                     # 檢查 DataFrame 的第一列是否包含 '作者' 或 '書名'
-                     # 這裡簡化處理：如果找不到標準欄位，就假設它是 raw data，重新整理
-                     # 為了保持高效，我們直接操作 df.values 或重讀
-                     # 考慮到這種情況很少，我們可以用舊的 fallback 邏輯，或者直接假設欄位位置
-                     
-                     # 這裡為了效能，我們直接依欄位位置判斷
-                     pass
-
-            # 統一欄位名稱以便處理
-            target_df = df.copy()
-            
-            # 定義欄位映射 (優先使用名稱，否則使用位置)
-            col_map = {}
-            
-            if '書名' in cols: col_map['title'] = '書名'
-            elif len(cols) > 1: col_map['title'] = cols[1]
-            else: col_map['title'] = None
-            
-            if '作者' in cols: col_map['author'] = '作者'
-            elif len(cols) > 0: col_map['author'] = cols[0]
-            else: col_map['author'] = None
-            
-            if '到期日' in cols: col_map['date'] = '到期日'
-            elif len(cols) > 2: col_map['date'] = cols[2]
-            else: col_map['date'] = None
-            
-            if 'ISBN' in cols: col_map['note'] = 'ISBN'
-            elif len(cols) > 3: col_map['note'] = cols[3]
-            else: col_map['note'] = None
-
-            if not col_map['title']: continue # 無法識別書名，跳過
+        # 資料版本沒變 (其他執行緒已經重讀過)，不需重讀
+        if CACHED_BOOKS is not None and STORAGE.change_token() == LAST_MTIME:
+            return
 
-            # 轉為字典列表，速度遠快於 iterrows
-            records = target_df.to_dict('records')
-            
-            for row in records:
-                # 取得原始值
-                r_title = row.get(col_map['title'])
-                r_author = row.get(col_map['author'])
-                r_date = row.get(col_map['date'])
-                r_note = row.get(col_map['note'])
-                
-                # 處理標題 (過濾掉標題行或空行)
-                title = str(r_title).strip() if pd.notna(r_title) else ''
-                if not title or title == '書名': continue
-                
-                author = str(r_author).strip() if pd.notna(r_author) else '未分類作者'
-                if author == '作者': author = '未分類作者' # 防止標題行被誤讀
-                
-                # 處理日期
-                date = str(r_date).strip() if pd.notna(r_date) else ''
-                if ' ' in date: date = date.split(' ')[0]
-                if date == '到期日': date = ''
-                
-                # 處理備註
-                note = str(r_note).strip() if pd.notna(r_note) else ''
-                if note == 'ISBN': note = ''
-                
-                # 🔧 自動修正：檢查「到期日」欄位是否被誤填為借閱人名稱
-                # 如果 date 不是日期格式（非 YYYY-MM-DD 或類似格式），就當作備註處理
-                if date and not is_valid_date(date):
-                    # 如果 note 是空的，就把錯誤的日期移過去
-                    if not note:
-                        note = date
-                    date = ''  # 清空日期欄位
-
-                books.append({
-                    'id': book_id,
-                    'title': title,
-                    'author': author if author else '未分類作者',
-                    'category': sheet_name,
-                    'date': date,
-                    'note': note
-                })
-                book_id += 1
+        logger.info(f"Loading books from {STORAGE.name} storage...")
+        # 建立 id 索引，並補上尚未寫入儲存後端的變更 (版本、資料與佇列在 flush 之間一起讀取)
+        (current_token, loaded), pending = WRITE_QUEUE.load_with_pending(
+            lambda: (STORAGE.change_token(), STORAGE.load_books())
+        )
+        books = BookCache(loaded, id_source=STORAGE.allocate_id).apply(pending)
                         
         # 更新快取
         CACHED_BOOKS = books
-        LAST_MTIME = current_mtime
+        LAST_MTIME = current_token
         logger.info(f"Read {len(books)} books. Updated cache.")
-        return books
+        publish_reload(books)
         
     except Exception as e:
-        logger.error(f"讀取 Excel 錯誤: {e}")
+        logger.error(f"讀取書籍錯誤: {e}")
         logger.error(traceback.format_exc())
-        return CACHED_BOOKS if CACHED_BOOKS is not None else []
+        if CACHED_BOOKS is None:
+            CACHED_BOOKS = BookCache(id_source=STORAGE.allocate_id)
 
-def backup_excel():
-    """自動備份 Excel 檔案"""
+def read_all_books():
+    """從儲存後端讀取所有書籍 (含快取機制)；資料被其他行程修改過時重讀"""
+    if not _cache_is_fresh():
+        with CACHE_LOCK.write():
+            _reload_cache()
+    return CACHED_BOOKS
+
+@contextmanager
+def books_for_read():
+    """取得快取供查詢 (讀取鎖，可與其他查詢同時進行)"""
+    read_all_books()
+    with CACHE_LOCK.read():
+        yield CACHED_BOOKS
+
+@contextmanager
+def books_for_write():
+    """
+    取得快取供修改 (讀取-修改-寫入期間獨佔)
+    先取得跨行程的 WRITE_LOCK 再確認快取是最新的 (其他 worker 已寫入儲存後端的修改會先重讀)；
+    新書 id 由儲存後端配發，各 worker 不會重複。變更仍交給背景寫入 (不在每次請求時 flush)，
+    其他 worker 在下一次 flush (LIBRARY_FLUSH_INTERVAL_MS) 之後才看得到
+    """
+    with WRITE_LOCK:
+        with CACHE_LOCK.write():
+            if not _cache_is_fresh():
+                _reload_cache()
+            yield CACHED_BOOKS
+
+def request_json():
+    """請求內容 (JSON，同 asgi_server.read_json)，沒有內容時回傳 {}；格式錯誤時拋出 ValueError"""
+    body = request.get_data()
+    return (json_backend.loads(body) if body else None) or {}
+
+def publish_book_change(op, book, books):
+    """推播書籍變更 (附上快取版本，客戶端可據此判斷是否需要 /api/books/changes 同步)"""
+    EVENTS.publish('book', {'op': op, 'book': book, 'version': books.version, 'epoch': books.instance})
+
+def publish_reload(books):
+    """快取重建 (重讀/匯入)，客戶端需重新取得全部資料"""
+    EVENTS.publish('reload', {'version': books.version, 'epoch': books.instance})
+
+def persist_changes(changes):
+    """將一批 (op, book) 變更排入寫入佇列 (寫入 journal 後即回傳)"""
     try:
-        if not os.path.exists(EXCEL_FILE):
-            return
-        
-        # 建立備份資料夾
-        backup_dir = os.path.join(os.path.dirname(__file__), 'backups')
-        os.makedirs(backup_dir, exist_ok=True)
-        
-        # 備份檔名包含時間戳記
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        backup_file = os.path.join(backup_dir, f'備份_{timestamp}.xlsx')
-        
-        import shutil
-        shutil.copy2(EXCEL_FILE, backup_file)
-        logger.info(f"Auto backup created: {backup_file}")
-        
-        # 只保留最近 10 份備份
-        backups = sorted([f for f in os.listdir(backup_dir) if f.endswith('.xlsx')])
-        while len(backups) > 10:
-            oldest = backups.pop(0)
-            os.remove(os.path.join(backup_dir, oldest))
-            logger.info(f"Removed old backup: {oldest}")
-            
+        WRITE_QUEUE.submit(changes)
+        BACKUPS.notify(len(changes))
+        return True
     except Exception as e:
-        logger.error(f"Backup error: {e}")
+        logger.error(f"寫入書籍錯誤: {e}")
+        logger.error(traceback.format_exc())
+        return False
+
+def on_storage_flushed(before_token, after_token):
+    """
+    寫入佇列寫入完成後同步版本，避免自己的寫入觸發重讀
+    寫入前的版本與快取不同，表示其他行程也修改過資料，保留舊版本讓下次讀取時重讀
+    """
+    global LAST_MTIME
+    with CACHE_LOCK.write():
+        if LAST_MTIME == before_token:
+            LAST_MTIME = after_token
+
+WRITE_QUEUE = WriteBehindQueue(
+    STORAGE,
+    WRITE_JOURNAL_DIR,
+    flush_interval=FLUSH_INTERVAL_MS / 1000,
+    max_pending=FLUSH_MAX_OPS,
+    on_flush=on_storage_flushed
+)
+WRITE_QUEUE.start()
+atexit.register(WRITE_QUEUE.stop)
+
+BACKUPS = BackupScheduler(
+    STORAGE,
+    BACKUP_DIR,
+    interval=BACKUP_INTERVAL_MIN * 60,
+    max_changes=BACKUP_MAX_CHANGES,
+    hourly=int(os.environ.get('LIBRARY_BACKUP_KEEP_HOURLY', 24)),
+    daily=int(os.environ.get('LIBRARY_BACKUP_KEEP_DAILY', 30)),
+    weekly=int(os.environ.get('LIBRARY_BACKUP_KEEP_WEEKLY', 12)),
+    before_snapshot=WRITE_QUEUE.flush,
+    store=BackupStore(os.path.join(BACKUP_DIR, 'store')) if BACKUP_FORMAT == 'store' else None
+)
+BACKUPS.start()
+atexit.register(BACKUPS.stop)
 
 def save_all_books(books):
-    """將所有書籍寫回 Excel (Smart Update)"""
+    """以整份書單取代儲存後端的資料 (匯入用)"""
     global CACHED_BOOKS, LAST_MTIME
     try:
-        # 💾 儲存前自動備份
-        backup_excel()
-        
-        # 按分類分組 (New State)
-        categorized = {cat: [] for cat in CATEGORIES}
-        for book in books:
-            cat = book.get('category', '新書-待借')
-            if cat in categorized:
-                categorized[cat].append(book)
-            else:
-                categorized['新書-待借'].append(book)
-        
-        # 判斷哪些工作表有變更
-        changed_sheets = []
-        
-        # Group Old State (from Cache)
-        if CACHED_BOOKS:
-            old_categorized = {cat: [] for cat in CATEGORIES}
-            for book in CACHED_BOOKS:
-                cat = book.get('category', '新書-待借')
-                if cat in old_categorized:
-                    old_categorized[cat].append(book)
-                else:
-                    old_categorized['新書-待借'].append(book)
-            
-            # Compare
-            for cat in CATEGORIES:
-                if categorized[cat] != old_categorized[cat]:
-                    changed_sheets.append(cat)
-        else:
-            # No cache, assume all changed (or first run)
-            changed_sheets = list(CATEGORIES)
-
-        if not changed_sheets and os.path.exists(EXCEL_FILE):
-             logger.info("No changes detected. Skip saving.")
-             return True
-
-        # 設定寫入模式
-        mode = 'a'
-        if_sheet_exists = 'replace'
-        
-        # 如果檔案不存在，必須用 'w' 模式寫入所有工作表
-        if not os.path.exists(EXCEL_FILE):
-            mode = 'w'
-            if_sheet_exists = None
-            changed_sheets = list(CATEGORIES) # Write all
-            logger.info("File not found, creating new file (write all sheets).")
-        else:
-            logger.info(f"Updating sheets: {changed_sheets}")
-
-        # 準備寫入參數
-        kwargs = {'engine': 'openpyxl', 'mode': mode}
-        if mode == 'a':
-            kwargs['if_sheet_exists'] = if_sheet_exists
-            
-        with pd.ExcelWriter(EXCEL_FILE, **kwargs) as writer:
-            for cat in changed_sheets:
-                cat_books = categorized[cat]
-                if cat_books:
-                    df = pd.DataFrame([{
-                        '作者': b.get('author', '未分類作者'),
-                        '書名': b.get('title', ''),
-                        '到期日': b.get('date', ''),
-                        'ISBN': b.get('note', '')
-                    } for b in cat_books])
-                    df.to_excel(writer, sheet_name=cat, index=False)
-                else:
-                    # 寫入空的工作表以保留結構
-                    pd.DataFrame(columns=['作者', '書名', '到期日', 'ISBN']).to_excel(writer, sheet_name=cat, index=False)
-                    
-        # 更新快取
-        CACHED_BOOKS = books
-        # Update mtime to prevent immediate re-read
-        if os.path.exists(EXCEL_FILE):
-             LAST_MTIME = os.path.getmtime(EXCEL_FILE)
-        
-        logger.info("Successfully saved books to Excel.")
+        with WRITE_LOCK:
+            # 先寫入佇列中已確認的變更，再整份取代
+            WRITE_QUEUE.flush()
+            BACKUPS.run_once(force=True)  # 整份取代前保留目前的資料
+            with CACHE_LOCK.write():
+                _, LAST_MTIME = STORAGE.replace_all(books)
+                CACHED_BOOKS = BookCache(books, id_source=STORAGE.allocate_id)
+                publish_reload(CACHED_BOOKS)
+        logger.info(f"Successfully saved {len(books)} books.")
         return True
     except Exception as e:
-        logger.error(f"寫入 Excel 錯誤: {e}")
+        logger.error(f"寫入書籍錯誤: {e}")
         logger.error(traceback.format_exc())
         return False
 
@@ -387,49 +275,93 @@ def serve_assets(path):
 
 @app.route('/api/books', methods=['GET'])
 def get_books():
-    """取得所有書籍"""
-    books = read_all_books()
-    
-    # 預設依日期排序 (最新在先)
+    """
+    取得書籍
+    - 無查詢參數: 回傳所有書籍 (依日期排序，最新在先)
+    - category / q / sort / limit / cursor: 回傳分頁結果 {books, total, next_cursor}
+    """
+    with books_for_read() as books:
+        def build():
+            if not any(param in request.args for param in QUERY_PARAMS):
+                # 同一版本只排序/編碼/壓縮一次
+                return cached_json(books, 'books', lambda: books.sorted('date_desc'))
+            
+            try:
+                result = books.query(
+                    category=request.args.get('category') or None,
+                    q=request.args.get('q') or None,
+                    sort=request.args.get('sort', 'date_desc'),
+                    limit=request.args.get('limit', DEFAULT_LIMIT),
+                    cursor=request.args.get('cursor') or None
+                )
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            return jsonify(result)
+        
+        # 資料沒變時回傳 304
+        return conditional_json(books, build)
+
+@app.route('/api/search', methods=['GET'])
+def search_books():
+    """全文搜尋 (書名/作者/備註)，依相關度排序"""
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify({'books': [], 'total': 0})
+    with books_for_read() as books:
+        def build():
+            try:
+                result = books.search(
+                    q,
+                    limit=request.args.get('limit', 20),
+                    category=request.args.get('category') or None
+                )
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            return jsonify(result)
+        
+        return conditional_json(books, build)
+
+@app.route('/api/books/changes', methods=['GET'])
+def get_book_changes():
+    """
+    增量同步: since=上次取得的 version，epoch=上次取得的 epoch
+    回傳 {epoch, version, full, books, deleted}；epoch 不同或紀錄已被捨棄時 full=true 並回傳所有書籍
+    """
     try:
-        books.sort(key=lambda x: str(x.get('date', '') if x.get('date') else ''), reverse=True)
-    except Exception as e:
-        logger.error(f"Sorting error: {e}")
-
-    return jsonify(books)
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        return jsonify({'error': 'Invalid since'}), 400
+    with books_for_read() as books:
+        return jsonify(books.changes_since(since, request.args.get('epoch')))
 
 @app.route('/api/books', methods=['POST'])
 def add_book():
     """新增書籍"""
     try:
-        data = request.json
-        logger.info(f"Adding new book: {data.get('title', 'Unknown')}")
-        
-        current_books = read_all_books()
-        # Create a copy to avoid modifying cache before save success
-        books = list(current_books)
-        
-        new_id = max([b['id'] for b in books], default=-1) + 1
-        new_book = {
-            'id': new_id,
-            'title': data.get('title', ''),
-            'author': data.get('author', '未分類作者'),
-            'category': data.get('category', '新書-待借'),
-            'date': data.get('date', ''),
-            'note': data.get('note', '')
-        }
+        try:
+            data = request_json()
+        except ValueError:
+            return jsonify({'error': 'Invalid JSON'}), 400
+        try:
+            new_book = build_book(None, data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        logger.info(f"Adding new book: {new_book['title'] or 'Unknown'}")
         
-        # Insert at the beginning
-        books.insert(0, new_book)
+        with books_for_write() as books:
+            new_id = new_book['id'] = books.next_id()
+            
+            if not persist_changes([('add', new_book)]):
+                logger.error("Failed to save book")
+                return jsonify({'error': '儲存失敗'}), 500
+            # 儲存成功後才更新快取
+            books.add(new_book)
+            publish_book_change('add', new_book, books)
         
-        if save_all_books(books):
-            # 記錄活動
-            add_activity('add', new_book)
-            logger.info(f"Book added successfully: ID {new_id}")
-            return jsonify(new_book), 201
-        else:
-            logger.error("Failed to save book to Excel")
-            return jsonify({'error': '儲存失敗'}), 500
+        # 記錄活動
+        add_activity('add', new_book)
+        logger.info(f"Book added successfully: ID {new_id}")
+        return jsonify(new_book), 201
             
     except Exception as e:
         logger.error(f"Error in add_book: {e}")
@@ -439,133 +371,235 @@ def add_book():
 @app.route('/api/books/<int:book_id>', methods=['PUT'])
 def update_book(book_id):
     """更新書籍"""
-    data = request.json
-    books = read_all_books()
-    old_book = None
-    updated_book = None
-    
-    for i, book in enumerate(books):
-        if book['id'] == book_id:
-            old_book = book.copy()  # 保存舊資料
-            books[i] = {
-                'id': book_id,
-                'title': data.get('title', book['title']),
-                'author': data.get('author', book['author']),
-                'category': data.get('category', book['category']),
-                'date': data.get('date', book.get('date', '')),
-                'note': data.get('note', book.get('note', ''))
-            }
-            updated_book = books[i]
-            break
+    try:
+        data = request_json()
+    except ValueError:
+        return jsonify({'error': 'Invalid JSON'}), 400
+    with books_for_write() as books:
+        if book_id not in books:
+            return jsonify({'error': '找不到書籍'}), 404
+        
+        old_book = books.get(book_id).copy()  # 保存舊資料
+        try:
+            updated_book = build_book(book_id, data, base=old_book)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        if not persist_changes([('update', updated_book)]):
+            return jsonify({'error': '儲存失敗'}), 500
+        books.update(updated_book)
+        publish_book_change('update', updated_book, books)
     
-    if save_all_books(books):
-        # 判斷編輯類型
-        if old_book and updated_book:
-            if old_book.get('category') != updated_book.get('category'):
-                add_activity('category_change', updated_book, old_book)
-            else:
-                add_activity('edit', updated_book, old_book)
-        return jsonify(updated_book)
+    # 判斷編輯類型
+    if old_book.get('category') != updated_book.get('category'):
+        add_activity('category_change', updated_book, old_book)
     else:
-        return jsonify({'error': '儲存失敗'}), 500
+        add_activity('edit', updated_book, old_book)
+    return jsonify(updated_book)
+
+@app.route('/api/books/batch', methods=['POST'])
+def batch_books():
+    """
+    批次新增/修改/刪除: {"operations": [{"op": "add"|"update"|"delete", "id": ..., "book": {...}}]}
+    整批驗證通過後一次寫入 (任何一筆有誤時全部不套用)，並記錄為一筆活動
+    """
+    try:
+        data = request_json()
+    except ValueError:
+        return jsonify({'error': 'Invalid JSON'}), 400
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be an object'}), 400
+    with books_for_write() as books:
+        try:
+            changes, results, errors = books.plan_batch(data.get('operations'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if errors:
+            return jsonify({'error': '批次操作有誤，未套用任何變更', 'errors': errors}), 400
+        
+        if changes and not persist_changes(changes):
+            return jsonify({'error': '儲存失敗'}), 500
+        for op, book in changes:
+            if op == 'add':
+                books.add(book)
+            elif op == 'update':
+                books.update(book)
+            else:
+                books.remove(book['id'])
+            publish_book_change(op, book, books)
+        version = books.version
+    
+    if changes:
+        add_batch_activity(results)
+    return jsonify({
+        'success': True,
+        'version': version,
+        'results': [{k: v for k, v in r.items() if k != 'old'} for r in results]
+    })
 
 @app.route('/api/books/<int:book_id>', methods=['DELETE'])
 def delete_book(book_id):
     """刪除書籍"""
-    books = read_all_books()
-    deleted_book = None
-    
-    # 先找到要刪除的書
-    for b in books:
-        if b['id'] == book_id:
-            deleted_book = b.copy()
-            break
-    
-    books = [b for b in books if b['id'] != book_id]
+    with books_for_write() as books:
+        if book_id not in books:
+            return jsonify({'success': True})
+        
+        deleted_book = books.get(book_id).copy()
+        
+        if not persist_changes([('delete', deleted_book)]):
+            return jsonify({'error': '儲存失敗'}), 500
+        books.remove(book_id)
+        publish_book_change('delete', deleted_book, books)
     
-    if save_all_books(books):
-        # 記錄刪除活動
-        if deleted_book:
-            add_activity('delete', deleted_book)
-        return jsonify({'success': True})
-    else:
-        return jsonify({'error': '儲存失敗'}), 500
+    # 記錄刪除活動
+    add_activity('delete', deleted_book)
+    return jsonify({'success': True})
+
+def _storage_change_check():
+    """SSE 閒置時檢查: 其他行程修改了資料時通知客戶端重新同步"""
+    seen = [STORAGE.change_token()]
+
+    def check():
+        token = STORAGE.change_token()
+        if token == seen[0]:
+            return None
+        seen[0] = token
+        if token != LAST_MTIME:
+            return format_event('resync', {})
+        return None
+
+    return check
+
+@app.route('/api/events', methods=['GET'])
+def stream_events():
+    """
+    即時推播 (Server-Sent Events)
+    事件: book (新增/修改/刪除)、activity (活動記錄)、reload (資料重新載入)、resync (請以 /api/books/changes 重新同步)
+    """
+    subscriber = EVENTS.subscribe()
+    if subscriber is None:
+        return jsonify({'error': '連線數已達上限'}), 503
+    response = Response(
+        EVENTS.stream(subscriber, idle_check=_storage_change_check()),
+        mimetype='text/event-stream'
+    )
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # 避免反向代理緩衝
+    return response
 
 @app.route('/api/stats', methods=['GET'])
 def get_stats():
-    """取得統計資料"""
-    books = read_all_books()
-    
-    # 作者統計
-    authors = {}
-    for book in books:
-        author = book.get('author', '未分類作者')
-        if author and author != '未分類作者':
-            if author not in authors:
-                authors[author] = []
-            authors[author].append(book['title'])
-    
-    # 分類統計
-    category_stats = {}
-    for cat in CATEGORIES:
-        category_stats[cat] = len([b for b in books if b.get('category') == cat])
-    
-    return jsonify({
-        'total_books': len(books),
-        'total_authors': len(authors),
-        'category_stats': category_stats,
-        'authors': authors
-    })
+    """取得統計資料 (總數/作者數/各分類數量；各作者的書籍請用 /api/stats/authors)"""
+    with books_for_read() as books:
+        def build():
+            # 分類統計 (快取中增量維護，不必掃描書籍)
+            category_stats = {}
+            for cat in CATEGORIES:
+                category_stats[cat] = books.count(cat)
+            return jsonify({
+                'total_books': len(books),
+                'total_authors': books.author_count(),
+                'category_stats': category_stats
+            })
+        
+        return conditional_json(books, build)
+
+@app.route('/api/stats/authors', methods=['GET'])
+def get_author_stats():
+    """作者統計 (分頁): sort=count|name, limit, offset"""
+    with books_for_read() as books:
+        def build():
+            try:
+                result = books.authors(
+                    sort=request.args.get('sort', 'count'),
+                    limit=request.args.get('limit', DEFAULT_LIMIT),
+                    offset=request.args.get('offset', 0)
+                )
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            return jsonify(result)
+        
+        return conditional_json(books, build)
 
 @app.route('/api/export', methods=['GET'])
 def export_books():
-    """匯出 Excel 檔案"""
+    """匯出目前資料: format=xlsx (預設) / csv / jsonl；同一版本的檔案只產生一次"""
+    fmt = request.args.get('format', 'xlsx')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f'Unknown format: {fmt}'}), 400
     try:
-        if not os.path.exists(EXCEL_FILE):
-             return jsonify({'error': '找不到原始檔案'}), 404
-             
-        # 確保 Excel 檔案存在且最新 (若是記憶體有更新但 save 失敗的情況... 但通常 save 會成功)
-        # 這裡直接傳送檔案即可，因為所有修改都會立即寫入檔案
-            
-        return send_file(
-            EXCEL_FILE,
-            as_attachment=True,
-            download_name=f'library_books_{datetime.now().strftime("%Y%m%d")}.xlsx',
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
+        with books_for_read() as books:
+            def build():
+                response = Response(EXPORTS.get(books, fmt), mimetype=EXPORT_FORMATS[fmt])
+                filename = f'library_books_{datetime.now().strftime("%Y%m%d")}.{fmt}'
+                response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+                return response
+
+            return conditional_json(books, build)
     except Exception as e:
         logger.error(f"Export error: {e}")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/debug/reload', methods=['POST'])
 def force_reload():
-    """強制重讀 Excel (清除快取)"""
+    """強制重讀 (清除快取)"""
     global CACHED_BOOKS, LAST_MTIME
-    CACHED_BOOKS = None
-    LAST_MTIME = 0
-    books = read_all_books()
-    return jsonify({'message': 'Cache cleared', 'count': len(books)})
+    with CACHE_LOCK.write():
+        CACHED_BOOKS = None
+        LAST_MTIME = 0
+        _reload_cache()
+        count = len(CACHED_BOOKS)
+    return jsonify({'message': 'Cache cleared', 'count': count})
+
+@app.route('/api/import', methods=['POST'])
+def import_books():
+    """從 Excel 重新匯入所有書籍 (會取代目前資料)"""
+    global CACHED_BOOKS, LAST_MTIME
+    try:
+        if not os.path.exists(EXCEL_FILE):
+            return jsonify({'error': '找不到原始檔案'}), 404
+        
+        if STORAGE.name == 'excel':
+            # Excel 本身就是儲存，重讀即可
+            with CACHE_LOCK.write():
+                CACHED_BOOKS = None
+                LAST_MTIME = 0
+                _reload_cache()
+                books = CACHED_BOOKS
+        else:
+            books = read_workbook_cached(EXCEL_FILE, CATEGORIES)
+            if not save_all_books(books):
+                return jsonify({'error': '匯入失敗'}), 500
+        
+        logger.info(f"Imported {len(books)} books from Excel")
+        return jsonify({'message': 'Imported', 'count': len(books)})
+    except Exception as e:
+        logger.error(f"Import error: {e}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/api/activities', methods=['GET'])
 def get_activities():
-    """取得今日活動記錄"""
-    global ACTIVITY_LOG
-    
+    """
+    取得活動記錄
+    - 無查詢參數: 今日記錄 (最新在前，limit 指定最多幾筆) 與統計
+    - from / to / action / book_id / cursor: 歷史記錄分頁結果 {activities, total, next_cursor, daily}
+    """
+    if any(param in request.args for param in ACTIVITY_QUERY_PARAMS):
+        return get_activity_history()
+
     today = datetime.now().strftime('%Y-%m-%d')
-    # 只回傳今日的記錄
-    today_activities = [a for a in ACTIVITY_LOG if a.get('date', '').startswith(today)]
+    try:
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+    today_activities = ACTIVITIES.tail(today, limit=limit)
+    counts = ACTIVITIES.counts(today)
     
-    logger.info(f"API: get_activities. Today: {today}. Found: {len(today_activities)}")
+    logger.info(f"API: get_activities. Today: {today}. Found: {counts['total']}")
     
-    # 統計資訊
-    stats = {
-        'total': len(today_activities),
-        'adds': len([a for a in today_activities if a['action'] == 'add']),
-        'edits': len([a for a in today_activities if a['action'] == 'edit']),
-        'deletes': len([a for a in today_activities if a['action'] == 'delete']),
-        'category_changes': len([a for a in today_activities if a['action'] == 'category_change']),
-        'date': today
-    }
+    # 統計資訊 (附加時累計，不必掃描記錄)
+    stats = dict(activity_stats(counts), date=today)
     
     response = jsonify({
         'activities': today_activities,
@@ -574,24 +608,39 @@ def get_activities():
     response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     return response
 
+def get_activity_history():
+    """歷史活動記錄 (日期區間/動作/書籍 id 篩選，分頁)"""
+    try:
+        book_id = request.args.get('book_id')
+        result = ACTIVITIES.query(
+            start=parse_day(request.args.get('from')),
+            end=parse_day(request.args.get('to')),
+            action=request.args.get('action') or None,
+            book_id=int(book_id) if book_id else None,
+            limit=request.args.get('limit', ACTIVITY_DEFAULT_LIMIT),
+            cursor=request.args.get('cursor') or None
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    result['daily'] = [dict(activity_stats(c), date=c['date']) for c in result['daily']]
+    response = jsonify(result)
+    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    return response
+
 @app.route('/api/activities', methods=['DELETE'])
 def clear_activities():
-    """清除所有活動記錄"""
-    global ACTIVITY_LOG
-    ACTIVITY_LOG = []
-    save_activity_log()  # 💾 同時清空檔案
+    """清除今日活動記錄"""
+    ACTIVITIES.clear(datetime.now().strftime('%Y-%m-%d'))  # 💾 同時刪除記錄檔
     return jsonify({'success': True, 'message': '活動記錄已清除'})
 
 if __name__ == '__main__':
     print("=" * 50)
     print("📚 圖書館借書管理系統 - API 服務")
     print("=" * 50)
+    print(f"儲存後端: {STORAGE.name}")
     print(f"Excel 檔案: {EXCEL_FILE}")
     print(f"API 網址: http://localhost:5001")
     print("=" * 50)
-    
-    # 📂 啟動時載入活動記錄
-    load_activity_log()
-    print(f"已載入 {len(ACTIVITY_LOG)} 筆今日活動記錄")
+    print(f"今日活動記錄: {ACTIVITIES.counts(datetime.now().strftime('%Y-%m-%d'))['total']} 筆")
     
     app.run(host='0.0.0.0', debug=True, port=5001, use_reloader=False) # Disable reloader to prevent double loops in some envs
@@ -8,6 +8,8 @@ import json
 from pathlib import Path
 from datetime import datetime
 
+from collation import sort_key as stroke_sort_key
+
 # 頁面設定
 st.set_page_config(
     page_title="圖書館借書管理系統",
@@ -184,14 +186,15 @@ if search_term:
         if search_lower in b.get('title', '').lower() or search_lower in b.get('author', '').lower()
     ]
 
-# 排序
+# 排序 (筆畫排序鍵有快取，同一作者/書名只計算一次)
 if sort_by == "作者筆畫":
     filtered_books.sort(key=lambda x: (
         x.get('author') == '未分類作者',  # 未分類排最後
-        x.get('author', '')
+        stroke_sort_key(x.get('author', '')),
+        stroke_sort_key(x.get('title', ''))
     ))
 else:
-    filtered_books.sort(key=lambda x: x.get('title', ''))
+    filtered_books.sort(key=lambda x: stroke_sort_key(x.get('title', '')))
 
 # 顯示結果數量
 st.markdown(f"### 顯示 **{len(filtered_books):,}** 本書籍")
@@ -0,0 +1,10 @@
+import os
+import sys
+
+# 模組都放在專案根目錄 (沒有套件結構)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def book(book_id, title='t', author='a', category='待借', date=''):
+    """測試用的書籍資料 (dict)"""
+    return {'id': book_id, 'title': title, 'author': author, 'category': category, 'date': date, 'note': ''}
@@ -0,0 +1,105 @@
+from datetime import datetime, timedelta
+import gzip
+import json
+import os
+
+from backup import BackupScheduler, list_backups, select_retained
+from backup_store import BackupStore
+from conftest import book
+from storage import ExcelStorage, JsonStorage, SQLiteStorage
+from test_excel_io import CATEGORIES, make_workbook
+
+
+def backups_every(hours, count, start=datetime(2026, 1, 31, 23, 30)):
+    """每 hours 小時一份，由新到舊 (格式同 list_backups)"""
+    return [(start - timedelta(hours=hours * i), None, f'b{i}') for i in range(count)]
+
+
+def test_retention_keeps_newest_per_bucket():
+    backups = backups_every(0.5, 6)  # 23:30, 23:00, 22:30, ...
+    assert select_retained(backups, hourly=2, daily=0, weekly=0) == {'b0', 'b2'}
+
+
+def test_retention_tiers_combine():
+    backups = backups_every(6, 4 * 60)  # 60 天，每天 4 份
+    keep = select_retained(backups, hourly=3, daily=5, weekly=2)
+    # 最近 3 個小時區間 + 最近 5 天各一份 (與前者重疊) + 最近 2 週各一份
+    days = {backups[int(name[1:])][0].date() for name in keep}
+    assert {'b0', 'b1', 'b2'} <= keep
+    assert len(days) == 5 + 1  # 第 6 天為上一週最新的一份
+    assert len(keep) == 3 + 4 + 1
+
+
+def test_retention_always_keeps_latest():
+    assert select_retained(backups_every(1, 3), hourly=0, daily=0, weekly=0) == {'b0'}
+    assert select_retained([]) == set()
+
+
+def test_file_backups_dedupe_and_prune(tmp_path):
+    storage = SQLiteStorage(str(tmp_path / 'library.db'))
+    storage.initialize(lambda: [book(1)])
+    backup_dir = tmp_path / 'backups'
+    scheduler = BackupScheduler(storage, str(backup_dir), hourly=1, daily=0, weekly=0)
+
+    path = scheduler.run_once(force=True)
+    assert path and os.path.exists(path)
+    assert scheduler.run_once(force=True) is None  # 內容沒變
+
+    # 較舊的完整備份 (舊格式) 依保留規則刪除
+    old = backup_dir / '備份_20200101_120000.xlsx'
+    old.write_bytes(b'old')
+    storage.apply_changes([('update', book(1, 'changed'))])
+    newer = scheduler.run_once(force=True)
+    names = [name for _, _, name in list_backups(str(backup_dir))]
+    assert names == [os.path.basename(newer)]
+    with gzip.open(newer, 'rb') as f:
+        assert f.read() == storage.snapshot()[0]
+    storage.close()
+
+
+def test_file_backup_of_json_storage(tmp_path):
+    data_file = tmp_path / 'books.json'
+    data_file.write_text(json.dumps([book(1), book(2)]), encoding='utf-8')
+    storage = JsonStorage(str(data_file))
+    storage.apply_changes([('delete', book(2))])
+    scheduler = BackupScheduler(storage, str(tmp_path / 'backups'))
+
+    path = scheduler.run_once(force=True)
+    assert path.endswith('.json.gz')
+    with gzip.open(path, 'rb') as f:
+        assert json.loads(f.read()) == [book(1)]
+
+
+def test_store_backups_pruned_by_retention(tmp_path):
+    storage = SQLiteStorage(str(tmp_path / 'library.db'))
+    storage.initialize(lambda: [book(1)])
+    store = BackupStore(str(tmp_path / 'store'))
+    start = datetime(2026, 1, 1, 12)
+    for day in range(5):
+        store.commit([book(1, f'day {day}')], when=start + timedelta(days=day))
+
+    scheduler = BackupScheduler(storage, str(tmp_path / 'backups'), hourly=1, daily=3, weekly=0, store=store)
+    snapshot_id = scheduler.run_once(force=True)
+    assert snapshot_id is not None
+    ids = [s for _, s in store.snapshots()]
+    assert len(ids) == 3 and ids[-1] == snapshot_id
+    assert store.load(ids[0])[0]['title'] == 'day 3'
+    assert store.restore()[1] == [book(1)]
+    storage.close()
+
+
+def test_store_backup_keeps_excel_patcher(tmp_path):
+    workbook = str(tmp_path / 'books.xlsx')
+    make_workbook(workbook, {'待借': [('甲', '書一', '', ''), ('乙', '書二', '', '')]})
+    storage = ExcelStorage(workbook, CATEGORIES)
+    storage.apply_changes([('add', dict(book(2, '新書'), category='新書-待借'))])
+    patcher = storage._patcher
+
+    scheduler = BackupScheduler(storage, str(tmp_path / 'backups'), store=BackupStore(str(tmp_path / 'store')))
+    scheduler.run_once(force=True)
+    assert storage._patcher is patcher  # 備份不重讀 Excel，不丟棄已載入的活頁簿
+    assert {b['title'] for b in scheduler.store.restore()[1]} == {'書一', '書二', '新書'}
+
+    storage.apply_changes([('update', dict(book(1, '改書二'), author='乙'))])
+    assert storage._patcher is patcher
+    assert {b['id']: b['title'] for b in storage.load_books()} == {0: '書一', 1: '改書二', 2: '新書'}
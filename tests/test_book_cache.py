@@ -0,0 +1,148 @@
+import pytest
+
+import book_cache
+from book_cache import DEFAULT_AUTHOR, SORT_KEYS, BookCache, build_book
+from conftest import book
+
+
+@pytest.fixture
+def cache():
+    return BookCache([
+        book(1, '三國演義', '羅貫中', '待借', '2024-01-03'),
+        book(2, '水滸傳', '施耐庵', '待借', '2024-01-01'),
+        book(3, '紅樓夢', '曹雪芹', '已看-1', ''),
+        book(4, '西遊記', DEFAULT_AUTHOR, '待借', '2024-01-02'),
+    ])
+
+
+def brute_force(cache, sort, category=None):
+    """不用索引，直接排序全部書籍 (與索引結果比對)"""
+    books = [b for b in cache.all() if category is None or b['category'] == category]
+    func = cache._sort_key_func(sort)
+    return [b['id'] for b in sorted(books, key=func)]
+
+
+def query_ids(cache, sort, category=None):
+    return [b['id'] for b in cache.query(category=category, sort=sort, limit=500)['books']]
+
+
+def test_indexes_follow_add_update_remove(cache):
+    for sort in SORT_KEYS:
+        query_ids(cache, sort)  # 先建立索引，之後的變更需要增量維護
+    cache.add(book(cache.next_id(), '金瓶梅', '蘭陵笑笑生', '待借', '2023-12-31'))
+    cache.update(book(2, '水滸全傳', '施耐庵', '已看-1', '2024-02-01'))
+    cache.remove(1)
+    for sort in SORT_KEYS:
+        for category in (None, '待借', '已看-1'):
+            assert query_ids(cache, sort, category) == brute_force(cache, sort, category)
+    assert cache.count('待借') == 2
+    assert cache.count('已看-1') == 2
+    assert {a['author'] for a in cache.authors()['authors']} == {'施耐庵', '曹雪芹', '蘭陵笑笑生'}
+
+
+def test_search_index_follows_update(cache):
+    assert cache.query(q='水滸')['total'] == 1
+    cache.update(book(2, '忠義水滸傳', '施耐庵'))
+    cache.update(book(3, '石頭記', '曹雪芹', '已看-1'))
+    assert [b['id'] for b in cache.query(q='水滸')['books']] == [2]
+    assert cache.query(q='紅樓')['total'] == 0
+    assert cache.query(q='石頭')['total'] == 1
+
+
+def test_cursor_pages_cover_all_books(cache):
+    seen, cursor = [], None
+    while True:
+        page = cache.query(sort='title', limit=1, cursor=cursor)
+        seen += [b['id'] for b in page['books']]
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert seen == brute_force(cache, 'title')
+
+
+def test_next_id_is_unique_after_removal(cache):
+    new_id = cache.next_id()
+    assert new_id == 5
+    cache.remove(4)
+    assert cache.next_id() == 6
+
+
+def test_next_id_from_id_source(cache):
+    allocated = []
+
+    def allocate(minimum):
+        allocated.append(minimum)
+        return max(minimum, 10)
+
+    cache._id_source = allocate
+    assert cache.next_id() == 10
+    assert cache.next_id() == 11
+    assert allocated == [5, 11]
+
+
+def test_build_book_defaults_and_coercion():
+    assert build_book(None, {'title': 'A', 'date': 20240101}) == {
+        'id': None, 'title': 'A', 'author': DEFAULT_AUTHOR, 'category': '新書-待借',
+        'date': '20240101', 'note': ''
+    }
+    old = book(7, '舊書名', '舊作者', '已看-1', '2024-01-01')
+    assert build_book(7, {'title': 123, 'note': None}, base=old) == dict(old, title='123')
+
+
+@pytest.mark.parametrize('data', [
+    {'title': ['a']}, {'author': {'x': 1}}, {'date': True}, [], 'title'
+])
+def test_build_book_rejects_invalid_fields(data):
+    with pytest.raises(ValueError):
+        build_book(None, data)
+
+
+def test_numbers_in_loaded_data_are_sortable():
+    cache = BookCache([book(1, 123, date=20240101), book(2, '書', date='2024-01-02')])
+    for sort in SORT_KEYS:
+        assert sorted(query_ids(cache, sort)) == [1, 2]
+    assert cache.get(1)['date'] == '20240101'
+
+
+def test_failed_insert_leaves_cache_unchanged(cache, monkeypatch):
+    for sort in SORT_KEYS:
+        query_ids(cache, sort)
+    before = {sort: query_ids(cache, sort) for sort in SORT_KEYS}
+    version = cache.version
+
+    def broken(book, strokes):
+        raise TypeError('boom')
+
+    monkeypatch.setitem(book_cache.SORT_KEYS, 'title', broken)
+    with pytest.raises(TypeError):
+        cache.add(book(cache.next_id(), '新書'))
+    with pytest.raises(TypeError):
+        cache.update(book(2, '改名'))
+    monkeypatch.undo()
+
+    assert cache.version == version
+    assert cache.get(2)['title'] == '水滸傳'
+    assert len(cache) == 4
+    assert {sort: query_ids(cache, sort) for sort in SORT_KEYS} == before
+
+
+def test_plan_batch_reports_invalid_fields(cache):
+    changes, results, errors = cache.plan_batch([
+        {'op': 'add', 'book': {'title': '新書'}},
+        {'op': 'update', 'id': 1, 'book': {'title': ['x']}},
+        {'op': 'add', 'book': {'date': {}}},
+    ])
+    assert [e['index'] for e in errors] == [1, 2]
+    assert changes[0][1]['title'] == '新書'
+    assert len(cache) == 4
+
+
+def test_changes_since(cache):
+    version = cache.version
+    cache.update(book(1, '三國志', '陳壽'))
+    cache.remove(3)
+    delta = cache.changes_since(version, cache.instance)
+    assert not delta['full']
+    assert [b['id'] for b in delta['books']] == [1]
+    assert delta['deleted'] == [3]
+    assert cache.changes_since(version, 'other-epoch')['full']
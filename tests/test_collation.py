@@ -0,0 +1,33 @@
+from pathlib import Path
+
+import pytest
+
+from collation import sort_key, stroke_count
+
+# build_stroke_table.py 以 Intl.Collator('zh-TW-u-co-stroke') 排序產生 (書單中的作者/書名與各筆畫的中文字)
+FIXTURE = Path(__file__).parent / 'data' / 'zh_tw_stroke_order.txt'
+
+
+def test_matches_intl_collator_fixture():
+    items = FIXTURE.read_text(encoding='utf-8').split('\n')[:-1]
+    assert len(items) > 1000
+    wrong = [(a, b) for a, b in zip(items, items[1:]) if sort_key(a) > sort_key(b)]
+    assert wrong == []
+
+
+@pytest.mark.parametrize('char, strokes', [
+    ('一', 1), ('丁', 2), ('王', 4), ('陳', 11), ('黃', 12), ('龜', 16), ('龘', 48), ('a', 0)
+])
+def test_taiwan_stroke_counts(char, strokes):
+    assert stroke_count(char) == strokes
+
+
+def test_symbols_and_digits_before_han_before_latin():
+    items = ['Harry', '王', '2024', '-', '一', 'ㄅ', 'abc']
+    assert sorted(items, key=sort_key) == ['-', '2024', '一', '王', 'ㄅ', 'abc', 'Harry']
+
+
+def test_case_width_and_accents_ignored():
+    assert sort_key('ABC') == sort_key('abc') == sort_key('ａｂｃ')
+    assert sort_key('Àngels') == sort_key('angels')
+    assert sort_key('⼀') == sort_key('一')  # 康熙部首正規化為中文字
@@ -0,0 +1,146 @@
+import pickle
+
+import openpyxl
+import pytest
+
+import excel_io
+from excel_io import ID_COLUMN, WorkbookPatcher, assign_ids, load_snapshot, read_workbook, read_workbook_cached
+from storage import ExcelStorage
+
+CATEGORIES = ['新書-待借', '待借', '已看-1']
+
+
+def make_workbook(path, sheets):
+    """sheets: {分類: [(作者, 書名, 到期日, 備註), ...]}，不含系統ID 欄 (舊格式)"""
+    wb = openpyxl.Workbook()
+    wb.remove(wb.active)
+    for name, rows in sheets.items():
+        ws = wb.create_sheet(name)
+        ws.append(['作者', '書名', '到期日', 'ISBN'])
+        for row in rows:
+            ws.append(list(row))
+    wb.save(path)
+
+
+@pytest.fixture
+def workbook(tmp_path):
+    path = str(tmp_path / 'books.xlsx')
+    make_workbook(path, {
+        '新書-待借': [('甲', '書一', '2024-01-01', ''), ('乙', '書二', '', '')],
+        '待借': [('丙', '書三', '', 'ISBN1'), ('丁', '書四', '', '')],
+        '已看-1': [('戊', '書五', '', '')],
+    })
+    return path
+
+
+def titles_by_id(books):
+    return {b['id']: b['title'] for b in books}
+
+
+def test_legacy_workbook_ids_follow_sheet_order(workbook):
+    books = read_workbook(workbook, CATEGORIES, engine='openpyxl')
+    assert titles_by_id(books) == {0: '書一', 1: '書二', 2: '書三', 3: '書四', 4: '書五'}
+
+
+def test_patcher_ids_match_read_workbook_and_books(workbook):
+    patcher = WorkbookPatcher(workbook, CATEGORIES)
+    assert patcher.books() == read_workbook(workbook, CATEGORIES, engine='openpyxl')
+
+
+def test_ids_stay_stable_after_add_and_reload(workbook):
+    storage = ExcelStorage(workbook, CATEGORIES)
+    books = storage.load_books()
+    assert titles_by_id(books)[3] == '書四'
+
+    # 新增到第一個工作表 (位置在其他書之前)，再重讀並修改後面工作表的書
+    storage.apply_changes([('add', {'id': 5, 'title': '新書', 'author': '己', 'category': '新書-待借',
+                                    'date': '', 'note': ''})])
+    reloaded = titles_by_id(storage.load_books())
+    assert reloaded == {0: '書一', 1: '書二', 5: '新書', 2: '書三', 3: '書四', 4: '書五'}
+
+    storage.apply_changes([('update', {'id': 3, 'title': '書四 (改)', 'author': '丁', 'category': '待借',
+                                       'date': '', 'note': ''})])
+    after = titles_by_id(read_workbook(workbook, CATEGORIES, engine='openpyxl'))
+    assert after[3] == '書四 (改)'
+    assert after[5] == '新書'
+    assert after[2] == '書三'
+
+
+def test_delete_and_category_change_keep_other_ids(workbook):
+    storage = ExcelStorage(workbook, CATEGORIES)
+    storage.load_books()
+    storage.apply_changes([('delete', {'id': 0})])
+    storage.apply_changes([('update', {'id': 2, 'title': '書三', 'author': '丙', 'category': '已看-1',
+                                       'date': '', 'note': 'ISBN1'})])
+    books = {b['id']: b for b in read_workbook(workbook, CATEGORIES, engine='openpyxl')}
+    assert sorted(books) == [1, 2, 3, 4]
+    assert books[2]['category'] == '已看-1'
+    assert books[4]['title'] == '書五'
+
+
+def test_id_column_is_hidden_and_survives_manual_row_insert(workbook):
+    storage = ExcelStorage(workbook, CATEGORIES)
+    storage.load_books()
+    storage.apply_changes([('update', {'id': 1, 'title': '書二', 'author': '乙', 'category': '新書-待借',
+                                       'date': '', 'note': '備註'})])
+
+    wb = openpyxl.load_workbook(workbook)
+    ws = wb['新書-待借']
+    assert ws.cell(row=1, column=5).value == ID_COLUMN
+    assert ws.column_dimensions['E'].hidden
+    # 在 Excel 中手動插入一列 (沒有系統ID)
+    ws.insert_rows(2)
+    ws.cell(row=2, column=2, value='手動新增')
+    wb.save(workbook)
+
+    books = titles_by_id(read_workbook(workbook, CATEGORIES, engine='openpyxl'))
+    assert books[0] == '書一' and books[1] == '書二'
+    assert books[5] == '手動新增'
+
+
+def test_cached_read_keeps_ids(workbook):
+    storage = ExcelStorage(workbook, CATEGORIES)
+    storage.load_books()
+    storage.apply_changes([('delete', {'id': 1})])
+    fresh = read_workbook(workbook, CATEGORIES, engine='openpyxl')
+    assert read_workbook_cached(workbook, CATEGORIES) == fresh
+    assert read_workbook_cached(workbook, CATEGORIES) == fresh  # 第二次來自快照
+
+
+def test_snapshot_written_from_memory_when_idle(workbook, monkeypatch):
+    storage = ExcelStorage(workbook, CATEGORIES)
+    storage.load_books()
+    storage.apply_changes([('add', {'id': 5, 'title': '書六', 'author': '己', 'category': '待借',
+                                    'date': '', 'note': ''})])
+    storage.apply_changes([('delete', {'id': 0})])
+    assert load_snapshot(workbook, CATEGORIES) is None  # 寫入時不更新快照
+
+    def no_rehash(path):
+        raise AssertionError('snapshot should use the digest computed on save')
+
+    monkeypatch.setattr(excel_io, '_file_digest', no_rehash)
+    storage.idle()
+    monkeypatch.undo()
+    assert load_snapshot(workbook, CATEGORIES) == read_workbook(workbook, CATEGORIES, engine='openpyxl')
+    with open(workbook + '.snapshot', 'rb') as f:
+        assert pickle.load(f)['digest'] == excel_io._file_digest(workbook)
+
+
+def test_idle_skips_snapshot_after_external_edit(workbook):
+    storage = ExcelStorage(workbook, CATEGORIES)
+    storage.apply_changes([('delete', {'id': 4})])
+    make_workbook(workbook, {'待借': [('外部', '外部修改', '', '')]})
+    storage.idle()
+    assert [b['title'] for b in storage.load_books()] == ['外部修改']
+
+
+def test_update_of_unknown_row_does_not_touch_other_books(workbook):
+    patcher = WorkbookPatcher(workbook, CATEGORIES)
+    patcher._rows['待借'].remove(3)  # 對照表與工作表不一致
+    with pytest.raises(KeyError):
+        patcher.update({'id': 3, 'title': 'x', 'author': 'y', 'category': '待借', 'date': '', 'note': ''})
+
+
+def test_assign_ids_skips_duplicates():
+    books = assign_ids([{'id': 7, 'title': 'a'}, {'id': 7, 'title': 'b'}, {'id': None, 'title': 'c'}])
+    assert [(b['id'], b['title']) for b in books] == [(7, 'a'), (8, 'b'), (9, 'c')]
@@ -0,0 +1,130 @@
+import json
+import os
+
+import pytest
+
+from conftest import book
+import storage as storage_module
+from json_backend import dumpb
+from storage import JsonStorage, SQLiteStorage
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    path = tmp_path / 'books.json'
+    path.write_text(json.dumps([book(1, 'one'), book(2, 'two')]), encoding='utf-8')
+    return str(path)
+
+
+def titles(storage):
+    return {b['id']: b['title'] for b in storage.load_books()}
+
+
+def wal_line(*changes):
+    return dumpb({'changes': list(changes)}) + b'\n'
+
+
+def test_changes_append_to_wal_and_replay(data_file):
+    storage = JsonStorage(data_file)
+    storage.apply_changes([('add', book(3, 'three'))])
+    storage.apply_changes([('update', book(1, 'uno')), ('delete', book(2))])
+    with open(data_file, encoding='utf-8') as f:
+        assert len(json.load(f)) == 2  # 快照不變，只附加寫入記錄
+    with open(storage.wal_file, 'rb') as f:
+        assert len(f.readlines()) == 2
+    assert titles(JsonStorage(data_file)) == {1: 'uno', 3: 'three'}
+
+
+def test_torn_tail_skipped_on_read(data_file):
+    with open(data_file + '.wal', 'wb') as f:
+        f.write(wal_line(('update', book(1, 'uno'))))
+        f.write(wal_line(('delete', book(2)))[:-7])  # 寫到一半被中斷
+    assert titles(JsonStorage(data_file)) == {1: 'uno', 2: 'two'}
+
+
+def test_torn_tail_truncated_before_next_append(data_file, monkeypatch):
+    monkeypatch.setattr(storage_module, 'WAL_SCAN_BLOCK', 8)  # 不完整的行跨越多個讀取區塊
+    first = wal_line(('update', book(1, 'uno')))
+    with open(data_file + '.wal', 'wb') as f:
+        f.write(first + wal_line(('delete', book(2)))[:-3])
+    storage = JsonStorage(data_file)
+    storage.apply_changes([('add', book(3, 'three'))])
+    with open(storage.wal_file, 'rb') as f:
+        assert f.read() == first + wal_line(('add', book(3, 'three')))
+    assert titles(JsonStorage(data_file)) == {1: 'uno', 2: 'two', 3: 'three'}
+
+
+def test_torn_only_line_truncated(data_file):
+    with open(data_file + '.wal', 'wb') as f:
+        f.write(b'{"changes": [["add"')
+    storage = JsonStorage(data_file)
+    storage.apply_changes([('delete', book(1))])
+    assert titles(JsonStorage(data_file)) == {2: 'two'}
+
+
+def test_append_reads_only_last_byte(data_file, monkeypatch):
+    storage = JsonStorage(data_file)
+    storage.apply_changes([('add', book(3))])
+    reads = []
+    real_open = open
+
+    class Tracking:
+        def __init__(self, f):
+            self._f = f
+
+        def read(self, size=-1):
+            data = self._f.read(size)
+            reads.append(len(data))
+            return data
+
+        def __getattr__(self, name):
+            return getattr(self._f, name)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            self._f.close()
+
+    def tracking_open(path, mode='r', *args, **kwargs):
+        f = real_open(path, mode, *args, **kwargs)
+        return Tracking(f) if mode == 'r+b' else f
+
+    monkeypatch.setattr('builtins.open', tracking_open)
+    storage.apply_changes([('add', book(4))])
+    monkeypatch.undo()
+    assert reads == [1]
+
+
+def test_compaction_rewrites_snapshot_and_clears_wal(data_file):
+    storage = JsonStorage(data_file, compact_bytes=200)
+    for i in range(3, 8):
+        storage.apply_changes([('add', book(i, 'x' * 40))])
+    with open(data_file, encoding='utf-8') as f:
+        compacted = {b['id'] for b in json.load(f)}
+    assert compacted >= {1, 2, 3}
+    assert titles(JsonStorage(data_file)).keys() == set(range(1, 8))
+
+    storage.compact()
+    assert not os.path.exists(storage.wal_file)
+    with open(data_file, encoding='utf-8') as f:
+        assert {b['id'] for b in json.load(f)} == set(range(1, 8))
+
+
+def test_allocated_ids_not_reused_after_restart(data_file, tmp_path):
+    storage = JsonStorage(data_file)
+    assert storage.allocate_id() == 3
+    assert storage.allocate_id(minimum=3) == 4
+    storage.apply_changes([('add', book(4))])
+    storage.apply_changes([('delete', book(4))])
+    assert JsonStorage(data_file).allocate_id() == 5  # 刪除的最大 id 不會再配發
+
+    db = SQLiteStorage(str(tmp_path / 'library.db'))
+    db.initialize(lambda: [book(1), book(2)])
+    assert db.allocate_id() == 3
+    db.apply_changes([('add', book(3))])
+    db.apply_changes([('delete', book(3))])
+    db.close()
+    db = SQLiteStorage(str(tmp_path / 'library.db'))
+    assert db.allocate_id(minimum=2) == 4
+    db.close()
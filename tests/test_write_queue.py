@@ -0,0 +1,164 @@
+import os
+import threading
+
+import pytest
+
+from conftest import book
+from json_backend import dumps
+from storage import SQLiteStorage
+from write_queue import WriteBehindQueue, coalesce_changes
+
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = SQLiteStorage(str(tmp_path / 'library.db'))
+    storage.initialize(lambda: [book(1, 'one'), book(2, 'two')])
+    yield storage
+    storage.close()
+
+
+def titles(storage):
+    return {b['id']: b['title'] for b in storage.load_books()}
+
+
+def test_coalesce_keeps_last_state():
+    changes = [
+        ('add', book(3, 'a')), ('update', book(3, 'b')),   # 新增後修改 -> 新增最後狀態
+        ('update', book(1, 'x')), ('delete', book(1)),      # 修改後刪除 -> 刪除
+        ('add', book(4)), ('delete', book(4)),              # 新增後刪除 -> 沒發生
+        ('delete', book(2)), ('update', book(2, 'back')),   # 刪除後又寫入 -> 修改
+    ]
+    assert coalesce_changes(changes) == [
+        ('add', book(3, 'b')), ('delete', book(1)), ('update', book(2, 'back'))
+    ]
+
+
+def test_submit_journals_and_flush_applies(storage, tmp_path):
+    flushed = []
+    queue = WriteBehindQueue(storage, str(tmp_path), flush_interval=60,
+                             on_flush=lambda before, after: flushed.append((before, after)))
+    queue.submit([('add', book(3, 'three')), ('update', book(1, 'uno'))])
+    assert os.path.exists(queue.journal_file)
+    assert titles(storage) == {1: 'one', 2: 'two'}
+    assert len(queue.pending()) == 2
+
+    assert queue.flush()
+    assert titles(storage) == {1: 'uno', 2: 'two', 3: 'three'}
+    assert queue.pending() == []
+    assert not os.path.exists(queue.journal_file)
+    assert len(flushed) == 1 and flushed[0][1] == storage.change_token()
+
+
+def test_restart_replays_own_journal(storage, tmp_path):
+    queue = WriteBehindQueue(storage, str(tmp_path))
+    queue.submit([('delete', book(2)), ('add', book(5, 'five'))])
+    # 程式在寫入前中斷: 新的佇列啟動時重播
+    restarted = WriteBehindQueue(storage, str(tmp_path))
+    restarted.start()
+    try:
+        assert titles(storage) == {1: 'one', 5: 'five'}
+        assert not os.path.exists(queue.journal_file)
+    finally:
+        restarted.stop()
+
+
+def test_orphan_journal_replayed_and_torn_line_skipped(storage, tmp_path):
+    orphan = tmp_path / 'write_journal.999999.jsonl'
+    orphan.write_text(
+        dumps({'op': 'update', 'book': book(1, 'orphan')}) + '\n'
+        + '{"op": "add", "book": {"id": 9', encoding='utf-8'  # 寫到一半
+    )
+    queue = WriteBehindQueue(storage, str(tmp_path))
+    queue.start()
+    try:
+        assert titles(storage) == {1: 'orphan', 2: 'two'}
+        assert not orphan.exists()
+    finally:
+        queue.stop()
+
+
+def test_live_process_journal_is_not_replayed(storage, tmp_path):
+    other = WriteBehindQueue(storage, str(tmp_path))
+    other.journal_file = str(tmp_path / 'write_journal.424242.jsonl')
+    other._journal_lock = type(other._journal_lock)(other._lock_path(other.journal_file))
+    other._journal_lock.acquire()  # 另一個仍在執行的行程
+    other.submit([('update', book(2, 'pending elsewhere'))])
+
+    queue = WriteBehindQueue(storage, str(tmp_path))
+    queue.start()
+    try:
+        assert titles(storage)[2] == 'two'
+        assert os.path.exists(other.journal_file)
+    finally:
+        queue.stop()
+        other._journal_lock.release()
+
+
+def test_changes_submitted_during_flush_stay_journaled(storage, tmp_path):
+    queue = WriteBehindQueue(storage, str(tmp_path))
+    original = storage.apply_changes
+
+    def slow_apply(changes):
+        queue.submit([('update', book(2, 'late'))])  # flush 期間新進的變更
+        return original(changes)
+
+    storage.apply_changes = slow_apply
+    queue.submit([('update', book(1, 'first'))])
+    assert queue.flush()
+    storage.apply_changes = original
+    assert [b['title'] for _, b in queue.pending()] == ['late']
+    with open(queue.journal_file, encoding='utf-8') as f:
+        assert 'late' in f.read()
+    assert queue.flush()
+    assert titles(storage) == {1: 'first', 2: 'late'}
+
+
+def test_load_with_pending_does_not_drop_batch_being_flushed(storage, tmp_path):
+    queue = WriteBehindQueue(storage, str(tmp_path))
+    original = storage.apply_changes
+    applying, release = threading.Event(), threading.Event()
+
+    def slow_apply(changes):
+        applying.set()
+        release.wait(5)
+        return original(changes)
+
+    storage.apply_changes = slow_apply
+    queue.submit([('add', book(3, 'three'))])
+    flusher = threading.Thread(target=queue.flush)
+    flusher.start()
+    applying.wait(5)
+
+    # flush 進行中 (已寫入一半): 讀取要等 flush 完成，不會讀到舊資料又拿到已清空的佇列
+    result = []
+    loader = threading.Thread(target=lambda: result.append(queue.load_with_pending(storage.load_books)))
+    loader.start()
+    loader.join(0.2)
+    assert loader.is_alive()
+    release.set()
+    flusher.join(5)
+    loader.join(5)
+
+    loaded, pending = result[0]
+    assert {b['id'] for b in loaded} | {b['id'] for _, b in pending} == {1, 2, 3}
+
+
+def test_on_flush_runs_outside_flush_lock(storage, tmp_path):
+    # on_flush 取得的鎖 (快取鎖) 可能正被等待 load_with_pending 的執行緒持有
+    calls = []
+    queue = WriteBehindQueue(storage, str(tmp_path),
+                             on_flush=lambda before, after: calls.append(queue._flush_lock.locked()))
+    queue.submit([('update', book(1, 'x'))])
+    assert queue.flush()
+    assert calls == [False]
+
+
+def test_idle_runs_when_queue_is_empty(storage, tmp_path):
+    idle = []
+    storage.idle = lambda: idle.append(len(queue.pending()))
+    queue = WriteBehindQueue(storage, str(tmp_path), flush_interval=0.01)
+    queue.start()
+    queue.submit([('update', book(1, 'x'))])
+    queue.stop()
+    assert idle and all(count == 0 for count in idle)
+    assert titles(storage)[1] == 'x'
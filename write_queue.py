@@ -0,0 +1,209 @@
+"""
+寫入佇列 (write-behind)
+API 先更新記憶體快取並回應，變更寫入 journal 後由背景執行緒合併成一批寫入儲存後端。
+每隔 flush_interval 秒或累積 max_pending 筆變更時寫入一次；
+程式中斷時尚未寫入的變更保留在 journal，下次啟動時重播。
+
+每個行程 (gunicorn worker) 使用自己的 journal (write_journal.<pid>.jsonl)，
+並在存活期間持有對應的檔案鎖；啟動時只重播鎖已釋放 (行程已結束) 的 journal。
+"""
+
+import glob
+import logging
+import os
+import threading
+
+from json_backend import dumps, loads
+from locks import FileLock
+
+logger = logging.getLogger(__name__)
+
+
+def coalesce_changes(changes):
+    """合併同一本書的多筆變更，只保留最後狀態"""
+    merged = {}
+    for op, book in changes:
+        book_id = book['id']
+        prev = merged.get(book_id)
+        if prev is None:
+            merged[book_id] = (op, book)
+        elif op == 'delete':
+            if prev[0] == 'add':
+                del merged[book_id]  # 新增後又刪除，等於沒發生
+            else:
+                merged[book_id] = ('delete', book)
+        elif prev[0] == 'add':
+            merged[book_id] = ('add', book)
+        else:
+            merged[book_id] = ('update', book)
+    return list(merged.values())
+
+
+class WriteBehindQueue:
+    """合併寫入的背景佇列 (附 journal)"""
+
+    def __init__(self, storage, journal_dir, flush_interval=0.5, max_pending=50, on_flush=None):
+        self.storage = storage
+        self.journal_dir = journal_dir
+        self.journal_file = self._journal_path(os.getpid())
+        self._journal_lock = FileLock(self._lock_path(self.journal_file))
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.on_flush = on_flush
+        self._pending = []
+        self._lock = threading.Lock()        # 保護 _pending 與 journal
+        self._flush_lock = threading.Lock()  # 同一時間只有一個 flush
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _journal_path(self, pid):
+        return os.path.join(self.journal_dir, f'write_journal.{pid}.jsonl')
+
+    @staticmethod
+    def _lock_path(journal_file):
+        return journal_file[:-len('.jsonl')] + '.lock'
+
+    def start(self):
+        """重播上次未寫入的變更 (自己與已結束行程的 journal)，並啟動背景寫入執行緒"""
+        self._journal_lock.acquire()
+        self.replay(self.journal_file)
+        self.replay_orphans()
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def replay_orphans(self):
+        """重播其他已結束行程留下的 journal"""
+        pattern = os.path.join(self.journal_dir, 'write_journal*.jsonl')
+        for journal_file in sorted(glob.glob(pattern)):
+            if journal_file == self.journal_file:
+                continue
+            lock_file = self._lock_path(journal_file)
+            lock = FileLock(lock_file)
+            if not lock.acquire(blocking=False):
+                continue  # 行程仍在執行中
+            try:
+                self.replay(journal_file)
+            finally:
+                lock.release()
+            try:
+                os.remove(lock_file)
+            except OSError:
+                pass
+
+    def replay(self, journal_file):
+        if not os.path.exists(journal_file):
+            return
+        changes = []
+        with open(journal_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = loads(line)
+                except ValueError:
+                    # 寫到一半被中斷的最後一行
+                    logger.warning("Skipping truncated journal entry")
+                    continue
+                changes.append((entry['op'], entry['book']))
+        if changes:
+            logger.info(f"Replaying {len(changes)} journaled change(s)")
+            self.storage.apply_changes(coalesce_changes(changes))
+        os.remove(journal_file)
+
+    def submit(self, changes):
+        """記錄變更到 journal (fsync) 並排入佇列，回傳後即視為已確認"""
+        lines = ''.join(
+            dumps({'op': op, 'book': book}) + '\n'
+            for op, book in changes
+        )
+        with self._lock:
+            with open(self.journal_file, 'a', encoding='utf-8') as f:
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            self._pending.extend(changes)
+            pending_count = len(self._pending)
+        if pending_count >= self.max_pending:
+            self._wakeup.set()
+
+    def pending(self):
+        """尚未寫入儲存後端的變更"""
+        with self._lock:
+            return list(self._pending)
+
+    def load_with_pending(self, load):
+        """
+        呼叫 load() 讀取儲存後端，回傳 (load() 的結果, 尚未寫入的變更)
+        兩者在沒有 flush 進行時一起讀取，不會有一批變更剛好在兩次讀取之間寫入而遺失
+        """
+        with self._flush_lock:
+            return load(), self.pending()
+
+    def flush(self):
+        """將佇列中的變更合併後一次寫入儲存後端"""
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._pending)
+            if not batch:
+                return True
+            try:
+                tokens = self.storage.apply_changes(coalesce_changes(batch))
+            except Exception as e:
+                logger.error(f"Write-behind flush failed (will retry): {e}")
+                return False
+
+            with self._lock:
+                # flush 期間新進的變更留在佇列與 journal
+                del self._pending[:len(batch)]
+                self._rewrite_journal()
+            logger.info(f"Flushed {len(batch)} change(s) to {self.storage.name} storage")
+        # 在 flush 鎖外通知 (on_flush 可能需要快取的鎖，而持有快取鎖時會呼叫 load_with_pending)
+        if self.on_flush:
+            self.on_flush(*tokens)
+        return True
+
+    def _rewrite_journal(self):
+        if not self._pending:
+            if os.path.exists(self.journal_file):
+                os.remove(self.journal_file)
+            return
+        tmp_file = self.journal_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            for op, book in self._pending:
+                f.write(dumps({'op': op, 'book': book}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.journal_file)
+
+    def _idle(self):
+        """佇列沒有變更時，讓儲存後端做延後的工作 (例如 Excel 快照)"""
+        try:
+            self.storage.idle()
+        except Exception as e:
+            logger.error(f"Storage idle task failed: {e}")
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if self.pending():
+                self.flush()
+            else:
+                self._idle()
+
+    def stop(self):
+        """停止背景執行緒並寫入剩餘變更"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        flushed = self.flush()
+        self._idle()
+        if flushed and self._journal_lock.locked:
+            self._journal_lock.release()
+            try:
+                os.remove(self._journal_lock.path)
+            except OSError:
+                pass